@@ -0,0 +1,173 @@
+import argparse
+import asyncio
+import logging
+import socket
+
+from protocol import (CODECS, FRAME_HEADER, HELLO_PREFIX, check_hello_prefix, choose_codec, encode_frame, is_framed,
+                      json_decode, read_frame_async, server_hello, split_json_messages)
+from push import FLUSH_INTERVAL, Subscriber, SubscriptionRegistry
+from durable import FSYNC_INTERVAL, SNAPSHOT_EVERY
+from metrics import configure_logging, serve_metrics
+from server import (add_server_arguments, encode_response, legacy_encode, open_store, raise_open_file_limit, respond,
+                    server_metrics, update_random_item)
+
+log = logging.getLogger('cache_invalidation.async_server')
+
+READ_SIZE = 64 * 1024
+
+
+class AsyncConnection:
+    # server.Connection for asyncio: writes are not interleaved as long as each message is one write()
+    def __init__(self, writer, metrics):
+        self.writer = writer
+        self.metrics = metrics
+        self.encode = legacy_encode  # until a framed hello
+        self.subscriber = None
+        self.sender = None
+
+    def send(self, message):
+        data = encode_response(self.encode, message)
+        self.writer.write(data)
+        self.metrics.count('bytes_sent_total', len(data))
+
+
+class AsyncServer:
+    """
+    The same get_invalidated/get_item protocol as server.Server, with every client served by one asyncio event loop.
+    A connection costs a few kilobytes of buffers instead of a thread and its stack, so thousands of clients
+    do not run into thread memory and context switching.
+    """
+
+    def __init__(self, host, port, item_count=5, flush_interval=FLUSH_INTERVAL, shards=None, data_dir=None,
+                 fsync_interval=FSYNC_INTERVAL, snapshot_every=SNAPSHOT_EVERY, metrics_port=None):
+        self.host = host
+        self.port = port
+        # The log is written by the DurableStore's own thread, puts on the event loop only queue the changes
+        self.store, self.durable = open_store(item_count, f"{host}:{port}", shards, data_dir, fsync_interval,
+                                              snapshot_every)
+        self.subscriptions = SubscriptionRegistry()
+        self.store.listeners.append(self.subscriptions.record_change)
+        self.flush_interval = flush_interval
+        self.connected_clients = set()
+        # Only the metrics HTTP server reads them from another thread
+        self.metrics = server_metrics(self.store, self.connected_clients)
+        self.metrics_port = metrics_port
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=socket.SOMAXCONN,
+                                            reuse_address=True)
+        log.info("Server listening on %s:%d", self.host, self.port)
+        if self.metrics_port is not None:
+            serve_metrics(self.metrics, self.host, self.metrics_port)
+        tasks = [asyncio.create_task(self.update_random_item_periodically()),
+                 asyncio.create_task(self.flush_subscriptions_periodically())]
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def update_random_item_periodically(self):
+        while True:
+            await asyncio.sleep(10)  # Update one random item every 10 seconds
+            random_item = update_random_item(self.store)
+            if random_item is not None:
+                log.info("Updated item %s", random_item.item_id)
+
+    async def flush_subscriptions_periodically(self):
+        # Only hands ids to the subscribers, their sender tasks do the writing
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            notified = self.subscriptions.flush()
+            if notified:
+                self.metrics.observe('invalidation_fanout', notified)
+
+    async def push_notifications(self, connection, subscriber, wakeup):
+        # Sender task of a subscribed client; while drain() waits for a slow client, new ids coalesce in the subscriber
+        try:
+            while not subscriber.closed:
+                await wakeup.wait()
+                wakeup.clear()
+                notification = subscriber.take_notification()
+                if notification is not None and not subscriber.closed:
+                    connection.send(notification)
+                    self.metrics.count('notifications_total', kind="resync" if "resync" in notification else "ids")
+                    await connection.writer.drain()
+        except ConnectionError as e:
+            log.warning("Failed to send updates to %s: %s", connection.writer.get_extra_info('peername'), e)
+
+    def subscriber_for(self, connection):
+        if connection.subscriber is None:
+            wakeup = asyncio.Event()
+            connection.subscriber = Subscriber(wakeup.set, self.store.sequence)
+            connection.sender = asyncio.create_task(self.push_notifications(connection, connection.subscriber, wakeup))
+        return connection.subscriber
+
+    async def handle_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        log.debug("Accepted connection from %s", address)
+        connection = AsyncConnection(writer, self.metrics)
+        self.connected_clients.add(writer)
+        self.metrics.count('connections_total')
+        try:
+            first = await reader.read(1)
+            if not first:
+                return
+            if is_framed(first):
+                check_hello_prefix(first + await reader.readexactly(len(HELLO_PREFIX) - 1))
+                codec = choose_codec(json_decode(await read_frame_async(reader) or b'{}'))
+                writer.write(server_hello(codec))
+                encode, decode = CODECS[codec]
+                connection.encode = lambda message: encode_frame(encode(message))
+                while (payload := await read_frame_async(reader)) is not None:
+                    self.metrics.count('bytes_received_total', FRAME_HEADER.size + len(payload))
+                    connection.send(respond(self, decode(payload), connection))
+                    await writer.drain()
+            else:
+                # Legacy clients: unframed JSON
+                buffer = first
+                while True:
+                    requests, buffer = split_json_messages(buffer)
+                    for request in requests:
+                        connection.send(respond(self, request, connection))
+                    await writer.drain()
+                    data = await reader.read(READ_SIZE)
+                    if not data:
+                        break
+                    self.metrics.count('bytes_received_total', len(data))
+                    buffer += data
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            log.warning("Connection from %s failed: %s", address, e)
+            self.metrics.count('connection_errors_total')
+        except Exception:
+            # Not the client's doing, but it only ends this connection
+            log.exception("Serving %s failed", address)
+            self.metrics.count('connection_errors_total')
+        finally:
+            if connection.subscriber is not None:
+                self.subscriptions.unsubscribe(connection.subscriber)
+                connection.subscriber.close()
+                connection.sender.cancel()
+            self.connected_clients.discard(writer)
+            writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve items and which of them changed, all clients on one '
+                                                 'asyncio event loop')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    configure_logging(args)
+    raise_open_file_limit()
+    server = AsyncServer(args.host, args.port, item_count=args.items, flush_interval=args.flush_interval,
+                         shards=args.shards, data_dir=args.data_dir, fsync_interval=args.fsync_interval,
+                         snapshot_every=args.snapshot_every, metrics_port=args.metrics_port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server.durable is not None:
+            server.durable.close()
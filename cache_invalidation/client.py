@@ -1,68 +1,463 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import queue
 import socket
 import json
 import time
 import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from delta import apply_delta
+from hash_ring import HashRing
+from metrics import Metrics, add_logging_arguments, configure_logging
+from protocol import (CODECS, FRAME_HEADER, check_message_size, client_handshake, encode_frame, read_frame,
+                      split_json_messages)
+
+log = logging.getLogger('cache_invalidation.client')
+
+# Large enough that a get_items response is not re-parsed for every small read
+READ_SIZE = 64 * 1024
+# Item ids per get_items request
+GET_ITEMS_BATCH = 1000
+# get_items requests sent before reading their responses; more could fill both socket buffers and deadlock
+MAX_PIPELINED = 16
+# Default bound of the content held by the client's cache
+CACHE_BYTES = 64 * 1024 * 1024
+
+
+def payload_size(item):
+    content = item["content"]
+    return len(content.encode()) if isinstance(content, str) else len(content)
+
+
+class ItemCache:
+    """
+    Item dicts by item_id, least recently used first, bounded by the total size of their content.
+    Entries older than ttl seconds are treated as missing. Counts hits, misses, evictions, expirations
+    and invalidations of cached items, to size the cache and see how many fetches it saves.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES, ttl=None, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # item_id -> (item, size, expiry time or None)
+        self.size = 0
+        self.lock = threading.Lock()  # the listener thread refreshes entries the application reads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, item_id):
+        return self.peek(item_id) is not None
+
+    def _live_entry(self, item_id):
+        entry = self.entries.get(item_id)
+        if entry is not None and entry[2] is not None and entry[2] <= self.clock():
+            self._remove(item_id)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _remove(self, item_id):
+        _, size, _ = self.entries.pop(item_id)
+        self.size -= size
+
+    def get(self, item_id):
+        # The cached item, counted as a hit or a miss and marked as recently used
+        with self.lock:
+            entry = self._live_entry(item_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(item_id)
+            return entry[0]
+
+    def peek(self, item_id):
+        # The cached item without counting or reordering, for keeping it up to date
+        with self.lock:
+            entry = self._live_entry(item_id)
+            return None if entry is None else entry[0]
+
+    def put(self, item):
+        size = payload_size(item)
+        with self.lock:
+            if item["item_id"] in self.entries:
+                self._remove(item["item_id"])
+            expires = None if self.ttl is None else self.clock() + self.ttl
+            self.entries[item["item_id"]] = (item, size, expires)
+            self.size += size
+            # Keep the new item even if it alone is over the bound
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                item_id = next(iter(self.entries))
+                if self._live_entry(item_id) is not None:  # an expired entry is removed by the check
+                    self._remove(item_id)
+                    self.evictions += 1
+
+    def discard(self, item_id):
+        with self.lock:
+            if item_id in self.entries:
+                self._remove(item_id)
+
+    def clear(self):
+        # Drop every item, counted as invalidations
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.size = 0
+
+    def mark_invalidated(self, item_id):
+        # Count an invalidation; True when the item is cached and so needs refreshing
+        with self.lock:
+            if self._live_entry(item_id) is None:
+                return False
+            self.invalidations += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0, "evictions": self.evictions,
+                    "expirations": self.expirations, "invalidations": self.invalidations}
+
 
 class Client:
-    def __init__(self, host, port):
+    """
+    A connection to the server that any number of threads, and asyncio code, can use at the same time.
+    One reader thread receives every message: a response completes the future of its request_id and a pushed
+    notification goes to on_notification. Requests are written whole under a lock, so hundreds of lookups
+    can be in flight on the one connection without stealing each other's responses.
+    """
+
+    def __init__(self, host, port, codecs=None, legacy=False, poll=True, inline_max=None, cache_bytes=CACHE_BYTES,
+                 ttl=None, on_notification=None, cache=None, metrics=None):
+        """
+        :param codecs: Codec names to offer the server, best first; all available ones by default.
+        :param legacy: Speak the old unframed JSON protocol, for servers that do not know framing.
+        :param poll: Ask for invalidations every 30 seconds; clients that subscribe get them pushed instead.
+        :param inline_max: Have polled invalidations carry deltas and the content of items up to this many
+            characters, only other items are fetched. None fetches every changed item.
+        :param cache_bytes: Bound of the content held in the cache, least recently used items are evicted.
+        :param ttl: Seconds after which a cached item is fetched again even without an invalidation.
+        :param on_notification: Called in the reader thread with every pushed notification, so it must not wait
+            for responses, and with None once the connection closed. By default notifications are queued for
+            listen_for_updates.
+        :param cache: ItemCache to use instead of a new one, cache_bytes and ttl are ignored then.
+        :param metrics: Metrics to count requests, their latency and bytes in, instead of new ones.
+        """
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((host, port))
-        self.items = {}
-        self.last_update_time = time.time()  # Initialize with current time
-        threading.Thread(target=self.ask_for_updates_periodically).start()
+        self.reader = self.client_socket.makefile('rb')
+        self.legacy = legacy
+        self.pending_messages = deque()  # legacy messages received but not yet returned
+        self.buffer = b''  # incomplete legacy message
+        self.send_lock = threading.Lock()  # one whole write at a time
+        self.waiting_lock = threading.Lock()
+        self.waiting = {}  # request_id -> (Future of its response, request type, time sent)
+        self.request_ids = itertools.count(1)
+        self.closed = False
+        self.notifications = queue.Queue()  # for listen_for_updates, None once the connection closed
+        self.on_notification = on_notification or self.notifications.put
+        if not legacy:
+            self.encode, self.decode = client_handshake(self.client_socket, self.reader, codecs)
+        self.inline_max = inline_max
+        self.items = ItemCache(cache_bytes, ttl) if cache is None else cache  # item dicts, with their versions
+        self.metrics = Metrics('cache_invalidation_client') if metrics is None else metrics
+        # Our cursor into the server's change log, polls ask for the changes after it. Unlike the time of the last
+        # change, it does not depend on our clock or miss changes made within one tick of the server's.
+        self.log_id = None
+        self.sequence = None
+        threading.Thread(target=self.read_messages, daemon=True).start()
+        # Start the cursor before reading any item, so that no later change of one is missed
+        self.ask_for_updates()
+        if poll:
+            threading.Thread(target=self.ask_for_updates_periodically).start()
+
+    def ask_for_updates(self, since_seq=None):
+        # since_seq defaults to our cursor. A response with "more" holds only the first changes, those after it
+        # are asked for until none are left
+        response = self.call(self.invalidated_request(since_seq))
+        while self.note_changes(response):
+            self.refresh(response["items"])
+            if not response.get("more"):
+                break
+            response = self.call(self.invalidated_request(response["sequence"]))
+
+    def invalidated_request(self, since_seq=None):
+        request = {"type": "get_invalidated", "since_seq": self.sequence if since_seq is None else since_seq,
+                   "log_id": self.log_id}
+        if self.inline_max is not None:
+            request["inline"] = self.inline_max
+        return request
+
+    def note_changes(self, response):
+        """
+        Move our cursor to the end of a get_invalidated response.
+        :return: True when the response carries the changes we missed, which refresh() then applies.
+        """
+        if response["type"] == "resync_required":
+            # The server cannot tell what we missed; what we cached and the versions we hold are from another
+            # history of the items
+            log.warning("%s, dropping %d cached items", response['message'], len(self.items))
+            self.items.clear()
+        elif response["type"] != "updated_items":
+            log.warning("Error: %s", response["message"])
+            return False
+        if response["log_id"] == self.log_id and self.sequence is not None:
+            self.sequence = max(self.sequence, response["sequence"])  # a concurrent poll may have got further
+        else:
+            self.log_id, self.sequence = response["log_id"], response["sequence"]
+        return response["type"] == "updated_items"
+
+    def refresh(self, updates):
+        """
+        Bring the cached items among updates up to date, fetching those the updates do not carry.
+        Items that are not cached are left alone, they are fetched when they are read.
+        """
+        self.ask_for_items(self.stale_items(updates))
+
+    def stale_items(self, updates):
+        # Apply the updates to the cached items; the ids of those still out of date, to be fetched
+        stale = []
+        for update in updates:
+            if self.items.mark_invalidated(update["item_id"]) and not self.apply_update(update):
+                log.debug("Item %s has been updated, fetching latest content", update['item_id'])
+                stale.append(update["item_id"])
+        return stale
+
+    def apply_update(self, update):
+        """
+        Bring our copy of an item up to date from an update carrying its content, a delta against a version,
+        or only its version.
+        :return: False when the update does not apply to the version we hold, the item needs fetching then.
+        """
+        item_id = update["item_id"]
+        held = self.items.peek(item_id)
+        if held is not None and update.get("version") is not None and held.get("version", 0) > update["version"]:
+            return True  # a concurrent refresh got a newer version already
+        if "content" in update:
+            content = update["content"]
+        elif held is None:
+            return False
+        elif "delta" in update:
+            if held.get("version") != update["base_version"]:
+                return False
+            content = apply_delta(held["content"], update["delta"])
+        elif held.get("version") == update.get("version"):
+            content = held["content"]
+        else:
+            return False
+        item = {"item_id": item_id, "content": content, "time_changed": update["time_changed"],
+                "version": update["version"]}
+        self.items.put(item)
+        log.debug("Updated item %s: %s", item_id, item)
+        return True
 
     def ask_for_updates_periodically(self):
         try:
             while True:
                 time.sleep(30)  # Ask for updates every 30 seconds
-                request = {"type": "get_invalidated", "since": self.last_update_time}
-                self.client_socket.send(json.dumps(request).encode())
-                data = self.client_socket.recv(1024)
-                response = json.loads(data)
-                if response["type"] == "updated_items":
-                    for item in response["items"]:
-                        item_id = item["item_id"]
-                        print(f"Item {item_id} has been updated, fetching latest content...")
-                        self.ask_for_item(item_id)
-                        if item["time_changed"] > self.last_update_time:
-                            self.last_update_time = item["time_changed"]
+                self.ask_for_updates()
         except Exception as e:
-            print(f"An error occurred: {e}")
+            log.error("Polling for updates failed: %s", e)
         finally:
             self.close_connection()
 
     def close_connection(self):
-        self.client_socket.close()
-        print("Connection closed")
+        # The reader thread notices, fails the requests still waiting and closes the socket
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def encode_message(self, message):
+        if self.legacy:
+            return check_message_size(json.dumps(message).encode())
+        return encode_frame(self.encode(message))
+
+    def send_requests(self, requests):
+        """
+        Send requests back to back in one write, without waiting for their responses.
+        :return: A concurrent.futures.Future of the response to each request, failing with ConnectionError
+            when the connection closes first.
+        """
+        requests = list(requests)
+        futures = [Future() for _ in requests]
+        with self.waiting_lock:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            request_ids = [next(self.request_ids) for _ in requests]
+            sent = time.perf_counter()
+            self.waiting.update((request_id, (future, request["type"], sent))
+                                for request_id, future, request in zip(request_ids, futures, requests))
+        data = b''.join(self.encode_message(dict(request, request_id=request_id))
+                        for request, request_id in zip(requests, request_ids))
+        with self.send_lock:
+            self.client_socket.sendall(data)
+        self.metrics.count('bytes_sent_total', len(data))
+        return futures
+
+    def call(self, request, timeout=None):
+        # One request and its response
+        future, = self.send_requests([request])
+        return future.result(timeout)
+
+    async def call_async(self, request):
+        # call() for asyncio code, the event loop keeps running while the response is on its way
+        future, = self.send_requests([request])
+        return await asyncio.wrap_future(future)
+
+    def read_messages(self):
+        # The reader thread, the only one receiving from the socket
+        error = ConnectionError("Server closed the connection")
+        try:
+            while (message := self.receive_message()) is not None:
+                request_id = message.get("request_id")
+                if request_id is None:
+                    self.metrics.count('notifications_total')
+                    self.on_notification(message)
+                    continue
+                with self.waiting_lock:
+                    waiting = self.waiting.pop(request_id, None)
+                if waiting is not None:
+                    future, request_type, sent = waiting
+                    self.metrics.count('requests_total', type=request_type)
+                    self.metrics.observe('request_seconds', time.perf_counter() - sent, type=request_type)
+                    future.set_result(message)
+        except (OSError, ValueError) as e:
+            error = ConnectionError(f"Connection failed: {e}")
+        finally:
+            with self.waiting_lock:
+                self.closed = True
+                waiting, self.waiting = self.waiting, {}
+            for future, _, _ in waiting.values():
+                future.set_exception(error)
+            self.on_notification(None)
+            self.reader.close()
+            self.client_socket.close()
+            log.info("Connection closed")
+            log.info("Cache: %s", self.items.stats())
+
+    def receive_message(self):
+        # The next message from the server, None once it closed the connection
+        if not self.legacy:
+            payload = read_frame(self.reader)
+            if payload is None:
+                return None
+            self.metrics.count('bytes_received_total', FRAME_HEADER.size + len(payload))
+            return self.decode(payload)
+        while not self.pending_messages:
+            data = self.reader.read1(READ_SIZE)
+            if not data:
+                return None
+            self.metrics.count('bytes_received_total', len(data))
+            messages, self.buffer = split_json_messages(self.buffer + data)
+            self.pending_messages.extend(messages)
+        return self.pending_messages.popleft()
+
+    def subscribe(self, item_ids=(), prefixes=()):
+        """
+        Have the server push invalidations of these items instead of waiting for the next poll.
+        listen_for_updates, or on_notification, receives them.
+        :param prefixes: Also every item whose str(item_id) starts with one of these.
+        """
+        response = self.call({"type": "subscribe", "item_ids": list(item_ids), "prefixes": list(prefixes)})
+        log.info("Subscribed to %d items and %d prefixes", response['item_count'], response['prefix_count'])
+
+    def stats(self):
+        # What this client measured: its metrics and those of its cache
+        return {"cache": self.items.stats(), **self.metrics.snapshot()}
+
+    def server_stats(self, prometheus=False):
+        # The server's metrics, as a dict or as Prometheus text
+        request = {"type": "stats", "format": "prometheus"} if prometheus else {"type": "stats"}
+        response = self.call(request)
+        return response["text"] if prometheus else {key: value for key, value in response.items()
+                                                     if key not in ("type", "request_id")}
+
+    def get(self, item_id):
+        """
+        Read through the cache: the cached item, or on a miss the item fetched from the server and cached.
+        :return: The item dict, None when the server does not have the item.
+        """
+        item = self.items.get(item_id)
+        if item is None:
+            self.ask_for_item(item_id)
+            item = self.items.peek(item_id)
+        return item
+
+    async def get_async(self, item_id):
+        # get() for asyncio code
+        item = self.items.get(item_id)
+        if item is None:
+            self.store_item(item_id, await self.call_async({"type": "get_item", "item_id": item_id}))
+            item = self.items.peek(item_id)
+        return item
 
     def ask_for_item(self, item_id):
         request = {"type": "get_item", "item_id": item_id}
-        self.client_socket.send(json.dumps(request).encode())
-        data = self.client_socket.recv(1024)
-        response = json.loads(data)
+        self.store_item(item_id, self.call(request))
+
+    def store_item(self, item_id, response):
         if response["type"] == "item":
-            self.items[item_id] = response["item"]
-            print(f"Updated item {item_id}: {response['item']}")
+            self.items.put(response["item"])
+            log.debug("Updated item %s: %s", item_id, response['item'])
         else:
-            print("Error:", response["message"])
+            log.warning("Error: %s", response["message"])
 
-    def listen_for_updates(self):
-        print("Listening for updates...")
-        try:
-            while True:
-                data = self.client_socket.recv(1024)
+    def ask_for_items(self, item_ids):
+        """
+        Fetch the latest content of items with get_items requests of GET_ITEMS_BATCH ids. Up to MAX_PIPELINED
+        requests are sent before reading the first response, so thousands of items cost a single round trip.
+        The versions we hold are sent along, so items we have come back as deltas when that is smaller.
+        """
+        requests = self.items_requests(item_ids)
+        for start in range(0, len(requests), MAX_PIPELINED):
+            for future in self.send_requests(requests[start:start + MAX_PIPELINED]):
+                self.apply_items_response(future.result())
+
+    def items_requests(self, item_ids):
+        item_ids = list(item_ids)
+        requests = []
+        for start in range(0, len(item_ids), GET_ITEMS_BATCH):
+            batch = item_ids[start:start + GET_ITEMS_BATCH]
+            versions = [(self.items.peek(item_id) or {}).get("version") for item_id in batch]
+            requests.append({"type": "get_items", "item_ids": batch, "versions": versions})
+        return requests
 
-                if not data:
-                    break
+    def apply_items_response(self, response):
+        if response["type"] != "items":
+            log.warning("Error: %s", response["message"])
+            return
+        for item in response["items"]:
+            if not self.apply_update(item):
+                log.warning("Update of item %s does not apply to our version", item['item_id'])
+        for item_id in response["missing"]:
+            self.items.discard(item_id)
+            log.warning("Item %s not found", item_id)
 
-                print("Got a periodic update from server...")
-                response = json.loads(data)
+    def listen_for_updates(self):
+        log.info("Listening for updates")
+        try:
+            while (response := self.notifications.get()) is not None:
+                log.debug("Got %s from the server", response["type"])
                 if response["type"] == "updated_ids":
-                    for item_id in response["item_ids"]:
-                        print(f"Item {item_id} has been updated, fetching latest content...")
-                        self.ask_for_item(item_id)
+                    if response.get("resync"):
+                        # The server dropped the ids because we fell behind, ask for everything changed since
+                        self.ask_for_updates(response["since_seq"])
+                    self.refresh({"item_id": item_id} for item_id in response["item_ids"])
         except Exception as e:
-            print(f"An error occurred: {e}")
+            log.error("Handling updates failed: %s", e)
             raise e
         finally:
             self.close_connection()
@@ -71,6 +466,200 @@ class Client:
         threading.Thread(target=self.listen_for_updates).start()
 
 
+def merge_responses(responses):
+    # One response from those of the shards a request was split across: their items, or the first error
+    if len(responses) == 1:
+        return responses[0]
+    for response in responses:
+        if response["type"] != "items":
+            return response
+    return {"type": "items", "items": [item for response in responses for item in response["items"]],
+            "missing": [item_id for response in responses for item_id in response["missing"]]}
+
+
+class ShardedClient:
+    """
+    Client of a sharded deployment: a Client per shard, routed by the same hash ring of item_ids the servers use,
+    all sharing one cache. A lookup goes to the shard owning the item, a multi-get is split by shard and sent to
+    every shard before waiting for any, and a poll asks every shard for its changes and merges them.
+    """
+
+    def __init__(self, addresses, codecs=None, legacy=False, poll=True, inline_max=None, cache_bytes=CACHE_BYTES,
+                 ttl=None, on_notification=None):
+        """
+        :param addresses: "host:port" of every shard, as the servers were given them with --shards.
+        The other parameters are those of Client.
+        """
+        self.ring = HashRing(addresses)
+        self.items = ItemCache(cache_bytes, ttl)
+        self.metrics = Metrics('cache_invalidation_client')
+        self.notifications = queue.Queue()  # of every shard, for listen_for_updates
+        self.shards = {}
+        for address in addresses:
+            host, port = address.rsplit(':', 1)
+            self.shards[address] = Client(host, int(port), codecs, legacy, poll=False, inline_max=inline_max,
+                                          on_notification=on_notification or self.notifications.put,
+                                          cache=self.items, metrics=self.metrics)
+        if poll:
+            threading.Thread(target=self.ask_for_updates_periodically).start()
+
+    # A Client's loops work unchanged on the merged updates and notifications of every shard
+    ask_for_updates_periodically = Client.ask_for_updates_periodically
+    listen_for_updates = Client.listen_for_updates
+    start = Client.start
+
+    def shard_for(self, item_id):
+        return self.shards[self.ring.shard_for(item_id)]
+
+    def routed_requests(self, request):
+        """
+        Where a request goes: a request with an item_id to the shard of the item, a get_items split by shard.
+        :return: List of (shard's Client, the part of the request for it).
+        """
+        if request.get("type") == "get_items":
+            versions = request.get("versions")
+            parts = {}
+            for index, item_id in enumerate(request["item_ids"]):
+                item_ids, part_versions = parts.setdefault(self.ring.shard_for(item_id), ([], []))
+                item_ids.append(item_id)
+                part_versions.append(None if versions is None else versions[index])
+            routed = []
+            for address, (item_ids, part_versions) in parts.items():
+                part = dict(request, item_ids=item_ids)
+                if versions is not None:
+                    part["versions"] = part_versions
+                routed.append((self.shards[address], part))
+            return routed
+        if "item_id" in request:
+            return [(self.shard_for(request["item_id"]), request)]
+        raise ValueError(f"A {request.get('type')} request has no item_id to pick a shard by; ask_for_updates, "
+                         f"subscribe and server_stats ask every shard")
+
+    def call(self, request, timeout=None):
+        # Client.call for the shards the request is routed to, with their responses merged
+        futures = [shard.send_requests([part])[0] for shard, part in self.routed_requests(request)]
+        return merge_responses([future.result(timeout) for future in futures])
+
+    async def call_async(self, request):
+        futures = [shard.send_requests([part])[0] for shard, part in self.routed_requests(request)]
+        return merge_responses(await asyncio.gather(*(asyncio.wrap_future(future) for future in futures)))
+
+    def ask_for_updates(self, since_seq=None):
+        # Every shard is asked for the changes after its own cursor, since_seq is ignored: the sequence numbers
+        # of the shards are unrelated, and a resync notification does not say which shard it came from
+        requests = {shard: shard.invalidated_request() for shard in self.shards.values()}
+        updates = []
+        while requests:
+            futures = [(shard, shard.send_requests([request])[0]) for shard, request in requests.items()]
+            requests = {}
+            for shard, future in futures:
+                response = future.result()
+                if shard.note_changes(response):
+                    updates.extend(response["items"])
+                    if response.get("more"):
+                        requests[shard] = shard.invalidated_request(response["sequence"])
+        updates.sort(key=lambda item: item["time_changed"])
+        self.refresh(updates)
+
+    def refresh(self, updates):
+        # Client.refresh, with the items still out of date fetched from all shards at once
+        stale = []
+        for update in updates:
+            stale.extend(self.shard_for(update["item_id"]).stale_items([update]))
+        self.ask_for_items(stale)
+
+    def get(self, item_id):
+        return self.shard_for(item_id).get(item_id)
+
+    async def get_async(self, item_id):
+        return await self.shard_for(item_id).get_async(item_id)
+
+    def ask_for_item(self, item_id):
+        self.shard_for(item_id).ask_for_item(item_id)
+
+    def ask_for_items(self, item_ids):
+        requests = [(self.shards[address], self.shards[address].items_requests(shard_item_ids))
+                    for address, shard_item_ids in self.ring.partition(item_ids).items()]
+        for start in range(0, max((len(shard_requests) for _, shard_requests in requests), default=0), MAX_PIPELINED):
+            futures = [(shard, future) for shard, shard_requests in requests
+                       for future in shard.send_requests(shard_requests[start:start + MAX_PIPELINED])]
+            for shard, future in futures:
+                shard.apply_items_response(future.result())
+
+    def subscribe(self, item_ids=(), prefixes=()):
+        # Item ids are subscribed at their shards, prefixes at every shard
+        parts = self.ring.partition(item_ids)
+        futures = [shard.send_requests([{"type": "subscribe", "item_ids": parts.get(address, []),
+                                         "prefixes": list(prefixes)}])[0]
+                   for address, shard in self.shards.items() if parts.get(address) or prefixes]
+        item_count = sum(future.result()["item_count"] for future in futures)
+        log.info("Subscribed to %d items and %d prefixes on %d shards", item_count, len(prefixes), len(futures))
+
+    def stats(self):
+        # What the client measured over all shards, and its cache
+        return {"cache": self.items.stats(), **self.metrics.snapshot()}
+
+    def server_stats(self, prometheus=False):
+        # The metrics of every shard by its address
+        return {address: shard.server_stats(prometheus) for address, shard in self.shards.items()}
+
+    def close_connection(self):
+        for shard in self.shards.values():
+            shard.close_connection()
+
+
 if __name__ == "__main__":
-    client = Client("localhost", 12345)
-    client.start()
+    parser = argparse.ArgumentParser(description='Keep items in sync with a cache invalidation server')
+    parser.add_argument('--host', default='localhost', help='Server address')
+    parser.add_argument('--port', type=int, default=12345, help='Server port')
+    parser.add_argument('--shards', type=lambda value: value.split(','), default=None,
+                        help='Comma separated host:port of every shard of a sharded deployment, instead of '
+                             '--host and --port')
+    parser.add_argument('--codec', choices=CODECS, default=None,
+                        help='Only offer this codec to the server instead of every available one')
+    parser.add_argument('--legacy', action='store_true', help='Use the old unframed JSON protocol')
+    parser.add_argument('--subscribe', type=int, nargs='*', default=None, metavar='ITEM_ID',
+                        help='Have invalidations of these items pushed instead of polling for them')
+    parser.add_argument('--subscribe_prefix', nargs='*', default=None, metavar='PREFIX',
+                        help='Have invalidations of items whose id starts with these prefixes pushed, '
+                             'an empty string subscribes to all items')
+    parser.add_argument('--inline_max', type=int, default=None,
+                        help='Have polled invalidations carry deltas and the content of items up to this many '
+                             'characters instead of fetching every changed item')
+    parser.add_argument('--get', type=int, nargs='*', default=[], metavar='ITEM_ID',
+                        help='Items to read into the cache at the start, only cached items are kept up to date')
+    parser.add_argument('--cache_mb', type=float, default=CACHE_BYTES / 2 ** 20,
+                        help='Bound of the content held in the cache in MiB')
+    parser.add_argument('--ttl', type=float, default=None,
+                        help='Seconds after which a cached item is fetched again even without an invalidation')
+    parser.add_argument('--server_stats', choices=['json', 'prometheus'], default=None,
+                        help='Print the metrics of the server, or of every shard, and exit')
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+
+    configure_logging(args)
+
+    push = args.subscribe is not None or args.subscribe_prefix is not None
+    poll = not push and args.server_stats is None
+    if args.shards:
+        client = ShardedClient(args.shards, [args.codec] if args.codec else None, args.legacy, poll=poll,
+                               inline_max=args.inline_max, cache_bytes=int(args.cache_mb * 2 ** 20), ttl=args.ttl)
+    else:
+        client = Client(args.host, args.port, [args.codec] if args.codec else None, args.legacy, poll=poll,
+                        inline_max=args.inline_max, cache_bytes=int(args.cache_mb * 2 ** 20), ttl=args.ttl)
+    if args.server_stats:
+        stats = client.server_stats(prometheus=args.server_stats == 'prometheus')
+        if args.server_stats == 'json':
+            print(json.dumps(stats, indent=2))
+        elif args.shards:
+            for address, text in stats.items():
+                print(f"# Shard {address}\n{text}")
+        else:
+            print(stats, end='')
+        client.close_connection()
+    else:
+        for item_id in args.get:
+            client.get(item_id)
+        if push:
+            client.subscribe(args.subscribe or (), args.subscribe_prefix or ())
+        client.start()
@@ -0,0 +1,108 @@
+import argparse
+import random
+import sys
+import threading
+import time
+
+from server import item_update
+from store import ItemStore
+
+
+def content_of_version(item_id, version):
+    # Writers put this content, so a reader can tell an item whose fields come from different versions
+    return f"{item_id} v{version}"
+
+
+def write(store, item_ids, stop, counts):
+    # Each writer owns its item_ids, so it knows the version every put creates
+    versions = dict.fromkeys(item_ids, 1)
+    rng = random.Random()
+    writes = 0
+    while not stop.is_set():
+        item_id = rng.choice(item_ids)
+        versions[item_id] += 1
+        store.put(item_id, content_of_version(item_id, versions[item_id]))
+        writes += 1
+    counts.append(('writes', writes))
+
+
+def read(store, item_count, stop, counts, global_lock):
+    """
+    What the server's handler threads do: mostly get_item, some get_items with the version held and some polls.
+    :param global_lock: Read items under the store's lock, the way a single lock would make them consistent.
+    """
+    rng = random.Random()
+    reads = torn = 0
+    cursor = store.sequence
+    while not stop.is_set():
+        item_id = rng.randrange(item_count)
+        choice = rng.random()
+        if choice < 0.8:
+            if global_lock:
+                with store.lock:
+                    item = store.get(item_id).to_dict()
+            else:
+                item = store.get(item_id).to_dict()
+            if item["content"] != content_of_version(item_id, item["version"]):
+                torn += 1
+        elif choice < 0.9:
+            item = store.get(item_id)
+            item_update(store, item, max(1, item.version - 1))
+        else:
+            sequence = store.sequence
+            store.changed_after(cursor)
+            cursor = sequence
+        reads += 1
+    counts.append(('reads', reads))
+    counts.append(('torn', torn))
+
+
+def run(threads, seconds, item_count, global_lock=False):
+    """
+    Run `threads` writer and `threads` reader threads on one store for `seconds`.
+    :return: dict with writes/s, reads/s and the number of reads that saw an item half changed.
+    """
+    if threads > item_count:
+        # Every writer owns some items, so that it knows their versions
+        raise ValueError(f"{threads} writer threads need at least as many items, not {item_count}")
+    store = ItemStore((item_id, content_of_version(item_id, 1)) for item_id in range(item_count))
+    stop = threading.Event()
+    counts = []
+    workers = [threading.Thread(target=write, args=(store, list(range(index, item_count, threads)), stop, counts))
+               for index in range(threads)]
+    workers += [threading.Thread(target=read, args=(store, item_count, stop, counts, global_lock))
+                for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    totals = {'writes': 0, 'reads': 0, 'torn': 0}
+    for name, count in counts:
+        totals[name] += count
+    return {'threads': threads, 'writes_per_second': totals['writes'] / seconds,
+            'reads_per_second': totals['reads'] / seconds, 'torn_reads': totals['torn']}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure ItemStore throughput with concurrent writer and reader '
+                                                 'threads, as the threaded server runs them')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64],
+                        help='Numbers of writer threads to run, with as many reader threads')
+    parser.add_argument('--seconds', type=float, default=2.0, help='Duration of each run')
+    parser.add_argument('--items', type=int, default=10000, help='Number of items in the store')
+    parser.add_argument('--global_lock', action='store_true',
+                        help='Have readers take the store lock, for comparison with the lock-free reads')
+    args = parser.parse_args()
+    if max(args.threads) > args.items:
+        parser.error(f"--items must be at least the largest number of --threads, {max(args.threads)}")
+
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print(f"Python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}, {args.items} items, "
+          f"{'reads under the store lock' if args.global_lock else 'lock-free reads'}")
+    print(f"{'threads':>8} {'writes/s':>12} {'reads/s':>12} {'torn reads':>11}")
+    for thread_count in args.threads:
+        result = run(thread_count, args.seconds, args.items, args.global_lock)
+        print(f"{result['threads']:>8} {result['writes_per_second']:>12,.0f} {result['reads_per_second']:>12,.0f} "
+              f"{result['torn_reads']:>11}")
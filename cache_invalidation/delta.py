@@ -0,0 +1,49 @@
+# Deltas between two versions of an item's content.
+#
+# A delta is [prefix, suffix, middle]: keep the first prefix and the last suffix characters of the old content
+# and put middle between them. That covers the usual edits, appending, truncating or changing one region,
+# in a few bytes more than the changed part, and is computed with slice comparisons instead of a diff search.
+
+# Bytes a delta costs beside its middle, when deciding whether it is worth sending
+DELTA_OVERHEAD = 16
+
+
+def _common_prefix_length(a, b, limit):
+    # Binary search over slice comparisons, which run in C
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _common_suffix_length(a, b, limit):
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:] == b[len(b) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def make_delta(old, new):
+    prefix = _common_prefix_length(old, new, min(len(old), len(new)))
+    # The suffix must not overlap the prefix in either string
+    suffix = _common_suffix_length(old, new, min(len(old), len(new)) - prefix)
+    return [prefix, suffix, new[prefix:len(new) - suffix]]
+
+
+def apply_delta(old, delta):
+    prefix, suffix, middle = delta
+    if prefix + suffix > len(old):
+        raise ValueError("Delta does not fit the content")
+    return old[:prefix] + middle + old[len(old) - suffix:]
+
+
+def delta_size(delta):
+    return len(delta[2]) + DELTA_OVERHEAD
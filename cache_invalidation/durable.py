@@ -0,0 +1,215 @@
+# An ItemStore kept on disk, so that a restarted server has the same items, sequence numbers and times, and
+# clients can carry on from the change they saw last.
+#
+# The directory holds snapshots of every item, snapshot-<sequence>.bin, and the changes after them in log
+# segments, changes-<first sequence>.log. Both are sequences of records: a RECORD header (payload length,
+# CRC-32 of everything after it, sequence, time_changed, version) and the JSON payload [item_id, content].
+# A snapshot starts with SNAPSHOT_MAGIC and the store's log_id, sequence and last time. A torn record at the end of
+# the log, from a crash in the middle of a write, fails its CRC and is cut off at recovery.
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+RECORD = struct.Struct('>IIQdQ')
+SNAPSHOT_MAGIC = b'CINVSNAP1'
+SNAPSHOT_HEADER = struct.Struct('>16sQd')
+# Changes are written and fsynced together every this many seconds, the most a crash can lose
+FSYNC_INTERVAL = 0.05
+# A snapshot is taken after this many changes, which bounds the log replayed at a restart
+SNAPSHOT_EVERY = 100000
+
+
+def encode_record(sequence, time_changed, version, item_id, content):
+    payload = json.dumps([item_id, content], separators=(',', ':')).encode()
+    body = RECORD.pack(len(payload), 0, sequence, time_changed, version)[8:] + payload
+    return struct.pack('>II', len(payload), zlib.crc32(body)) + body
+
+
+def decode_records(data, offset=0):
+    """
+    Decode the records in data from offset on.
+    :return: (list of (sequence, time_changed, version, item_id, content), offset after the last intact record)
+    """
+    records = []
+    while offset + RECORD.size <= len(data):
+        length, crc, sequence, time_changed, version = RECORD.unpack_from(data, offset)
+        end = offset + RECORD.size + length
+        if end > len(data) or zlib.crc32(data[offset + 8:end]) != crc:
+            break
+        item_id, content = json.loads(data[offset + RECORD.size:end])
+        records.append((sequence, time_changed, version, item_id, content))
+        offset = end
+    return records, offset
+
+
+def _sequence_of(name):
+    return int(name.split('-', 1)[1].split('.', 1)[0])
+
+
+def _fsync_directory(directory):
+    # Makes renames and new files in the directory durable; not possible on Windows
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class DurableStore:
+    """
+    Writes every change of an ItemStore to an append-only log and restores the store from the latest snapshot
+    and the log after it. Changes are queued by the store listener and written and fsynced in batches by one
+    writer thread, so a change costs the store an encode and an append, not a disk flush. The same thread
+    takes a snapshot every snapshot_every changes and then drops the log segments it covers, so a restart
+    replays at most that many changes.
+    """
+
+    def __init__(self, store, directory, fsync_interval=FSYNC_INTERVAL, snapshot_every=SNAPSHOT_EVERY):
+        self.store = store
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()  # pending and changes_since_snapshot, filled by the store listener
+        self.pending = []
+        self.changes_since_snapshot = 0
+        self.snapshot_sequence = None  # of the latest snapshot
+        self.segment = None
+        self.closed = threading.Event()
+        self.writer = None
+        os.makedirs(directory, exist_ok=True)
+
+    def files(self, prefix):
+        # Names of the snapshot or log files, oldest first
+        return sorted((name for name in os.listdir(self.directory) if name.startswith(prefix + '-')),
+                      key=_sequence_of)
+
+    def recover(self):
+        """
+        Load the latest intact snapshot into the store and replay the changes logged after it.
+        :return: dict with the number of items loaded from the snapshot, changes replayed and seconds taken.
+        """
+        start = time.perf_counter()
+        snapshot_items = 0
+        for name in reversed(self.files('snapshot')):
+            state = self.read_snapshot(os.path.join(self.directory, name))
+            if state is not None:
+                log_id, sequence, last_time, records = state
+                self.store.restore(log_id, sequence, last_time, records)
+                self.snapshot_sequence = sequence
+                snapshot_items = len(records)
+                break
+
+        replayed = 0
+        for name in self.files('changes'):
+            path = os.path.join(self.directory, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            records, end = decode_records(data)
+            for record in records:
+                if record[0] > self.store.sequence:
+                    self.store.replay(*record)
+                    replayed += 1
+            if end < len(data):
+                # A write cut short by a crash, nothing after it was acknowledged as durable
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+        self.changes_since_snapshot = replayed
+        return {'snapshot_items': snapshot_items, 'replayed': replayed, 'seconds': time.perf_counter() - start}
+
+    def read_snapshot(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(SNAPSHOT_MAGIC):
+            return None
+        log_id, sequence, last_time = SNAPSHOT_HEADER.unpack_from(data, len(SNAPSHOT_MAGIC))
+        records, end = decode_records(data, len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size)
+        if end != len(data):
+            return None  # incomplete, an older snapshot and more of the log are used instead
+        return log_id.hex(), sequence, last_time, records
+
+    def start(self):
+        # Log every change of the store from now on. Without a snapshot to start from, the items present are
+        # written to one, as is the log_id that clients' cursors refer to.
+        if self.snapshot_sequence is None:
+            self.snapshot()
+        else:
+            self.segment = self.open_segment(self.store.sequence + 1)
+        self.store.listeners.append(self.record_change)
+        self.writer = threading.Thread(target=self.write_periodically, daemon=True)
+        self.writer.start()
+
+    def open_segment(self, first_sequence):
+        segment = open(os.path.join(self.directory, f'changes-{first_sequence:020d}.log'), 'ab')
+        _fsync_directory(self.directory)
+        return segment
+
+    def record_change(self, item):
+        # ItemStore listener, runs under the store's lock
+        record = encode_record(item.sequence, item.time_changed, item.version, item.item_id, item.content)
+        with self.lock:
+            self.pending.append(record)
+            self.changes_since_snapshot += 1
+
+    def write_periodically(self):
+        # The writer thread, the only one writing files after start()
+        while not self.closed.wait(self.fsync_interval):
+            self.flush()
+            if self.changes_since_snapshot >= self.snapshot_every:
+                self.snapshot()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            self.segment.write(b''.join(pending))
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+
+    def snapshot(self):
+        """
+        Write every item to a new snapshot and start a new log segment after it, then drop the older snapshots
+        and the segments the new one covers. Only the copy of the items holds the store's lock.
+        """
+        with self.store.lock:
+            log_id, sequence, last_time, records = self.store.state()
+            with self.lock:
+                pending, self.pending = self.pending, []
+                self.changes_since_snapshot = 0
+        # Everything logged so far is at or before sequence, it goes to the old segment
+        if self.segment is not None:
+            self.segment.write(b''.join(pending))
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            self.segment.close()
+        self.segment = self.open_segment(sequence + 1)
+
+        path = os.path.join(self.directory, f'snapshot-{sequence:020d}.bin')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(bytes.fromhex(log_id), sequence, last_time))
+            f.write(b''.join(encode_record(*record) for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        _fsync_directory(self.directory)
+        self.snapshot_sequence = sequence
+
+        for name in self.files('snapshot'):
+            if _sequence_of(name) < sequence:
+                os.remove(os.path.join(self.directory, name))
+        for name in self.files('changes'):
+            if _sequence_of(name) <= sequence:
+                os.remove(os.path.join(self.directory, name))
+
+    def close(self):
+        # Stop the writer and leave a snapshot behind, so that the next start has no log to replay
+        self.closed.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.flush()
+        if self.changes_since_snapshot:
+            self.snapshot()
+        self.segment.close()
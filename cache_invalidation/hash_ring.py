@@ -0,0 +1,61 @@
+import hashlib
+from bisect import bisect
+
+# Points of every shard on the ring; more even out the ranges at the cost of a larger ring
+VIRTUAL_NODES = 160
+
+
+def ring_hash(key):
+    # Stable across processes and runs, unlike hash() of str
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of item_ids onto shards named "host:port".
+    Every shard owns VIRTUAL_NODES points on a ring of 64-bit hashes, and an item belongs to the shard of the first
+    point at or after its hash. Adding or removing a shard only moves the items between its points and their
+    neighbours, about 1/N of all items, instead of rehashing everything.
+    """
+
+    def __init__(self, shards=(), virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self.points = []  # sorted hashes
+        self.owners = []  # shard of every point
+        self.shards = []
+        for shard in shards:
+            self.add(shard)
+
+    def add(self, shard):
+        if shard in self.shards:
+            return
+        self.shards.append(shard)
+        ring = sorted(list(zip(self.points, self.owners)) +
+                      [(ring_hash(f"{shard}#{index}"), shard) for index in range(self.virtual_nodes)])
+        self.points = [point for point, _ in ring]
+        self.owners = [owner for _, owner in ring]
+
+    def remove(self, shard):
+        self.shards.remove(shard)
+        ring = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != shard]
+        self.points = [point for point, _ in ring]
+        self.owners = [owner for _, owner in ring]
+
+    def shard_for(self, item_id):
+        if not self.points:
+            raise LookupError("No shards")
+        return self.owners[bisect(self.points, ring_hash(item_id)) % len(self.points)]
+
+    def partition(self, item_ids):
+        # shard -> the item_ids it owns, in their original order
+        parts = {}
+        for item_id in item_ids:
+            parts.setdefault(self.shard_for(item_id), []).append(item_id)
+        return parts
+
+
+def moved_fraction(before, after, item_ids):
+    # Share of the items that a change from ring `before` to ring `after` gives to another shard
+    item_ids = list(item_ids)
+    moved = sum(before.shard_for(item_id) != after.shard_for(item_id) for item_id in item_ids)
+    return moved / len(item_ids) if item_ids else 0.0
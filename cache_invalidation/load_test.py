@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from protocol import CODECS, client_handshake_async, encode_frame, read_frame_async, split_json_messages
+from server import raise_open_file_limit
+
+READ_SIZE = 64 * 1024
+# Script of every server mode, started with --server
+SERVERS = {'threaded': 'server.py', 'asyncio': 'async_server.py'}
+
+
+async def open_connections(host, port, count, batch_size):
+    # Connect in batches so that the server's accept backlog is not flooded all at once
+    connections = []
+    failures = 0
+    for start in range(0, count, batch_size):
+        results = await asyncio.gather(*(asyncio.open_connection(host, port)
+                                         for _ in range(min(batch_size, count - start))), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                failures += 1
+            else:
+                connections.append(result)
+    return connections, failures
+
+
+async def round_trip(reader, writer, request, codec):
+    # Only one request is in flight per connection, so the first complete message is its response
+    if codec is not None:
+        encode, decode = codec
+        writer.write(encode_frame(encode(request)))
+        await writer.drain()
+        payload = await read_frame_async(reader)
+        if payload is None:
+            raise ConnectionError("Server closed the connection")
+        return decode(payload)
+
+    writer.write(json.dumps(request).encode())
+    await writer.drain()
+    buffer = b''
+    while True:
+        data = await reader.read(READ_SIZE)
+        if not data:
+            raise ConnectionError("Server closed the connection")
+        responses, buffer = split_json_messages(buffer + data)
+        if responses:
+            return responses[0]
+
+
+async def run_client(reader, writer, requests, interval, latencies, rng, protocol, item_count):
+    # Behave like client.Client: poll for invalidations since the last change seen and fetch single items
+    codec = None if protocol == 'legacy' else await client_handshake_async(reader, writer, [protocol])
+    cursor = {"since_seq": None, "log_id": None}  # Like client.Client, only changes from the first poll on
+    for _ in range(requests):
+        if rng.random() < 0.5:
+            request = {"type": "get_invalidated", **cursor}
+        else:
+            request = {"type": "get_item", "item_id": rng.randrange(item_count)}
+        start = time.perf_counter()
+        response = await round_trip(reader, writer, request, codec)
+        latencies.append(time.perf_counter() - start)
+        if response["type"] in ("updated_items", "resync_required"):
+            cursor = {"since_seq": response["sequence"], "log_id": response["log_id"]}
+        if interval:
+            await asyncio.sleep(rng.uniform(0, 2 * interval))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def load_test(host, port, connections, requests, interval=0.0, connect_batch=500, seed=0, server_pid=None,
+                    protocol='json', item_count=5):
+    """
+    Open many connections to a server, then let all of them send requests concurrently.
+    :param requests: Round trips per connection, each waits for the previous response.
+    :param interval: Mean pause in seconds between the requests of one connection, 0 sends them back to back.
+    :param server_pid: Process of the server, to report its memory and threads while all connections are open.
+    :param protocol: 'legacy' for unframed JSON, or the codec of framed messages ('json', 'msgpack').
+    :param item_count: Number of items on the server, get_item asks for random ones.
+    :return: dict with connection and error counts, the elapsed seconds, requests/s and latency percentiles.
+    """
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    opened, failed_connections = await open_connections(host, port, connections, connect_batch)
+    connect_seconds = time.perf_counter() - start
+
+    latencies = []
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run_client(reader, writer, requests, interval, latencies,
+                                                random.Random(rng.random()), protocol, item_count)
+                                     for reader, writer in opened), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    server = process_status(server_pid) if server_pid else None
+    for _, writer in opened:
+        writer.close()
+
+    latencies.sort()
+    return {
+        'connections': len(opened),
+        'failed_connections': failed_connections,
+        'failed_clients': sum(isinstance(result, Exception) for result in results),
+        'connect_seconds': connect_seconds,
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': {name: percentile(latencies, q) * 1000
+                       for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+        'server': server,
+    }
+
+
+def start_server(mode, host, port, item_count=5, extra_args=()):
+    # Run a server in its own process and wait until it accepts connections
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SERVERS[mode])
+    process = subprocess.Popen([sys.executable, script, '--host', host, '--port', str(port), '--quiet',
+                                '--items', str(item_count), *extra_args], stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError(f"The {mode} server did not start")
+            time.sleep(0.1)
+
+
+def process_status(pid):
+    # Peak resident memory and thread count from /proc, only available on Linux
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+    except OSError:
+        return None
+    return {'peak_rss_mb': int(fields['VmHWM'].split()[0]) / 1024, 'threads': int(fields['Threads'])}
+
+
+def format_report(result):
+    latency = ', '.join(f"{name} {value:.1f} ms" for name, value in result['latency_ms'].items())
+    report = (f"{result['connections']} connections ({result['failed_connections']} failed) in "
+              f"{result['connect_seconds']:.1f} s, {result['requests']} requests in {result['seconds']:.1f} s: "
+              f"{result['requests_per_second']:,.0f} requests/s, latency {latency}")
+    if result['failed_clients']:
+        report += f", {result['failed_clients']} connections failed while sending requests"
+    if result.get('server'):
+        report += (f"\nServer peak RSS {result['server']['peak_rss_mb']:.0f} MB, "
+                   f"{result['server']['threads']} threads")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test a cache invalidation server with many connections')
+    parser.add_argument('--host', default='localhost', help='Server address')
+    parser.add_argument('--port', type=int, default=12345, help='Server port')
+    parser.add_argument('--server', choices=SERVERS, default=None,
+                        help='Start this server mode for the test instead of using a running server')
+    parser.add_argument('--connections', type=int, default=10000, help='Number of concurrent connections')
+    parser.add_argument('--requests', type=int, default=10, help='Requests sent by every connection')
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help='Mean pause between the requests of one connection in seconds')
+    parser.add_argument('--connect_batch', type=int, default=500, help='Connections opened at the same time')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the request mix')
+    parser.add_argument('--items', type=int, default=5,
+                        help='Number of items on the server, also passed to the server started with --server')
+    parser.add_argument('--protocol', choices=['legacy', *CODECS], default='json',
+                        help='Unframed JSON as old clients send it, or framed messages with this codec')
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    server_process = start_server(args.server, args.host, args.port, args.items) if args.server else None
+    try:
+        result = asyncio.run(load_test(args.host, args.port, args.connections, args.requests, args.interval,
+                                       args.connect_batch, args.seed, server_process and server_process.pid,
+                                       args.protocol, args.items))
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+    print(format_report(result))
@@ -0,0 +1,180 @@
+# Counters, gauges and latency histograms of a server or client, read as a dict (the stats request) or as
+# Prometheus text (GET /metrics on the server's --metrics_port), and the logging options of the scripts.
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger('cache_invalidation.metrics')
+
+# Histogram buckets are 1/2**(SUB_BUCKET_BITS - 1) of the values they hold wide, so percentiles are within 1.6% of
+# the true value, close to an HdrHistogram with 2 significant digits
+SUB_BUCKET_BITS = 7
+# Percentiles reported for every histogram
+PERCENTILES = (0.5, 0.9, 0.99, 0.999)
+# Histograms whose name ends with _seconds count microseconds
+SECONDS_SCALE = 1000000
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+def add_logging_arguments(parser):
+    parser.add_argument('--log_level', choices=LOG_LEVELS, default='INFO',
+                        help='Least severe messages to log; DEBUG logs every connection and request')
+    parser.add_argument('--quiet', action='store_true', help='Only log warnings and errors')
+
+
+def configure_logging(args):
+    logging.basicConfig(level='WARNING' if args.quiet else args.log_level, format=LOG_FORMAT)
+
+
+class Histogram:
+    """
+    Counts of values in log-linear buckets. Recording is O(1) and memory stays at a few hundred counts over any
+    range of values, so every request can be recorded.
+    :param scale: Values are multiplied by this and rounded to an integer; 1e6 keeps seconds to the microsecond.
+    """
+
+    def __init__(self, scale=1):
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.buckets = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        value = max(0, round(value * self.scale))
+        # The bucket is the number of low bits dropped and the SUB_BUCKET_BITS top bits left
+        shift = max(0, value.bit_length() - SUB_BUCKET_BITS)
+        index = (shift << SUB_BUCKET_BITS) + (value >> shift)
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def percentile(self, q):
+        # The highest value of the bucket holding the q-th quantile, not above the largest value recorded
+        with self.lock:
+            rank = q * self.count
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen >= rank:
+                    shift, top_bits = index >> SUB_BUCKET_BITS, index & ((1 << SUB_BUCKET_BITS) - 1)
+                    return min(((top_bits + 1) << shift) - 1, self.max) / self.scale
+            return 0.0
+
+    def summary(self):
+        summary = {"count": self.count, "sum": self.total / self.scale, "max": self.max / self.scale}
+        summary.update((f"p{q * 100:g}", self.percentile(q)) for q in PERCENTILES)
+        return summary
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_name(name, labels, extra=()):
+    labels = [*labels, *extra]
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}'
+
+
+class Metrics:
+    """
+    Named metrics, each with optional labels, such as requests_total{type="get_item"}.
+    Collectors are called with the Metrics before it is read, to set gauges that are cheaper to read than to track.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix  # of the Prometheus names
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def count(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(
+                    key, Histogram(SECONDS_SCALE if name.endswith('_seconds') else 1))
+        histogram.record(value)
+
+    def collect(self):
+        for collector in self.collectors:
+            collector(self)
+        with self.lock:
+            return dict(self.counters), dict(self.gauges), dict(self.histograms)
+
+    def snapshot(self):
+        # Every metric by its name with labels, histograms as their count, sum, max and percentiles
+        counters, gauges, histograms = self.collect()
+        return {
+            "counters": {_format_name(name, labels): value for (name, labels), value in sorted(counters.items())},
+            "gauges": {_format_name(name, labels): value for (name, labels), value in sorted(gauges.items())},
+            "histograms": {_format_name(name, labels): histogram.summary()
+                           for (name, labels), histogram in sorted(histograms.items())},
+        }
+
+    def prometheus(self):
+        # The Prometheus text exposition format; histograms are summaries, their buckets are not Prometheus's
+        counters, gauges, histograms = self.collect()
+        lines = []
+        for kind, metrics in (('counter', counters), ('gauge', gauges)):
+            for name in sorted({name for name, _ in metrics}):
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+                lines.extend(f"{_format_name(f'{self.prefix}_{name}', labels)} {value}"
+                             for (metric, labels), value in sorted(metrics.items()) if metric == name)
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {self.prefix}_{name} summary")
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                full_name = f'{self.prefix}_{name}'
+                lines.extend(f"{_format_name(full_name, labels, [('quantile', q)])} {histogram.percentile(q)}"
+                             for q in PERCENTILES)
+                lines.append(f"{_format_name(full_name + '_sum', labels)} {histogram.total / histogram.scale}")
+                lines.append(f"{_format_name(full_name + '_count', labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(metrics, host, port):
+    """
+    Serve metrics.prometheus() at http://host:port/metrics from a daemon thread.
+    :return: The HTTP server, shutdown() stops it.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug("%s %s", self.address_string(), format % args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Metrics at http://%s:%d/metrics", host, port)
+    return server
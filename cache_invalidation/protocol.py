@@ -0,0 +1,196 @@
+# Wire protocol between the cache invalidation server and its clients.
+#
+# A framed connection starts with the client sending HELLO_PREFIX (MAGIC and the protocol version) and a JSON
+# hello frame listing the codecs it can use, best first. The server answers with a JSON hello frame naming the
+# codec it picked, and from then on every message in both directions is one frame: a 4-byte big-endian length
+# and the message encoded with that codec. msgpack is used when both sides have it installed, JSON otherwise.
+#
+# Clients that start with '{' instead of MAGIC speak the legacy protocol: unframed JSON messages back to back.
+#
+# After a subscribe request the server also pushes updated_ids notifications, which may arrive before the
+# response to any later request. A request may carry a request_id, which the server copies into its response,
+# so that clients can pipeline requests and match the responses; pushed notifications carry none.
+#
+# updated_items responses carry the server's change sequence number and the log_id of the history it counts. A
+# client that sends both back as since_seq and log_id gets exactly the changes it has not seen, also after a restart
+# of a server that keeps its items in a --data_dir; since_seq null gets just the current cursor. A cursor into
+# another history gets resync_required, after which the client has to drop everything it cached.
+#
+# No message may be larger than MAX_MESSAGE_SIZE, receivers reject it. Senders check it with check_message_size, and
+# an updated_items response that would be too large holds only the first changes, with "more": true and the sequence
+# of the last of them; the client asks again from there for the rest.
+import asyncio
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, JSON frames work everywhere
+    msgpack = None
+
+MAGIC = b'CINV'
+PROTOCOL_VERSION = 1
+HELLO_PREFIX = MAGIC + bytes([PROTOCOL_VERSION])
+FRAME_HEADER = struct.Struct('>I')
+# A peer that sends this much without completing a single message is sending garbage
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+
+class MessageTooLarge(ValueError):
+    pass
+
+_decoder = json.JSONDecoder()
+
+
+def json_encode(message):
+    return json.dumps(message, separators=(',', ':')).encode()
+
+
+def json_decode(payload):
+    return json.loads(payload)
+
+
+# Name -> (encode, decode) of every codec available here, best first
+CODECS = {}
+if msgpack is not None:
+    CODECS['msgpack'] = (msgpack.packb, msgpack.unpackb)
+CODECS['json'] = (json_encode, json_decode)
+
+
+def split_json_messages(buffer):
+    """
+    Decode the complete JSON messages at the start of a buffer of unframed messages sent back to back.
+    TCP may split a message across reads or join several into one, so the incomplete rest is handed back
+    to be prepended to the next read.
+    :param buffer: Bytes received so far.
+    :return: (list of decoded messages, bytes left over)
+    """
+    try:
+        text = buffer.decode()
+        tail = b''
+    except UnicodeDecodeError as e:
+        if e.reason != 'unexpected end of data':
+            raise
+        # A multi-byte character cut off by the read, it completes with the next one
+        text, tail = buffer[:e.start].decode(), buffer[e.start:]
+
+    messages = []
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position == len(text):
+            break
+        try:
+            message, position = _decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            break
+        messages.append(message)
+
+    rest = text[position:].encode() + tail
+    if len(rest) > MAX_MESSAGE_SIZE:
+        raise ValueError(f"No complete message in {len(rest)} bytes")
+    return messages, rest
+
+
+def check_message_size(payload):
+    # The encoded message, which must not be larger than the peer accepts
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise MessageTooLarge(f"Message of {len(payload)} bytes is larger than the limit of {MAX_MESSAGE_SIZE}")
+    return payload
+
+
+def encode_frame(payload):
+    return FRAME_HEADER.pack(len(check_message_size(payload))) + payload
+
+
+def frame_size(header):
+    size, = FRAME_HEADER.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Frame of {size} bytes is too large")
+    return size
+
+
+def is_framed(first_byte):
+    # Legacy clients start with a JSON object, framed ones with MAGIC
+    return first_byte == MAGIC[:1]
+
+
+def client_hello(codecs=None):
+    return HELLO_PREFIX + encode_frame(json_encode({"type": "hello", "codecs": list(codecs or CODECS)}))
+
+
+def check_hello_prefix(prefix):
+    if prefix != HELLO_PREFIX:
+        raise ValueError(f"Unsupported protocol {prefix!r}")
+
+
+def choose_codec(hello):
+    # The first codec of the client's list that is available here; JSON is always available
+    if hello.get("type") != "hello":
+        raise ValueError("Expected a hello message")
+    return next((name for name in hello.get("codecs", ()) if name in CODECS), 'json')
+
+
+def server_hello(codec):
+    return encode_frame(json_encode({"type": "hello", "codec": codec}))
+
+
+def accepted_codec(hello):
+    if hello.get("type") != "hello" or hello.get("codec") not in CODECS:
+        raise ValueError(f"Unexpected hello {hello!r}")
+    return hello["codec"]
+
+
+def read_frame(reader):
+    """
+    Read one frame from a buffered binary file, such as socket.makefile('rb').
+    :return: The payload, or None when the peer closed the connection between frames.
+    """
+    header = reader.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise ConnectionError("Connection closed in a frame header")
+    size = frame_size(header)
+    payload = reader.read(size)
+    if len(payload) < size:
+        raise ConnectionError("Connection closed in a frame")
+    return payload
+
+
+async def read_frame_async(reader):
+    # read_frame for an asyncio StreamReader
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Connection closed in a frame header")
+    try:
+        return await reader.readexactly(frame_size(header))
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed in a frame")
+
+
+def client_handshake(sock, reader, codecs=None):
+    """
+    Negotiate the codec on a freshly connected blocking socket.
+    :param reader: sock.makefile('rb'), used for every later read.
+    :return: (encode, decode) of the codec the server picked.
+    """
+    sock.sendall(client_hello(codecs))
+    payload = read_frame(reader)
+    if payload is None:
+        raise ConnectionError("Connection closed during the handshake")
+    return CODECS[accepted_codec(json_decode(payload))]
+
+
+async def client_handshake_async(reader, writer, codecs=None):
+    # client_handshake for asyncio streams
+    writer.write(client_hello(codecs))
+    await writer.drain()
+    payload = await read_frame_async(reader)
+    if payload is None:
+        raise ConnectionError("Connection closed during the handshake")
+    return CODECS[accepted_codec(json_decode(payload))]
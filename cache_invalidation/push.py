@@ -0,0 +1,136 @@
+import threading
+
+# Invalidations are collected for this long and then sent as one notification per subscriber
+FLUSH_INTERVAL = 0.5
+# A subscriber that falls this far behind gets a single resync notification instead of the ids
+MAX_PENDING_IDS = 10000
+SUBSCRIPTION_REQUESTS = ("subscribe", "unsubscribe")
+
+
+class Subscriber:
+    """
+    What one connection subscribed to, and the invalidations waiting to be sent to it.
+    The flush adds ids and calls wake(); the connection's own sender takes them with take_notification() and
+    writes them at the pace the client reads. Ids arriving meanwhile coalesce into one set, and past
+    MAX_PENDING_IDS they are dropped for a resync notification, so a slow client costs bounded memory and
+    never holds up the flush or other clients.
+    """
+
+    def __init__(self, wake, sequence=0):
+        """
+        :param sequence: The store's sequence when subscribing; later changes are notified.
+        """
+        self.item_ids = set()
+        self.prefixes = set()
+        self.wake = wake
+        self.lock = threading.Lock()  # the flush fills pending, the sender empties it
+        self.pending = set()
+        self.pending_until = None
+        self.delivered_until = sequence  # changes up to this sequence were notified or predate the subscription
+        self.resync_since = None
+        self.closed = False
+
+    def add(self, item_ids, until):
+        with self.lock:
+            if self.resync_since is None:
+                self.pending.update(item_ids)
+                self.pending_until = until
+                if len(self.pending) > MAX_PENDING_IDS:
+                    self.pending.clear()
+                    self.resync_since = self.delivered_until
+        self.wake()
+
+    def take_notification(self):
+        # The next notification to send, None when there is nothing new
+        with self.lock:
+            if self.resync_since is not None:
+                notification = {"type": "updated_ids", "item_ids": [], "resync": True,
+                                "since_seq": self.resync_since}
+                self.resync_since = None
+                return notification
+            if not self.pending:
+                return None
+            notification = {"type": "updated_ids", "item_ids": list(self.pending), "until": self.pending_until}
+            self.pending = set()
+            self.delivered_until = self.pending_until
+            return notification
+
+    def close(self):
+        self.closed = True
+        self.wake()
+
+
+class SubscriptionRegistry:
+    """
+    Subscriptions of all connections, indexed by item_id and by prefix of str(item_id), and the ids changed
+    since the last flush. A change is recorded in O(1); flush() finds the subscribers of every changed id with
+    one lookup per id and per prefix length, so an id changed many times within one interval goes out once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_item_id = {}
+        self.by_prefix = {}
+        self.changed = set()
+        self.changed_until = None
+
+    def record_change(self, item):
+        # ItemStore listener
+        with self.lock:
+            self.changed.add(item.item_id)
+            self.changed_until = item.sequence
+
+    def subscribe(self, subscriber, item_ids=(), prefixes=()):
+        with self.lock:
+            for item_id in item_ids:
+                self.by_item_id.setdefault(item_id, set()).add(subscriber)
+            for prefix in prefixes:
+                self.by_prefix.setdefault(prefix, set()).add(subscriber)
+            subscriber.item_ids.update(item_ids)
+            subscriber.prefixes.update(prefixes)
+
+    def unsubscribe(self, subscriber, item_ids=None, prefixes=None):
+        # Without item_ids and prefixes, drop every subscription of the subscriber
+        if item_ids is None and prefixes is None:
+            item_ids, prefixes = subscriber.item_ids, subscriber.prefixes
+        with self.lock:
+            for index, keys in ((self.by_item_id, set(item_ids or ())), (self.by_prefix, set(prefixes or ()))):
+                for key in keys:
+                    subscribers = index.get(key)
+                    if subscribers is not None:
+                        subscribers.discard(subscriber)
+                        if not subscribers:
+                            del index[key]
+            subscriber.item_ids.difference_update(item_ids or ())
+            subscriber.prefixes.difference_update(prefixes or ())
+
+    def flush(self):
+        """
+        Hand the ids changed since the last flush to their subscribers.
+        :return: Number of subscribers notified.
+        """
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            until = self.changed_until
+            batches = {}
+            for item_id in changed:
+                for subscriber in self.by_item_id.get(item_id, ()):
+                    batches.setdefault(subscriber, set()).add(item_id)
+                if self.by_prefix:
+                    key = str(item_id)
+                    for length in range(len(key) + 1):
+                        for subscriber in self.by_prefix.get(key[:length], ()):
+                            batches.setdefault(subscriber, set()).add(item_id)
+        for subscriber, item_ids in batches.items():
+            subscriber.add(item_ids, until)
+        return len(batches)
+
+
+def handle_subscription(registry, subscriber, request):
+    # Response to a subscribe or unsubscribe request of the connection owning subscriber
+    if request["type"] == "subscribe":
+        # null, which request_error lets through as for unsubscribe, subscribes to nothing more
+        registry.subscribe(subscriber, request.get("item_ids") or (), request.get("prefixes") or ())
+    else:
+        registry.unsubscribe(subscriber, request.get("item_ids"), request.get("prefixes"))
+    return {"type": "subscribed", "item_count": len(subscriber.item_ids), "prefix_count": len(subscriber.prefixes)}
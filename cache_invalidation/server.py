@@ -1,90 +1,496 @@
+import argparse
+import logging
 import random
 import socket
 import threading
 import time
 import json
+from collections.abc import Hashable
 
-class Item:
-    def __init__(self, item_id, content):
-        self.item_id = item_id
-        self.content = content
-        self.time_changed = time.time()
+from protocol import (CODECS, FRAME_HEADER, HELLO_PREFIX, MAX_MESSAGE_SIZE, MessageTooLarge, check_hello_prefix,
+                      check_message_size, choose_codec, encode_frame, is_framed, json_decode, read_frame, server_hello,
+                      split_json_messages)
+from delta import delta_size, make_delta
+from durable import FSYNC_INTERVAL, SNAPSHOT_EVERY, DurableStore
+from hash_ring import HashRing
+from metrics import Metrics, add_logging_arguments, configure_logging, serve_metrics
+from push import FLUSH_INTERVAL, SUBSCRIPTION_REQUESTS, Subscriber, SubscriptionRegistry, handle_subscription
+from store import ItemStore
 
-    def update_content(self, new_content):
-        self.content = new_content
-        self.time_changed = time.time()
+try:
+    import resource
+except ImportError:  # Windows, where the open file limit cannot be raised this way
+    resource = None
+
+log = logging.getLogger('cache_invalidation.server')
+# Request types counted under their own name, others as "other" so that garbage cannot add metrics without bound
+REQUEST_TYPES = ("get_invalidated", "get_item", "get_items", "stats", *SUBSCRIPTION_REQUESTS)
+# An updated_items response holds changes with up to this many characters of content; the rest follow in the next
+# ones. Far below MAX_MESSAGE_SIZE, as JSON may escape a character to 6 bytes
+MAX_UPDATES_CONTENT = MAX_MESSAGE_SIZE // 8
+# Estimate of what an update adds to a response besides its content: the item_id, time and version with their keys
+UPDATE_OVERHEAD = 100
+
+
+def initial_contents(count=5, shard=None, shards=None):
+    """
+    (item_id, content) of the items a server starts with.
+    :param count: Number of items across all shards.
+    :param shard: Name "host:port" of this server in shards; only the items the hash ring gives it are created.
+    """
+    if not shards:
+        return [(i, f"Content {i}") for i in range(count)]
+    if shard not in shards:
+        raise ValueError(f"{shard} is not one of the shards {shards}")
+    ring = HashRing(shards)
+    return [(i, f"Content {i}") for i in range(count) if ring.shard_for(i) == shard]
+
+
+def initial_items(count=5, shard=None, shards=None):
+    return ItemStore(initial_contents(count, shard, shards))
+
+
+def open_store(item_count=5, shard=None, shards=None, data_dir=None, fsync_interval=FSYNC_INTERVAL,
+               snapshot_every=SNAPSHOT_EVERY):
+    """
+    The store of a server, kept in data_dir when given: restored from there, or created with the initial items
+    when data_dir holds nothing yet.
+    :return: (store, DurableStore of data_dir to close at shutdown or None)
+    """
+    if data_dir is None:
+        return initial_items(item_count, shard, shards), None
+    store = ItemStore()
+    durable = DurableStore(store, data_dir, fsync_interval, snapshot_every)
+    recovered = durable.recover()
+    durable.start()
+    if len(store):
+        log.info("Restored %d items up to change %d from %s: %d from the snapshot, %d changes replayed in %.3fs",
+                 len(store), store.sequence, data_dir, recovered['snapshot_items'], recovered['replayed'],
+                 recovered['seconds'])
+    else:
+        for item_id, content in initial_contents(item_count, shard, shards):
+            store.put(item_id, content)
+    return store, durable
+
+
+def update_random_item(store):
+    if not store.item_ids:
+        return None
+    item_id = random.choice(store.item_ids)
+    return store.put(item_id, f"Updated Content {item_id} at {time.time()}")
+
+
+def item_update(store, item, base_version=None, inline_max=None):
+    """
+    An item as a client holding base_version of it can apply: without content when that is the current version,
+    with a delta against base_version when the store still has it and the delta is smaller, with the content
+    otherwise.
+    :param inline_max: Leave out content longer than this many characters, the client then fetches the item.
+    """
+    update = {"item_id": item.item_id, "time_changed": item.time_changed, "version": item.version}
+    if base_version == item.version:
+        return update
+    base = None if base_version is None else store.content_of(item.item_id, base_version)
+    if base is not None:
+        delta = make_delta(base, item.content)
+        if delta_size(delta) < len(item.content):
+            update["base_version"] = base_version
+            update["delta"] = delta
+            return update
+    if inline_max is None or len(item.content) <= inline_max:
+        update["content"] = item.content
+    return update
+
+
+def first_page(changed, budget=MAX_UPDATES_CONTENT):
+    # The first of the changed items, as many as fit into budget, and at least one
+    size = 0
+    for index, item in enumerate(changed):
+        size += len(item.content) + UPDATE_OVERHEAD
+        if size > budget and index:
+            return changed[:index]
+    return changed
+
+
+def handle_request(store, request):
+    # Response to one request, shared by the threaded and the asyncio server
+    if request["type"] == "get_invalidated":
+        # Read first: changes made meanwhile are sent now and again next time, rather than not at all
+        sequence = store.sequence
+        # since_seq, the sequence of the last response, gives exactly the missed changes, also across restarts
+        if "since_seq" in request:
+            if request["since_seq"] is None:
+                # A new client's cursor: no changes, only where they start
+                return {"type": "updated_items", "items": [], "sequence": sequence, "log_id": store.log_id}
+            if request.get("log_id") != store.log_id or request["since_seq"] > sequence:
+                # The cursor counts another history, such as that of a server restarted without its --data_dir.
+                # Every change since store.sequence 0 could be sent, but the versions the client holds are from the
+                # other history too, so it has to drop its cache.
+                return {"type": "resync_required", "sequence": sequence, "log_id": store.log_id,
+                        "message": "Cursor is not from this server's change log, full resync required"}
+            cursor = {"sequence": request["since_seq"]}
+            changed = store.changed_after(request["since_seq"])
+        else:
+            cursor = {"when": request["since"]}
+            changed = store.changed_since(request["since"])
+        page = first_page(changed)
+        more = len(page) < len(changed)
+        if more:
+            # The client asks for the rest with since_seq at the last change sent, after since_seq or since alike
+            changed, sequence = page, page[-1].sequence
+        if "inline" in request:
+            # Small items inline and deltas against the version the client held, so that a client which was
+            # up to date then needs no get_items round trip
+            updated_items = [item_update(store, item, store.version_at(item.item_id, **cursor), request["inline"])
+                             for item in changed]
+        else:
+            updated_items = [item.to_dict() for item in changed]
+        response = {"type": "updated_items", "items": updated_items, "sequence": sequence, "log_id": store.log_id}
+        if more:
+            response["more"] = True
+        return response
+    elif request["type"] == "get_item":
+        item_id = request["item_id"]
+        item = store.get(item_id)
+        if item:
+            return {"type": "item", "item": item.to_dict()}
+        return {"type": "error", "message": "Item not found"}
+    elif request["type"] == "get_items":
+        # versions, when given, are those the client holds, in the order of item_ids, None for items it has not got
+        versions = request.get("versions")
+        items, missing = [], []
+        for index, item_id in enumerate(request["item_ids"]):
+            item = store.get(item_id)
+            if not item:
+                missing.append(item_id)
+            elif versions is None:
+                items.append(item.to_dict())
+            else:
+                items.append(item_update(store, item, versions[index]))
+        return {"type": "items", "items": items, "missing": missing}
+    return {"type": "error", "message": f"Unknown request type {request['type']}"}
+
+
+def server_metrics(store, connected_clients):
+    # Metrics of a server, with gauges read from the store and the connected clients when they are read
+    metrics = Metrics('cache_invalidation')
+
+    def collect(metrics):
+        metrics.set('items', len(store))
+        metrics.set('sequence', store.sequence)
+        metrics.set('connections_open', len(connected_clients))
+
+    metrics.collectors.append(collect)
+    return metrics
+
+
+def request_label(request):
+    request_type = request.get("type") if isinstance(request, dict) else None
+    return request_type if request_type in REQUEST_TYPES else "other"
+
+
+def _is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_item_ids(value):
+    return isinstance(value, list) and all(isinstance(item_id, Hashable) for item_id in value)
+
+
+def request_error(request):
+    """
+    What is wrong with the shape of a request, None when it has every field its type needs, of the right kind.
+    Decoded requests are checked once before they are handled, so that a client's mistake gets an error response
+    rather than an exception in its connection's handler.
+    """
+    if not isinstance(request, dict):
+        return f"A request is an object, not {type(request).__name__}"
+    request_type = request.get("type")
+    if request_type not in REQUEST_TYPES:
+        return f"Unknown request type {request_type}"
+    if request_type == "get_invalidated":
+        if "since_seq" in request:
+            if request["since_seq"] is not None and not _is_integer(request["since_seq"]):
+                return "since_seq must be an integer or null"
+        elif not isinstance(request.get("since"), (int, float)) or isinstance(request.get("since"), bool):
+            return "get_invalidated needs since_seq or since"
+        if request.get("inline") is not None and not _is_integer(request["inline"]):
+            return "inline must be an integer or null"
+    elif request_type == "get_item":
+        if not isinstance(request.get("item_id"), Hashable) or request.get("item_id") is None:
+            return "get_item needs an item_id"
+    elif request_type == "get_items":
+        if not _is_item_ids(request.get("item_ids")):
+            return "get_items needs a list of item_ids"
+        versions = request.get("versions")
+        if versions is not None and (not isinstance(versions, list) or len(versions) != len(request["item_ids"])
+                                     or not all(version is None or _is_integer(version) for version in versions)):
+            return "versions must be a list of an integer or null for every item_id"
+    elif request_type in SUBSCRIPTION_REQUESTS:
+        if request.get("item_ids") is not None and not _is_item_ids(request["item_ids"]):
+            return "item_ids must be a list"
+        prefixes = request.get("prefixes")
+        if prefixes is not None and not (isinstance(prefixes, list)
+                                         and all(isinstance(prefix, str) for prefix in prefixes)):
+            return "prefixes must be a list of strings"
+    return None
+
+
+def respond(server, request, connection):
+    """
+    Response to one request of a connection, timed and counted in the server's metrics; shared by the threaded and
+    the asyncio server. A request of the wrong shape gets an error response, keeping its request_id, and so does
+    one whose handling fails, which is logged with its traceback; the connection carries on either way.
+    :param server: Server or AsyncServer, for its store, subscriptions, metrics and subscriber_for(connection).
+    """
+    start = time.perf_counter()
+    label = request_label(request)
+    log.debug("Got a %s request", label)
+    error = request_error(request)
+    if error is not None:
+        log.debug("Rejected a request: %s", error)
+        response = {"type": "error", "message": error}
+    else:
+        try:
+            if request["type"] == "stats":
+                response = stats_response(server.metrics, request)
+            elif request["type"] in SUBSCRIPTION_REQUESTS:
+                response = handle_subscription(server.subscriptions, server.subscriber_for(connection), request)
+            else:
+                response = handle_request(server.store, request)
+        except Exception as e:
+            log.exception("Handling a %s request failed", label)
+            server.metrics.count('request_errors_total', type=label)
+            response = {"type": "error", "message": f"Internal error: {e}"}
+    server.metrics.count('requests_total', type=label)
+    server.metrics.observe('request_seconds', time.perf_counter() - start, type=label)
+    return tag_response(request, response)
+
+
+def stats_response(metrics, request):
+    # Response to a stats request: the metrics as a dict, or as Prometheus text with "format": "prometheus"
+    if request.get("format") == "prometheus":
+        return {"type": "stats", "text": metrics.prometheus()}
+    return {"type": "stats", **metrics.snapshot()}
+
+
+def tag_response(request, response):
+    # Clients that pipeline requests match the responses by the request_id they sent
+    if isinstance(request, dict) and "request_id" in request:
+        response["request_id"] = request["request_id"]
+    return response
+
+
+def encode_response(encode, response):
+    """
+    The encoded response, or an error in its place when it is larger than clients accept: they would end the
+    connection on the oversized message, with the error they can ask for less.
+    """
+    try:
+        return encode(response)
+    except MessageTooLarge as e:
+        log.warning("Not sending a %s response: %s", response.get("type"), e)
+        return encode(tag_response(response, {"type": "error", "message": f"Response too large: {e}"}))
+
+
+def legacy_encode(message):
+    return check_message_size(json.dumps(message).encode())
+
+
+def raise_open_file_limit():
+    # Every client connection is a file descriptor, thousands of them need more than the usual soft limit of 1024
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--host', default='localhost', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=12345, help='Port to listen on')
+    parser.add_argument('--items', type=int, default=5, help='Number of items to serve')
+    parser.add_argument('--flush_interval', type=float, default=FLUSH_INTERVAL,
+                        help='Seconds to collect invalidations before pushing them to subscribed clients')
+    parser.add_argument('--shards', type=lambda value: value.split(','), default=None,
+                        help='Comma separated host:port of every shard, including this server as --host:--port; '
+                             'the server then only holds the items the hash ring gives it')
+    parser.add_argument('--data_dir', default=None,
+                        help='Directory to keep the items and their change log in, so that a restarted server '
+                             'carries on where it stopped; in memory only without it')
+    parser.add_argument('--fsync_interval', type=float, default=FSYNC_INTERVAL,
+                        help='Seconds to collect changes before writing them to the log with one fsync')
+    parser.add_argument('--snapshot_every', type=int, default=SNAPSHOT_EVERY,
+                        help='Number of logged changes after which all items are written to a new snapshot')
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help='Serve Prometheus metrics over HTTP at /metrics on this port of --host; the stats '
+                             'request returns them on the protocol\'s own connections either way')
+    add_logging_arguments(parser)
+
+
+class ClientRegistry:
+    # The connected clients, added and removed by their handler threads; iterating goes over a copy taken under the
+    # lock, so it never sees the set change
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = set()
+
+    def add(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def discard(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.clients))
+
+
+class Connection:
+    # A client socket written to by its handler thread and, once it subscribed, by its push sender thread
+    def __init__(self, client_socket, address, metrics):
+        self.socket = client_socket
+        self.address = address
+        self.metrics = metrics
+        self.encode = legacy_encode  # until a framed hello
+        self.send_lock = threading.Lock()  # one whole message at a time
+        self.subscriber = None
+
+    def send(self, message):
+        data = encode_response(self.encode, message)
+        with self.send_lock:
+            self.socket.sendall(data)
+        self.metrics.count('bytes_sent_total', len(data))
 
-    def to_dict(self):
-        return {
-            "item_id": self.item_id,
-            "content": self.content,
-            "time_changed": self.time_changed
-        }
 
 class Server:
-    def __init__(self, host, port):
-        self.items = [Item(i, f"Content {i}") for i in range(5)]
+    # One thread per connected client, plus one push sender thread per subscribed client
+    def __init__(self, host, port, item_count=5, flush_interval=FLUSH_INTERVAL, shards=None, data_dir=None,
+                 fsync_interval=FSYNC_INTERVAL, snapshot_every=SNAPSHOT_EVERY, metrics_port=None):
+        self.store, self.durable = open_store(item_count, f"{host}:{port}", shards, data_dir, fsync_interval,
+                                              snapshot_every)
+        self.subscriptions = SubscriptionRegistry()
+        self.store.listeners.append(self.subscriptions.record_change)
+        self.flush_interval = flush_interval
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((host, port))
-        self.server_socket.listen()
-        print(f"Server listening on {host}:{port}")
-        self.connected_clients = []
-        threading.Thread(target=self.update_random_item_periodically).start()
-        #threading.Thread(target=self.send_updates_to_clients_periodically).start()
+        self.server_socket.listen(socket.SOMAXCONN)
+        log.info("Server listening on %s:%d", host, port)
+        self.connected_clients = ClientRegistry()
+        self.metrics = server_metrics(self.store, self.connected_clients)
+        if metrics_port is not None:
+            serve_metrics(self.metrics, host, metrics_port)
+        threading.Thread(target=self.update_random_item_periodically, daemon=True).start()
+        threading.Thread(target=self.flush_subscriptions_periodically, daemon=True).start()
 
     def start(self):
         while True:
             client_socket, address = self.server_socket.accept()
-            self.connected_clients.append(client_socket)
-            threading.Thread(target=self.handle_client, args=(client_socket, address)).start()
+            self.connected_clients.add(client_socket)
+            self.metrics.count('connections_total')
+            threading.Thread(target=self.handle_client, args=(client_socket, address), daemon=True).start()
 
     def update_random_item_periodically(self):
         while True:
             time.sleep(10)  # Update one random item every 10 seconds
-            random_item = random.choice(self.items)
-            new_content = f"Updated Content {random_item.item_id} at {time.time()}"
-            random_item.update_content(new_content)
-            print(f"Updated item {random_item.item_id}")
+            random_item = update_random_item(self.store)
+            if random_item is not None:
+                log.info("Updated item %s", random_item.item_id)
 
-    def send_updates_to_clients_periodically(self):
+    def flush_subscriptions_periodically(self):
+        # Only hands ids to the subscribers, their sender threads do the writing
         while True:
-            time.sleep(10)
-            print("Sending updates to clients...")
-            updated_item_ids = [item.item_id for item in self.items if time.time() - item.time_changed < 10]
-            if updated_item_ids:
-                response = {"type": "updated_ids", "item_ids": updated_item_ids}
-                for client in self.connected_clients:
-                    try:
-                        client.send(json.dumps(response).encode())
-                    except Exception as e:
-                        print(f"Failed to send update to client: {e}")
-                        self.connected_clients.remove(client)
+            time.sleep(self.flush_interval)
+            notified = self.subscriptions.flush()
+            if notified:
+                self.metrics.observe('invalidation_fanout', notified)
+
+    def push_notifications(self, connection, subscriber, wakeup):
+        # Sender thread of a subscribed client; while it waits for a slow client, new ids coalesce in the subscriber
+        try:
+            while not subscriber.closed:
+                wakeup.wait()
+                wakeup.clear()
+                notification = subscriber.take_notification()
+                if notification is not None and not subscriber.closed:
+                    connection.send(notification)
+                    self.metrics.count('notifications_total', kind="resync" if "resync" in notification else "ids")
+        except OSError as e:
+            log.warning("Failed to send updates to %s: %s", connection.address, e)
+
+    def subscriber_for(self, connection):
+        if connection.subscriber is None:
+            wakeup = threading.Event()
+            connection.subscriber = Subscriber(wakeup.set, self.store.sequence)
+            threading.Thread(target=self.push_notifications, args=(connection, connection.subscriber, wakeup),
+                             daemon=True).start()
+        return connection.subscriber
 
     def handle_client(self, client_socket, address):
-        print(f"Accepted connection from {address}")
-        while True:
-            data = client_socket.recv(1024)
-            if not data:
-                break
-
-            request = json.loads(data)
-            if request["type"] == "get_invalidated":
-                print("Got a request for invalidated items...")
-                last_update_time = request["since"]
-                updated_items = [item.to_dict() for item in self.items if item.time_changed > last_update_time]
-                response = {"type": "updated_items", "items": updated_items}
-                client_socket.send(json.dumps(response).encode())
-            elif request["type"] == "get_item":
-                print("Got a request for an item...")
-                item_id = request["item_id"]
-                item = next((item for item in self.items if item.item_id == item_id), None)
-                if item:
-                    response = {"type": "item", "item": item.to_dict()}
-                else:
-                    response = {"type": "error", "message": "Item not found"}
-                client_socket.send(json.dumps(response).encode())
+        log.debug("Accepted connection from %s", address)
+        connection = Connection(client_socket, address, self.metrics)
+        reader = client_socket.makefile('rb')
+        try:
+            first = reader.read(1)
+            if not first:
+                return
+            if is_framed(first):
+                check_hello_prefix(first + reader.read(len(HELLO_PREFIX) - 1))
+                codec = choose_codec(json_decode(read_frame(reader) or b'{}'))
+                client_socket.sendall(server_hello(codec))
+                encode, decode = CODECS[codec]
+                connection.encode = lambda message: encode_frame(encode(message))
+                while (payload := read_frame(reader)) is not None:
+                    self.metrics.count('bytes_received_total', FRAME_HEADER.size + len(payload))
+                    connection.send(respond(self, decode(payload), connection))
+            else:
+                # Legacy clients: unframed JSON
+                buffer = first
+                while True:
+                    requests, buffer = split_json_messages(buffer)
+                    for request in requests:
+                        connection.send(respond(self, request, connection))
+                    data = reader.read1(1024)
+                    if not data:
+                        break
+                    self.metrics.count('bytes_received_total', len(data))
+                    buffer += data
+        except (OSError, ValueError) as e:
+            log.warning("Connection from %s failed: %s", address, e)
+            self.metrics.count('connection_errors_total')
+        except Exception:
+            # Not the client's doing, but it only ends this connection
+            log.exception("Serving %s failed", address)
+            self.metrics.count('connection_errors_total')
+        finally:
+            if connection.subscriber is not None:
+                self.subscriptions.unsubscribe(connection.subscriber)
+                connection.subscriber.close()
+            self.connected_clients.discard(client_socket)
+            reader.close()
+            client_socket.close()
 
 
 if __name__ == "__main__":
-    server = Server("localhost", 12345)
-    server.start()
+    parser = argparse.ArgumentParser(description='Serve items and which of them changed, one thread per client')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    configure_logging(args)
+    raise_open_file_limit()
+    server = Server(args.host, args.port, item_count=args.items, flush_interval=args.flush_interval,
+                    shards=args.shards, data_dir=args.data_dir, fsync_interval=args.fsync_interval,
+                    snapshot_every=args.snapshot_every, metrics_port=args.metrics_port)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server.durable is not None:
+            server.durable.close()
@@ -0,0 +1,45 @@
+import argparse
+import time
+from collections import Counter
+
+from hash_ring import HashRing, moved_fraction
+from load_test import SERVERS, start_server
+from server import raise_open_file_limit
+
+
+def shard_addresses(host, port, count):
+    return [f"{host}:{port + index}" for index in range(count)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a sharded deployment on this machine: one server process per '
+                                                 'shard on consecutive ports')
+    parser.add_argument('--host', default='localhost', help='Address the shards listen on')
+    parser.add_argument('--port', type=int, default=12345, help='Port of the first shard')
+    parser.add_argument('--shards', type=int, default=4, help='Number of shards')
+    parser.add_argument('--server', choices=SERVERS, default='asyncio', help='Server mode of every shard')
+    parser.add_argument('--items', type=int, default=5, help='Number of items across all shards')
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    addresses = shard_addresses(args.host, args.port, args.shards)
+    ring = HashRing(addresses)
+    counts = Counter(ring.shard_for(item_id) for item_id in range(args.items))
+    grown = HashRing(addresses + shard_addresses(args.host, args.port + args.shards, 1))
+    processes = []
+    try:
+        for address in addresses:
+            host, port = address.rsplit(':', 1)
+            processes.append(start_server(args.server, host, int(port), args.items, ['--shards', ','.join(addresses)]))
+            print(f"Shard {address}: {counts[address]} items")
+        print(f"Adding a shard would move {moved_fraction(ring, grown, range(args.items)):.1%} of the items")
+        print(f"Clients connect with --shards {','.join(addresses)}")
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
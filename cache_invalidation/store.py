@@ -0,0 +1,237 @@
+import threading
+import time
+import uuid
+from bisect import bisect_right
+from collections import OrderedDict
+
+# The change log is compacted once it holds this many times more entries than there are items
+COMPACT_FACTOR = 2
+# ... and never below this many entries, so small stores do not compact on every change
+COMPACT_MIN_ENTRIES = 1024
+# Old versions of items kept to compute deltas against, least recently used ones are dropped first
+HISTORY_SIZE = 4096
+# The history is split into this many parts by item_id, each with its own lock
+HISTORY_STRIPES = 16
+
+
+class Item:
+    # Never changed once in the store: a change replaces the item, so readers need no lock to see it whole
+    def __init__(self, item_id, content, time_changed=None, sequence=0, version=1):
+        self.item_id = item_id
+        self.content = content
+        self.time_changed = time.time() if time_changed is None else time_changed
+        self.sequence = sequence  # number of the change log entry of the item's last change
+        self.version = version  # counts the changes of this item
+
+    def updated(self, new_content, time_changed=None, sequence=0):
+        # The next version of the item
+        return Item(self.item_id, new_content, time_changed, sequence, self.version + 1)
+
+    def to_dict(self):
+        return {
+            "item_id": self.item_id,
+            "content": self.content,
+            "time_changed": self.time_changed,
+            "version": self.version
+        }
+
+
+class ItemStore:
+    """
+    Items indexed by item_id, plus a log of their changes in the order they happened.
+    Every change gets the next sequence number and a time_changed that never goes backwards, so the log is sorted
+    by both and "changed since" is a bisect followed by a walk over the k newer entries: O(log n + k).
+    Only the latest entry of every item is live; the others are dropped by compaction, which keeps the log
+    below COMPACT_FACTOR times the number of items.
+    Replaced versions of items stay in a least recently used history of history_size entries, so that responses
+    can carry a delta against the version a client holds.
+
+    Changes are serialised by the store's lock, as the log needs one order of them. Reads hardly wait for it:
+    items are replaced rather than changed, so get() is a lock-free lookup that always sees a whole item, "changed
+    since" holds the lock only to copy its part of the log, and the history is striped over HISTORY_STRIPES locks.
+    """
+
+    def __init__(self, items=(), history_size=HISTORY_SIZE):
+        self.items = {}
+        self.item_ids = []  # insertion order, for picking random items
+        self.sequence = 0
+        self.last_time = 0.0
+        # Names the history the sequence numbers count; a store started afresh has another one, so that a cursor
+        # into an old history is not mistaken for one into this
+        self.log_id = uuid.uuid4().hex
+        # The change log, as parallel lists ordered by sequence (and so by time)
+        self.log_sequences = []
+        self.log_times = []
+        self.log_item_ids = []
+        # (item_id, version) -> (content, time_changed, sequence) of replaced versions, in the stripe of item_id
+        self.history = [OrderedDict() for _ in range(HISTORY_STRIPES)]
+        self.history_locks = [threading.Lock() for _ in range(HISTORY_STRIPES)]
+        self.history_size = history_size
+        self.lock = threading.Lock()
+        # Called with every changed item, in the order of the changes; they run under the store's lock
+        # and must be quick
+        self.listeners = []
+        for item_id, content in items:
+            self.put(item_id, content)
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, item_id):
+        return self.items.get(item_id)
+
+    def put(self, item_id, content):
+        # Create or update an item and log the change
+        with self.lock:
+            self.sequence += 1
+            # The wall clock may step back, the log must not
+            self.last_time = max(time.time(), self.last_time)
+            item = self.items.get(item_id)
+            if item is None:
+                item = Item(item_id, content, self.last_time, self.sequence)
+                self.item_ids.append(item_id)
+            else:
+                self._remember(item)
+                item = item.updated(content, self.last_time, self.sequence)
+            self.items[item_id] = item
+
+            self.log_sequences.append(self.sequence)
+            self.log_times.append(self.last_time)
+            self.log_item_ids.append(item_id)
+            for listener in self.listeners:
+                listener(item)
+            if len(self.log_sequences) > max(COMPACT_FACTOR * len(self.items), COMPACT_MIN_ENTRIES):
+                self._compact()
+            return item
+
+    def replay(self, sequence, time_changed, version, item_id, content):
+        """
+        Apply a change recorded by an earlier run, keeping its sequence number, time and version.
+        Listeners are not called, the change is not new.
+        """
+        with self.lock:
+            self.sequence = sequence
+            self.last_time = max(time_changed, self.last_time)
+            item = self.items.get(item_id)
+            if item is None:
+                self.item_ids.append(item_id)
+            else:
+                self._remember(item)
+            self.items[item_id] = Item(item_id, content, time_changed, sequence, version)
+            self.log_sequences.append(sequence)
+            self.log_times.append(time_changed)
+            self.log_item_ids.append(item_id)
+            if len(self.log_sequences) > max(COMPACT_FACTOR * len(self.items), COMPACT_MIN_ENTRIES):
+                self._compact()
+
+    def state(self):
+        """
+        Copy of what restore() needs to rebuild the store: (log_id, sequence, last_time, list of (sequence,
+        time_changed, version, item_id, content) of every item). The caller holds the lock, so that it can cut its
+        log at sequence.
+        """
+        records = [(item.sequence, item.time_changed, item.version, item.item_id, item.content)
+                   for item in self.items.values()]
+        return self.log_id, self.sequence, self.last_time, records
+
+    def restore(self, log_id, sequence, last_time, records):
+        # Replace the items with those of state(); the log is rebuilt from every item's last change
+        items = {}
+        for item_sequence, time_changed, version, item_id, content in records:
+            items[item_id] = Item(item_id, content, time_changed, item_sequence, version)
+        log = sorted(items.values(), key=lambda item: item.sequence)
+        with self.lock:
+            self.items = items
+            self.item_ids = list(items)
+            self.log_sequences = [item.sequence for item in log]
+            self.log_times = [item.time_changed for item in log]
+            self.log_item_ids = [item.item_id for item in log]
+            for stripe, lock in zip(self.history, self.history_locks):
+                with lock:
+                    stripe.clear()
+            self.log_id = log_id
+            self.sequence = sequence
+            self.last_time = last_time
+
+    def changed_since(self, since):
+        """
+        Items changed after the time `since`, each once with its current content, in the order of their last change.
+        """
+        with self.lock:
+            start = bisect_right(self.log_times, since)
+            entries = list(zip(self.log_item_ids[start:], self.log_sequences[start:]))
+        return self._live(entries)
+
+    def changed_after(self, sequence):
+        """
+        Items changed after the change numbered `sequence`, like changed_since. Unlike times, sequence numbers are
+        unique, so a client that saw change `sequence` gets exactly the changes it missed.
+        """
+        with self.lock:
+            start = bisect_right(self.log_sequences, sequence)
+            entries = list(zip(self.log_item_ids[start:], self.log_sequences[start:]))
+        return self._live(entries)
+
+    def _live(self, entries):
+        # The items of the log entries that are still their last change. Outside the lock an item may have changed
+        # again since the entries were copied; it is then left out here, and its newer change reported next time.
+        items = self.items
+        return [item for item_id, sequence in entries if (item := items[item_id]).sequence == sequence]
+
+    def _history_stripe(self, item_id):
+        index = hash(item_id) % HISTORY_STRIPES
+        return self.history[index], self.history_locks[index]
+
+    def _remember(self, item):
+        if self.history_size:
+            history, lock = self._history_stripe(item.item_id)
+            with lock:
+                history[item.item_id, item.version] = (item.content, item.time_changed, item.sequence)
+                if len(history) > max(1, self.history_size // HISTORY_STRIPES):
+                    history.popitem(last=False)
+
+    def content_of(self, item_id, version):
+        # Content of a version of an item, None when it is unknown or no longer kept
+        item = self.items.get(item_id)
+        if item is not None and item.version == version:
+            return item.content
+        history, lock = self._history_stripe(item_id)
+        with lock:
+            entry = history.get((item_id, version))
+            if entry is None:
+                return None
+            history.move_to_end((item_id, version))
+            return entry[0]
+
+    def version_at(self, item_id, when=None, sequence=None):
+        """
+        The version an item had at time `when`, or after the change numbered `sequence`, which a client that was
+        up to date then holds.
+        :return: The version, or None when the item did not exist then or that version is no longer kept.
+        """
+        item = self.items.get(item_id)
+        if item is None:
+            return None
+        version = item.version
+        time_changed, changed_sequence = item.time_changed, item.sequence
+        history, lock = self._history_stripe(item_id)
+        with lock:
+            while (time_changed > when) if sequence is None else (changed_sequence > sequence):
+                version -= 1
+                entry = history.get((item_id, version))
+                if entry is None:
+                    return None
+                _, time_changed, changed_sequence = entry
+        return version
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        # Keep only the entries of every item's last change, older ones are superseded
+        live = [index for index, (item_id, sequence) in enumerate(zip(self.log_item_ids, self.log_sequences))
+                if self.items[item_id].sequence == sequence]
+        self.log_sequences = [self.log_sequences[index] for index in live]
+        self.log_times = [self.log_times[index] for index in live]
+        self.log_item_ids = [self.log_item_ids[index] for index in live]
@@ -0,0 +1,28 @@
+import pytest
+
+from push import Subscriber, SubscriptionRegistry, handle_subscription
+from server import request_error
+
+
+def subscribed(requests):
+    registry = SubscriptionRegistry()
+    subscriber = Subscriber(lambda: None)
+    return [handle_subscription(registry, subscriber, request) for request in requests]
+
+
+@pytest.mark.parametrize('fields', [{"item_ids": None}, {"prefixes": None}, {"item_ids": None, "prefixes": None}, {}])
+def test_null_or_missing_fields(fields):
+    # A subscribe without item_ids or prefixes adds none, an unsubscribe without either drops every subscription
+    subscribe = {"type": "subscribe", **fields}
+    unsubscribe = {"type": "unsubscribe", **fields}
+    assert request_error(subscribe) is None and request_error(unsubscribe) is None
+    responses = subscribed([{"type": "subscribe", "item_ids": [1, 2], "prefixes": ["3"]}, subscribe, unsubscribe])
+    assert responses[1] == {"type": "subscribed", "item_count": 2, "prefix_count": 1}
+    assert responses[2] == {"type": "subscribed", "item_count": 0, "prefix_count": 0}
+
+
+def test_subscribe_and_unsubscribe():
+    responses = subscribed([{"type": "subscribe", "item_ids": [1, 2], "prefixes": ["3"]},
+                            {"type": "unsubscribe", "item_ids": [2]},
+                            {"type": "unsubscribe", "prefixes": ["3"], "item_ids": None}])
+    assert [(response["item_count"], response["prefix_count"]) for response in responses] == [(2, 1), (1, 1), (1, 0)]
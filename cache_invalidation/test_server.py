@@ -0,0 +1,72 @@
+import json
+
+from protocol import MAX_MESSAGE_SIZE, encode_frame, json_encode
+from metrics import Metrics
+from push import SubscriptionRegistry
+from server import MAX_UPDATES_CONTENT, encode_response, handle_request, legacy_encode, respond
+from store import ItemStore
+
+
+def test_updated_items_are_paged():
+    content = 'x' * 1000
+    store = ItemStore((item_id, content) for item_id in range(5 * MAX_UPDATES_CONTENT // len(content)))
+    request = {"type": "get_invalidated", "since_seq": 0, "log_id": store.log_id}
+    seen = []
+    while True:
+        response = handle_request(store, request)
+        assert len(json_encode(response)) < MAX_MESSAGE_SIZE // 4
+        seen.extend(item["item_id"] for item in response["items"])
+        if not response.get("more"):
+            break
+        request = dict(request, since_seq=response["sequence"])
+    assert seen == list(range(len(store)))
+    assert response["sequence"] == store.sequence
+
+
+def test_time_cursor_continues_with_since_seq():
+    store = ItemStore((item_id, 'x' * MAX_UPDATES_CONTENT) for item_id in range(3))
+    response = handle_request(store, {"type": "get_invalidated", "since": 0})
+    assert [item["item_id"] for item in response["items"]] == [0] and response["more"]
+    response = handle_request(store, {"type": "get_invalidated", "since_seq": response["sequence"],
+                                      "log_id": response["log_id"]})
+    assert [item["item_id"] for item in response["items"]] == [1] and response["more"]
+
+
+def test_small_responses_are_not_paged():
+    store = ItemStore((item_id, f"Content {item_id}") for item_id in range(5))
+    response = handle_request(store, {"type": "get_invalidated", "since_seq": 0, "log_id": store.log_id})
+    assert len(response["items"]) == 5 and "more" not in response
+
+
+def test_oversized_response_is_replaced_by_an_error():
+    response = {"type": "item", "item": {"content": 'x' * MAX_MESSAGE_SIZE}, "request_id": 3}
+    for encode in (legacy_encode, lambda message: encode_frame(json_encode(message))):
+        data = encode_response(encode, response)
+        message = json.loads(data if encode is legacy_encode else data[4:])
+        assert message["type"] == "error" and message["request_id"] == 3
+
+
+class BrokenStore(ItemStore):
+    def get(self, item_id):
+        raise OSError("Disk on fire")
+
+
+class StubServer:
+    # What respond() needs of a Server
+    def __init__(self, store):
+        self.store = store
+        self.subscriptions = SubscriptionRegistry()
+        self.metrics = Metrics('test')
+
+    def subscriber_for(self, connection):
+        raise AssertionError("No subscription requests here")
+
+
+def test_failing_request_gets_an_error_response():
+    server = StubServer(BrokenStore([(1, "Content 1")]))
+    response = respond(server, {"type": "get_item", "item_id": 1, "request_id": 5}, None)
+    assert response == {"type": "error", "message": "Internal error: Disk on fire", "request_id": 5}
+    assert server.metrics.snapshot()["counters"]['request_errors_total{type="get_item"}'] == 1
+    # The next request is served as usual
+    response = respond(server, {"type": "get_items", "item_ids": [], "request_id": 6}, None)
+    assert response == {"type": "items", "items": [], "missing": [], "request_id": 6}
@@ -2,7 +2,26 @@ import gpxpy
 import gpxpy.gpx
 from datetime import datetime
 import argparse
-from math import radians, cos, sin, asin, sqrt
+import glob
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+from math import radians, cos, sin, asin, sqrt, isnan
+from time import perf_counter
+
+from checksum import checksum_ok
+from follow import follow
+from nmea_numpy import decode_nmea_block, decode_nmea_file, decode_nmea_file_parallel, iter_file_blocks, resolve_dates
+from segmentation import split_track
+from simplify import simplify_segments
+from stats import TrackStats
+from track import Track
+from writers import OUTPUT_FORMATS, write_segments
+
+
+# Counters of dropped GGA/RMC sentences, filled by both the scalar and the vectorized parser
+REJECT_REASONS = ('bad_checksum', 'no_fix', 'malformed')
 
 
 # Define NMEA Sentence Parsing
@@ -11,6 +30,8 @@ def parse_gpgga(sentence):
 
     # Get time
     time_str = fields[1]
+    if not time_str[0:4].isdigit():
+        raise ValueError(f"Invalid time {time_str}")
     hours = int(time_str[0:2])
     minutes = int(time_str[2:4])
     seconds = float(time_str[4:])
@@ -36,20 +57,37 @@ def parse_gpgga(sentence):
     # Get altitude
     altitude = float(fields[9])
 
+    if not (0 <= hours <= 23 and 0 <= minutes <= 59 and 0 <= seconds < 60):
+        raise ValueError(f"Invalid time {time_str}")
+    if isnan(latitude) or isnan(longitude) or isnan(altitude):
+        raise ValueError("Position is not a number")
+
     return (hours, minutes, seconds, latitude, longitude, altitude)
 
 
+def gpgga_has_fix(sentence):
+    # Fix quality 0 (or an empty one) and empty time or position fields mean the receiver had no fix
+    fields = sentence.split(',', 7)
+    return fields[6] not in ('', '0') and bool(fields[1] and fields[2] and fields[4])
+
+
 def parse_gprmc(sentence):
     fields = sentence.split(',')
 
+    # Get status (A=active, V=void)
+    status = fields[2]
+    if status != 'A':
+        # Void sentences often come without a date
+        return (None, None, None, status)
+
     # Get date
     date_str = fields[9]
+    if not date_str[0:6].isdigit():
+        raise ValueError(f"Invalid date {date_str}")
     day = int(date_str[0:2])
     month = int(date_str[2:4])
     year = int(date_str[4:6]) + 2000  # Assuming a YY format which is common in NMEA sentences
-
-    # Get status (A=active, V=void)
-    status = fields[2]
+    datetime(year, month, day)  # Raises ValueError for impossible dates
 
     return (day, month, year, status)
 
@@ -62,7 +100,8 @@ def should_create_new_path(prev_point, current_point, max_time_diff, max_lat_lon
         return True
 
     if distance_in_meters is not None:
-        distance = haversine(prev_point[2], prev_point[1], current_point[2], current_point[1])
+        # haversine() works in kilometres, the threshold is in metres
+        distance = haversine(prev_point[2], prev_point[1], current_point[2], current_point[1]) * 1000
         if distance > distance_in_meters:
             return True
     else:
@@ -74,77 +113,278 @@ def should_create_new_path(prev_point, current_point, max_time_diff, max_lat_lon
     return False
 
 
-def create_gpx_track(gps_data, max_time_diff, max_lat_lon_diff, distance_in_meters=None):
+def iter_segments(gps_data, max_time_diff, max_lat_lon_diff, distance_in_meters=None):
+    # Lazily split the points into segments; each segment is an iterator that must be consumed before the next one
+    segment_index = 0
+    prev_point = None
+
+    def segment_key(data_point):
+        nonlocal segment_index, prev_point
+        if prev_point and should_create_new_path(prev_point, data_point, max_time_diff, max_lat_lon_diff, distance_in_meters):
+            segment_index += 1
+        prev_point = data_point
+        return segment_index
+
+    for _, segment in groupby(gps_data, key=segment_key):
+        yield segment
+
+
+def create_gpx_track(track, max_time_diff, max_lat_lon_diff, distance_in_meters=None, simplify_tolerance=None):
+    # Segment breaks are found for the whole track at once, then every slice is emitted as a segment
+    segments = split_track(track, max_time_diff, max_lat_lon_diff, distance_in_meters)
+    if simplify_tolerance:
+        segments = simplify_segments(segments, simplify_tolerance)
+    return segments_to_gpx(segments)
+
+
+def segments_to_gpx(segments):
     gpx = gpxpy.gpx.GPX()
 
     # Create first track in our GPX:
     gpx_track = gpxpy.gpx.GPXTrack()
     gpx.tracks.append(gpx_track)
 
-    # Create the first segment in our GPX track:
-    gpx_segment = gpxpy.gpx.GPXTrackSegment()
-    gpx_track.segments.append(gpx_segment)
-
-    prev_point = None
-
-    for data_point in gps_data:
-        time, latitude, longitude, altitude = data_point
-
-        # If we have a previous point, check if we should start a new segment
-        if prev_point and should_create_new_path(prev_point, (time, latitude, longitude, altitude), max_time_diff, max_lat_lon_diff, distance_in_meters):
-            # Start a new segment
-            gpx_segment = gpxpy.gpx.GPXTrackSegment()
-            gpx_track.segments.append(gpx_segment)
+    for segment in segments:
+        gpx_segment = gpxpy.gpx.GPXTrackSegment()
+        gpx_track.segments.append(gpx_segment)
 
-        # Add point to current segment
-        gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(latitude, longitude, elevation=altitude, time=time))
+        for time, latitude, longitude, altitude in segment:
+            gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(latitude, longitude, elevation=altitude, time=time))
 
-        # Update the previous point
-        prev_point = (time, latitude, longitude, altitude)
+    # Keep the single empty segment for empty input
+    if not gpx_track.segments:
+        gpx_track.segments.append(gpxpy.gpx.GPXTrackSegment())
 
     return gpx
 
 
 # Parse the NMEA sentences and create a GPX file
-def nmea_to_gps_data(nmea_sentences):
-    gps_data = []
+def iter_gps_data(nmea_sentences, counters=None, validate_checksums=True):
+    # Yield fixes one by one as they are parsed, without collecting them.
+    # Sentences with a wrong checksum, without a fix or with broken fields are counted in `counters` and skipped.
+    counters = Counter() if counters is None else counters
     current_date = None
 
     for sentence in nmea_sentences:
-        if sentence.startswith('$GPGGA'):
-            time_data = parse_gpgga(sentence)
-            if current_date is not None:
-                time = datetime(current_date[2], current_date[1], current_date[0],
-                                         time_data[0], time_data[1], int(time_data[2]),
-                                         int((time_data[2] % 1) * 1e6))
-                gps_data.append((time,) + time_data[3:])
-        elif sentence.startswith('$GPRMC'):
-            date_data = parse_gprmc(sentence)
-            if date_data[3] == 'A':  # We'll take only active RMC sentences for the date
-                current_date = date_data[:3]
-    return gps_data
+        counters['sentences'] += 1
+        is_gpgga = sentence.startswith('$GPGGA')
+        if not is_gpgga and not sentence.startswith('$GPRMC'):
+            continue
+        if validate_checksums and not checksum_ok(sentence):
+            counters['bad_checksum'] += 1
+            continue
+
+        fix = None
+        try:
+            if is_gpgga:
+                if not gpgga_has_fix(sentence):
+                    counters['no_fix'] += 1
+                    continue
+                time_data = parse_gpgga(sentence)
+                if current_date is not None:
+                    time = datetime(current_date[2], current_date[1], current_date[0],
+                                    time_data[0], time_data[1], int(time_data[2]),
+                                    int((time_data[2] % 1) * 1e6))
+                    fix = (time,) + time_data[3:]
+            else:
+                date_data = parse_gprmc(sentence)
+                if date_data[3] == 'A':  # We'll take only active RMC sentences for the date
+                    current_date = date_data[:3]
+        except (ValueError, IndexError):
+            counters['malformed'] += 1
+            continue
+
+        if fix is not None:
+            yield fix
+
+
+def nmea_to_gps_data(nmea_sentences, counters=None, validate_checksums=True):
+    return Track.from_fixes(iter_gps_data(nmea_sentences, counters, validate_checksums))
 
 
 def load_nmea_sentences(nmea_file_path):
-    with open(nmea_file_path) as f:
+    # NMEA is ASCII; a garbage byte becomes U+FFFD, which fails the checksum or the parsing of its sentence
+    with open(nmea_file_path, encoding='ascii', errors='replace') as f:
         nmea_sentences = f.readlines()
     return nmea_sentences
 
 
-def calculate_averages(gps_data):
-    if len(gps_data) < 2:
-        return None
-
-    total_time_diff = sum((gps_data[i][0] - gps_data[i-1][0]).total_seconds() for i in range(1, len(gps_data)))
-    average_time_diff = total_time_diff / (len(gps_data) - 1)
-
-    total_lat_diff = sum(abs(gps_data[i][1] - gps_data[i-1][1]) for i in range(1, len(gps_data)))
-    average_lat_diff = total_lat_diff / (len(gps_data) - 1)
-
-    total_lon_diff = sum(abs(gps_data[i][2] - gps_data[i-1][2]) for i in range(1, len(gps_data)))
-    average_lon_diff = total_lon_diff / (len(gps_data) - 1)
-
-    return average_time_diff, average_lat_diff, average_lon_diff
+def iter_nmea_sentences(nmea_file_path):
+    # Read the file lazily, one stripped line at a time, decoded like load_nmea_sentences
+    with open(nmea_file_path, encoding='ascii', errors='replace') as f:
+        for line in f:
+            yield line.strip()
+
+
+def convert_streaming(nmea_file_path, output_path, max_time_diff, max_lat_lon_diff, distance_in_meters=None,
+                      counters=None, validate_checksums=True, output_format='gpx', stats=None):
+    # Memory stays flat: lines are read, parsed, segmented and written to the output file one at a time
+    gps_data = iter_gps_data(iter_nmea_sentences(nmea_file_path), counters, validate_checksums)
+    if stats is not None:
+        gps_data = stats.observe(gps_data)
+    segments = iter_segments(gps_data, max_time_diff, max_lat_lon_diff, distance_in_meters)
+    return write_segments(segments, output_path, output_format)
+
+
+def convert_file(nmea_file_path, output_path, max_time_diff, max_lat_lon_diff, distance_in_meters=None,
+                 mode='gpxpy', parse_workers=1, simplify_tolerance=None, validate_checksums=True,
+                 output_format='gpx', collect_stats=False):
+    """
+    Convert one NMEA file to GPX (or another output format) and measure it.
+    :param mode: 'gpxpy' builds the gpxpy object tree, 'stream' converts point by point in constant memory,
+                 'numpy' uses the vectorized decoder and segmentation.
+    :param parse_workers: In 'numpy' mode, number of processes decoding chunks of the file in parallel.
+    :param simplify_tolerance: Douglas-Peucker tolerance in metres applied to every segment, not in 'stream' mode.
+    :param validate_checksums: Drop GGA/RMC sentences whose *hh checksum does not match.
+    :param output_format: One of writers.OUTPUT_FORMATS; formats other than 'gpx' skip gpxpy in every mode.
+    :param collect_stats: Gather TrackStats of the parsed fixes in the same pass, returned under 'stats'.
+    :return: Dictionary with the input and output paths, sentence, fix, written point and byte counts,
+             counts of rejected sentences and the elapsed seconds.
+    """
+    counters = Counter()
+    stats = TrackStats(max_time_diff, max_lat_lon_diff, distance_in_meters) if collect_stats else None
+    start = perf_counter()
+
+    if mode == 'stream':
+        points = fixes = convert_streaming(nmea_file_path, output_path, max_time_diff, max_lat_lon_diff,
+                                           distance_in_meters, counters, validate_checksums, output_format, stats)
+    elif mode == 'gpxpy' and output_format == 'gpx':
+        track = nmea_to_gps_data(iter_nmea_sentences(nmea_file_path), counters, validate_checksums)
+        fixes = len(track)
+        if stats is not None:
+            stats.update(track)
+        gpx = create_gpx_track(track, max_time_diff, max_lat_lon_diff, distance_in_meters, simplify_tolerance)
+        with open(output_path, 'w') as f:
+            f.write(gpx.to_xml())
+        points = gpx.get_points_no()
+    else:
+        if mode == 'numpy' and parse_workers > 1:
+            track = Track.from_columns(decode_nmea_file_parallel(nmea_file_path, parse_workers, counters=counters,
+                                                                 validate_checksums=validate_checksums))
+        elif mode == 'numpy':
+            track = Track.from_columns(decode_nmea_file(nmea_file_path, counters=counters,
+                                                        validate_checksums=validate_checksums))
+        else:
+            track = nmea_to_gps_data(iter_nmea_sentences(nmea_file_path), counters, validate_checksums)
+        fixes = len(track)
+        if stats is not None:
+            stats.update(track)
+        segments = split_track(track, max_time_diff, max_lat_lon_diff, distance_in_meters)
+        if simplify_tolerance:
+            segments = simplify_segments(segments, simplify_tolerance)
+        points = write_segments(segments, output_path, output_format)
+
+    result = {
+        'input': nmea_file_path,
+        'output': output_path,
+        'sentences': counters['sentences'],
+        'rejected': {reason: counters[reason] for reason in REJECT_REASONS},
+        'fixes': fixes,
+        'points': points,
+        'bytes': os.path.getsize(nmea_file_path),
+        'seconds': perf_counter() - start,
+    }
+    if stats is not None:
+        result['stats'] = stats.summary()
+    return result
+
+
+def scan_track_stats(nmea_file_path, max_time_diff=None, max_lat_lon_diff=None, distance_in_meters=None,
+                     validate_checksums=True):
+    # Statistics of a whole log without converting it; block by block, so memory does not grow with the file
+    stats = TrackStats(max_time_diff, max_lat_lon_diff, distance_in_meters)
+    current_day = None
+    for block in iter_file_blocks(nmea_file_path):
+        fixes, current_day = resolve_dates(decode_nmea_block(block, validate_checksums=validate_checksums),
+                                           current_day)
+        stats.update(Track.from_columns(fixes))
+    return stats
+
+
+def find_nmea_files(inputs):
+    # Expand directories (every *.nmea inside) and glob patterns, keeping the order and dropping duplicates
+    nmea_files = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            nmea_files.extend(sorted(glob.glob(os.path.join(pattern, '*.nmea'))))
+        else:
+            nmea_files.extend(sorted(glob.glob(pattern)) or [pattern])
+    return list(dict.fromkeys(nmea_files))
+
+
+def output_path_for(nmea_file_path, output_dir=None, output_format='gpx'):
+    base_name = os.path.splitext(os.path.basename(nmea_file_path))[0] + OUTPUT_FORMATS[output_format][2]
+    return os.path.join(output_dir if output_dir else os.path.dirname(nmea_file_path), base_name)
+
+
+def format_throughput(result):
+    seconds = max(result['seconds'], 1e-9)
+    points = f"{result['points']} points"
+    if result['points'] != result['fixes']:
+        points += f" of {result['fixes']} fixes ({result['points'] / max(result['fixes'], 1):.1%} kept)"
+    report = (f"{result['input']} -> {result['output']}: {points}, "
+              f"{result['sentences']} sentences in {result['seconds']:.2f} s "
+              f"({result['sentences'] / seconds:,.0f} sentences/s, {result['bytes'] / seconds / 1e6:.1f} MB/s)")
+    rejected = ', '.join(f"{count} {reason.replace('_', ' ')}" for reason, count in result['rejected'].items() if count)
+    if rejected:
+        report += f", rejected {rejected}"
+    return report
+
+
+def convert_batch(nmea_files, output_dir, max_time_diff, max_lat_lon_diff, distance_in_meters=None, workers=None,
+                  **convert_options):
+    # Convert every file in its own worker process, reporting each one as it finishes.
+    # convert_options are passed on to convert_file (mode, parse_workers, ...)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(convert_file, nmea_file_path,
+                            output_path_for(nmea_file_path, output_dir, convert_options.get('output_format', 'gpx')),
+                            max_time_diff, max_lat_lon_diff, distance_in_meters, **convert_options): nmea_file_path
+            for nmea_file_path in nmea_files
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # One broken file must not stop the rest of the batch
+                print(f"{futures[future]}: failed: {e}")
+                continue
+            print(format_throughput(result))
+            if 'stats' in result:
+                print(format_stats(result['stats']))
+            results.append(result)
+    return results
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def format_stats(summary, max_segments=20):
+    # Multi-line report of a TrackStats summary, listing at most max_segments segments
+    percentiles = ', '.join(f"p{p} {speed * 3.6:.1f}" for p, speed in summary['speed_percentiles_mps'].items())
+    lines = [
+        f"  {summary['fixes']} fixes in {len(summary['segments'])} segments, {summary['distance_m'] / 1000:.2f} km, "
+        f"moving {format_duration(summary['moving_seconds'])} of {format_duration(summary['elapsed_seconds'])}",
+        f"  Speed km/h: mean {summary['speed_mean_mps'] * 3.6:.1f}, {percentiles}, "
+        f"max {summary['speed_max_mps'] * 3.6:.1f}",
+        f"  Elevation: +{summary['elevation_gain_m']:.0f} m / -{summary['elevation_loss_m']:.0f} m, "
+        f"{summary['altitude_min_m']:.0f} to {summary['altitude_max_m']:.0f} m",
+    ]
+    for index, segment in enumerate(summary['segments'][:max_segments]):
+        lines.append(f"    #{index}: {segment.start:%Y-%m-%d %H:%M:%S} to {segment.end:%H:%M:%S}, "
+                     f"{segment.points} points, {segment.distance_m / 1000:.2f} km, "
+                     f"moving {format_duration(segment.moving_seconds)}, +{segment.elevation_gain_m:.0f} m "
+                     f"-{segment.elevation_loss_m:.0f} m, max {segment.max_speed_mps * 3.6:.1f} km/h")
+    if len(summary['segments']) > max_segments:
+        lines.append(f"    ... and {len(summary['segments']) - max_segments} more segments")
+    return '\n'.join(lines)
 
 
 def haversine(lon1, lat1, lon2, lat2):
@@ -162,34 +402,97 @@ def haversine(lon1, lat1, lon2, lat2):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Convert NMEA sentences to GPX format.')
+    parser.add_argument('inputs', nargs='*', default=["2015-08-12.nmea"],
+                        help='NMEA files, glob patterns or directories containing *.nmea files')
+    parser.add_argument('--output', default=None,
+                        help='Output file when converting a single input, output.gpx (or the --format extension) '
+                             'by default')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='gpx',
+                        help='Output format: GPX, GeoJSON LineStrings (Points for single points), compact delta '
+                             'encoded binary track or Parquet (needs pyarrow)')
+    parser.add_argument('--output_dir', default=None,
+                        help='Directory for batch output, by default every GPX is written next to its input')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes for batch conversion')
+    parser.add_argument('--parse_workers', type=int, default=1,
+                        help='With --numpy, split each file into chunks and decode them on this many processes')
     parser.add_argument('--max_time_diff', type=int, default=5,
                         help='Maximum time difference between points in seconds')
     parser.add_argument('--max_lat_lon_diff', type=float, default=0.0001,
                         help='Maximum latitude/longitude difference between points')
     parser.add_argument('--distance_in_meters', type=float, default=None,
                         help='Maximum distance between points in meters')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read, convert and write point by point so memory does not grow with the input size')
+    parser.add_argument('--numpy', action='store_true',
+                        help='Decode the input with the vectorized NumPy decoder')
+    parser.add_argument('--simplify_tolerance', type=float, default=None,
+                        help='Simplify every segment with Douglas-Peucker, dropping points closer than this many meters '
+                             'to the simplified line')
+    parser.add_argument('--skip_checksums', action='store_true',
+                        help='Do not check the *hh checksums of GGA/RMC sentences')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print distance, moving time, speed, elevation and per segment statistics of every input')
+    parser.add_argument('--suggest_thresholds', action='store_true',
+                        help='Only scan the inputs and suggest segmentation thresholds that fit them, '
+                             'along with their statistics')
+    parser.add_argument('--follow', action='store_true',
+                        help='Keep converting lines appended to a growing log, extending the GPX output')
+    parser.add_argument('--poll_interval', type=float, default=5.0,
+                        help='Seconds between checks for new data in --follow mode')
+    parser.add_argument('--checkpoint', default=None,
+                        help='Checkpoint file for --follow mode, defaults to the output path + .checkpoint.json')
     args = parser.parse_args()
 
-    print("Converting NMEA to GPX...")
-
-    nmea_sentences = load_nmea_sentences("2015-08-12.nmea")
-
-    # remove \n from each sentence
-    nmea_sentences = [sentence.strip() for sentence in nmea_sentences]
-
-    # Parse the NMEA sentences
-    gps_data = nmea_to_gps_data(nmea_sentences)
-
-    # Use the average values calculated or set your own thresholds
-    max_time_diff = 5
-    max_lat_lon_diff = 0.0001
-    distance_in_meters = None
-
-    # Convert NMEA to GPX using the new thresholds
-    gpx = create_gpx_track(gps_data, max_time_diff, max_lat_lon_diff, distance_in_meters)
-
-    # Save to a file
-    with open('output.gpx', 'w') as f:
-        f.write(gpx.to_xml())
-
-    print("GPX data written to 'output.gpx'")
+    if args.simplify_tolerance and (args.stream or args.follow):
+        parser.error('--simplify_tolerance needs whole segments and cannot be combined with --stream or --follow')
+    if args.follow and args.format != 'gpx':
+        parser.error('--follow only supports GPX output')
+    output = args.output or 'output' + OUTPUT_FORMATS[args.format][2]
+
+    convert_options = {
+        'mode': 'stream' if args.stream else 'numpy' if args.numpy else 'gpxpy',
+        'parse_workers': args.parse_workers,
+        'simplify_tolerance': args.simplify_tolerance,
+        'validate_checksums': not args.skip_checksums,
+        'output_format': args.format,
+        'collect_stats': args.stats,
+    }
+    nmea_files = find_nmea_files(args.inputs)
+    if not args.suggest_thresholds:
+        print("Converting NMEA to GPX...")
+
+    if args.suggest_thresholds:
+        for nmea_file_path in nmea_files:
+            stats = scan_track_stats(nmea_file_path, args.max_time_diff, args.max_lat_lon_diff,
+                                     args.distance_in_meters, not args.skip_checksums)
+            print(f"{nmea_file_path}:")
+            print(format_stats(stats.summary()))
+            suggestion = stats.suggest_thresholds()
+            if suggestion is None:
+                print("  Not enough fixes to suggest thresholds")
+            else:
+                print("  Suggested thresholds: " + ' '.join(f'--{name} {value:.6g}'
+                                                            for name, value in suggestion.items()))
+    elif args.follow:
+        if len(nmea_files) != 1:
+            parser.error('--follow needs exactly one input file')
+        print(f"Following '{nmea_files[0]}', writing to '{output}'")
+        follow(nmea_files[0], output, args.max_time_diff, args.max_lat_lon_diff, args.distance_in_meters,
+               args.checkpoint, args.poll_interval, not args.skip_checksums)
+    elif len(nmea_files) == 1 and not args.output_dir:
+        result = convert_file(nmea_files[0], output, args.max_time_diff, args.max_lat_lon_diff,
+                              args.distance_in_meters, **convert_options)
+        print(format_throughput(result))
+        if 'stats' in result:
+            print(format_stats(result['stats']))
+        print(f"Data written to '{output}'")
+    else:
+        start = perf_counter()
+        results = convert_batch(nmea_files, args.output_dir, args.max_time_diff, args.max_lat_lon_diff,
+                                args.distance_in_meters, args.workers, **convert_options)
+        elapsed = perf_counter() - start
+        total_bytes = sum(result['bytes'] for result in results)
+        total_sentences = sum(result['sentences'] for result in results)
+        print(f"Converted {len(results)} of {len(nmea_files)} files in {elapsed:.2f} s "
+              f"({total_sentences / elapsed:,.0f} sentences/s, {total_bytes / elapsed / 1e6:.1f} MB/s)")
@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+
+import numpy as np
+
+from app import convert_file, load_nmea_sentences, nmea_to_gps_data, segments_to_gpx
+from nmea_numpy import concatenate_fix_columns, decode_nmea_block, iter_file_blocks, resolve_dates
+from segmentation import split_track
+from simplify import simplify_segments
+from synthetic_nmea import generate_nmea, parse_size
+from track import Track
+from writers import write_segments
+
+try:
+    import resource
+except ImportError:  # Windows has no getrusage, peak RSS is reported as None there
+    resource = None
+
+STAGES = ('load', 'parse', 'segment', 'simplify', 'serialize')
+# Benchmarked path and the convert_file mode that runs it end to end
+PATHS = {'scalar': 'gpxpy', 'numpy': 'numpy'}
+# Walking pace with some noise, the occasional outlier, a lost fix every hour and a few corrupt sentences
+SYNTHETIC_LOG = {
+    'rate': 1.0,
+    'max_speed': 5.0,
+    'noise': 2.0,
+    'outlier_rate': 0.0005,
+    'gap_every': 3600.0,
+    'gap_length': 60.0,
+    'corrupt_rate': 0.0001,
+}
+# Timings below this are mostly noise and are not compared against a baseline
+MIN_COMPARED_SECONDS = 0.1
+
+
+def peak_rss_mb():
+    # High-water mark of this process's resident memory; ru_maxrss is in KiB on Linux and in bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def format_size(size):
+    for unit, factor in (('GB', 10 ** 9), ('MB', 10 ** 6), ('KB', 10 ** 3)):
+        if size >= factor:
+            return f'{size / factor:g}{unit}'
+    return f'{size}B'
+
+
+def synthetic_log(data_dir, size, seed=0):
+    # Logs are generated once per size and seed and reused by later runs
+    nmea_file_path = os.path.join(data_dir, f'synthetic-{format_size(size)}-{seed}.nmea')
+    if not os.path.exists(nmea_file_path):
+        os.makedirs(data_dir, exist_ok=True)
+        temporary_path = nmea_file_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            generate_nmea(f, target_bytes=size, seed=seed, **SYNTHETIC_LOG)
+        os.replace(temporary_path, nmea_file_path)
+    return nmea_file_path
+
+
+def load_stage(path, nmea_file_path):
+    if path == 'scalar':
+        return load_nmea_sentences(nmea_file_path)
+    return [bytes(block) for block in iter_file_blocks(nmea_file_path)]
+
+
+def parse_stage(path, data):
+    if path == 'scalar':
+        return nmea_to_gps_data(data)
+    parts = []
+    current_day = None
+    for block in data:
+        fixes, current_day = resolve_dates(decode_nmea_block(block), current_day)
+        parts.append(fixes)
+    return Track.from_columns(concatenate_fix_columns(parts))
+
+
+def serialize_stage(path, segments, output_path):
+    if path == 'scalar':
+        with open(output_path, 'w') as f:
+            f.write(segments_to_gpx(segments).to_xml())
+    else:
+        write_segments(segments, output_path)
+
+
+def run_stages(path, nmea_file_path, output_path, thresholds, simplify_tolerance):
+    """
+    Convert one file stage by stage, timing every stage.
+    Meant for a fresh process, so that the peak RSS belongs to this run alone.
+    :return: dict with the seconds of every stage, the peak RSS in MB after every stage and the point counts.
+    """
+    result = {'seconds': {}, 'peak_rss_mb': {'start': peak_rss_mb()}}
+
+    def timed(stage, function, *args):
+        start = perf_counter()
+        value = function(*args)
+        result['seconds'][stage] = perf_counter() - start
+        result['peak_rss_mb'][stage] = peak_rss_mb()
+        return value
+
+    data = timed('load', load_stage, path, nmea_file_path)
+    track = timed('parse', parse_stage, path, data)
+    del data
+    segments = timed('segment', split_track, track, *thresholds)
+    simplified = timed('simplify', simplify_segments, segments, simplify_tolerance)
+    timed('serialize', serialize_stage, path, simplified, output_path)
+
+    result['fixes'] = len(track)
+    result['segments'] = len(segments)
+    result['points'] = sum(len(segment) for segment in simplified)
+    return result
+
+
+def run_convert(path, nmea_file_path, output_path, thresholds, simplify_tolerance):
+    # The end to end conversion as the CLI runs it, for the memory a user actually sees
+    result = convert_file(nmea_file_path, output_path, *thresholds, mode=PATHS[path],
+                          simplify_tolerance=simplify_tolerance)
+    return {'seconds': result['seconds'], 'peak_rss_mb': peak_rss_mb(), 'points': result['points']}
+
+
+def in_fresh_process(function, *args):
+    # One short lived worker per run, because the peak RSS is a high-water mark that would carry over between runs
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def run_benchmark(sizes, paths, data_dir, scalar_max_size=None, thresholds=(5, 0.0001, None),
+                  simplify_tolerance=1.0):
+    """
+    Benchmark every path on a synthetic log of every size.
+    Each run happens twice in a fresh process: once stage by stage and once end to end through convert_file.
+    :param scalar_max_size: Skip the scalar path on larger logs, it keeps every line and fix as Python objects.
+    :return: List of result dicts, one per size and path.
+    """
+    results = []
+    for size in sizes:
+        nmea_file_path = synthetic_log(data_dir, size)
+        for path in paths:
+            if path == 'scalar' and scalar_max_size and size > scalar_max_size:
+                print(f"Skipping the scalar path on {format_size(size)}, above --scalar_max_size")
+                continue
+            output_path = os.path.join(data_dir, f'output-{format_size(size)}-{path}.gpx')
+            try:
+                stages = in_fresh_process(run_stages, path, nmea_file_path, output_path, thresholds,
+                                          simplify_tolerance)
+                convert = in_fresh_process(run_convert, path, nmea_file_path, output_path, thresholds,
+                                           simplify_tolerance)
+            finally:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            result = {'size': format_size(size), 'path': path, 'input_bytes': os.path.getsize(nmea_file_path),
+                      'stages': stages, 'convert': convert}
+            print(format_result(result))
+            results.append(result)
+    return results
+
+
+def format_mb(value):
+    return 'n/a' if value is None else f'{value:,.0f} MB'
+
+
+def format_result(result):
+    stages = result['stages']
+    timings = '  '.join(f"{stage} {stages['seconds'][stage]:.3f} s" for stage in STAGES)
+    return (f"{result['size']:>6} {result['path']:<6}  {timings}  "
+            f"peak {format_mb(stages['peak_rss_mb']['serialize'])}  |  "
+            f"convert {result['convert']['seconds']:.3f} s, peak {format_mb(result['convert']['peak_rss_mb'])}")
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Print how much slower or faster every stage and end to end run got against a baseline result file.
+    :param tolerance: Allowed slowdown, 0.2 accepts up to 20 % more time.
+    :return: List of (size, path, stage) that got slower than allowed.
+    """
+    previous = {(result['size'], result['path']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['size'], result['path']))
+        if before is None:
+            continue
+        timings = [(stage, before['stages']['seconds'][stage], result['stages']['seconds'][stage])
+                   for stage in STAGES]
+        timings.append(('convert', before['convert']['seconds'], result['convert']['seconds']))
+        ratios = []
+        for stage, old, new in timings:
+            ratios.append(f'{stage} {new / old:.2f}x' if old else f'{stage} n/a')
+            if old >= MIN_COMPARED_SECONDS and new > old * (1 + tolerance):
+                regressions.append((result['size'], result['path'], stage))
+        print(f"{result['size']:>6} {result['path']:<6}  " + '  '.join(ratios))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the NMEA to GPX conversion on synthetic logs')
+    parser.add_argument('--sizes', default='1MB,100MB,1GB', help='Comma separated log sizes')
+    parser.add_argument('--paths', default=','.join(PATHS), help='Comma separated paths: scalar, numpy')
+    parser.add_argument('--scalar_max_size', type=parse_size, default=parse_size('100MB'),
+                        help='Largest log the scalar path runs on, 0 runs it on every size')
+    parser.add_argument('--data_dir', default=os.path.join(tempfile.gettempdir(), 'nmea_to_gpx_benchmark'),
+                        help='Where the synthetic logs are generated and kept between runs')
+    parser.add_argument('--simplify_tolerance', type=float, default=1.0,
+                        help='Tolerance of the simplify stage in metres')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', default=None, help='Earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline before the run fails')
+    args = parser.parse_args()
+
+    paths = args.paths.split(',')
+    for path in paths:
+        if path not in PATHS:
+            parser.error(f"Unknown path '{path}', choose from {', '.join(PATHS)}")
+
+    results = run_benchmark([parse_size(size) for size in args.sizes.split(',')], paths, args.data_dir,
+                            args.scalar_max_size, simplify_tolerance=args.simplify_tolerance)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'synthetic_log': SYNTHETIC_LOG,
+            'results': results,
+        }, f, indent=2)
+    print(f"Results written to '{args.output}'")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Slower than the baseline: ' + ', '.join('/'.join(regression) for regression in regressions))
+            sys.exit(1)
@@ -0,0 +1,49 @@
+from functools import reduce
+from operator import xor
+from string import hexdigits
+
+import numpy as np
+
+STAR = ord('*')
+
+# Value of every byte as a hexadecimal digit, -1 for bytes that are not one
+HEX_VALUES = np.full(256, -1, dtype=np.int16)
+for digit in b'0123456789':
+    HEX_VALUES[digit] = digit - ord('0')
+for digit in b'ABCDEF':
+    HEX_VALUES[digit] = digit - ord('A') + 10
+    HEX_VALUES[digit + 32] = digit - ord('A') + 10
+
+
+def checksum_ok(sentence):
+    # "$<body>*hh": hh is the XOR of all characters of the body, as two hexadecimal digits
+    star = sentence.find('*', 1)
+    digits = sentence[star + 1:star + 3]
+    if star < 2 or len(digits) != 2 or not all(digit in hexdigits for digit in digits):
+        return False
+    return reduce(xor, sentence[1:star].encode(), 0) == int(digits, 16)
+
+
+def valid_checksums(buf, line_starts, line_ends):
+    """
+    Check the checksums of many sentences of one byte buffer at once.
+    :param buf: uint8 array of the raw NMEA data.
+    :param line_starts: Offsets of the '$' of every sentence to check.
+    :param line_ends: Offsets where those sentences end (their newline or the end of the buffer).
+    :return: Boolean mask, False for sentences without a checksum or with a wrong one.
+    """
+    if len(line_starts) == 0:
+        return np.zeros(0, dtype=bool)
+
+    stars = np.flatnonzero(buf == STAR)
+    star = np.append(stars, len(buf))[np.searchsorted(stars, line_starts + 1)]
+    valid = (star > line_starts + 1) & (star + 2 < line_ends)
+
+    # XOR of buf[start + 1:star] for every line, via reduceat on (start + 1, star) index pairs
+    star = np.where(valid, star, line_starts + 2)
+    bounds = np.minimum(np.column_stack((line_starts + 1, star)).ravel(), len(buf) - 1)
+    computed = np.bitwise_xor.reduceat(buf, bounds)[::2]
+
+    high = HEX_VALUES[buf[np.minimum(star + 1, len(buf) - 1)]]
+    low = HEX_VALUES[buf[np.minimum(star + 2, len(buf) - 1)]]
+    return valid & (high >= 0) & (low >= 0) & (computed == high * 16 + low)
@@ -0,0 +1,129 @@
+import json
+import mmap
+import os
+import time
+
+from nmea_numpy import decode_nmea_block, line_block_bounds, resolve_dates
+from segmentation import segment_breaks
+from track import Track
+from writers import GPX_FOOTER, GPX_HEADER, SEGMENT_END, SEGMENT_START, format_gpx_point
+
+
+def default_checkpoint_path(output_path):
+    return output_path + '.checkpoint.json'
+
+
+def initial_state():
+    return {
+        'input_offset': 0,  # bytes of the NMEA file already converted, always at a line boundary
+        'last_day': None,  # day of the last active RMC, carried into the next GGA sentences
+        'last_fix': None,  # [epoch microseconds, latitude, longitude, altitude] of the last written point
+        'segment_open': False,  # whether the last <trkseg> continues with the next point
+        'output_offset': None,  # where new points go in the GPX file, the closing tags come after it
+    }
+
+
+def load_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return initial_state()
+
+
+def save_checkpoint(checkpoint_path, state):
+    # Write and rename so a crash never leaves a half written checkpoint
+    temporary_path = checkpoint_path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def gpx_closing_tags(state):
+    return (SEGMENT_END if state['segment_open'] else '') + GPX_FOOTER
+
+
+def append_track(out, state, track, max_time_diff, max_lat_lon_diff, distance_in_meters=None):
+    # Write new points to the GPX file at its current position, continuing the open segment when allowed
+    if state['last_fix'] is not None:
+        previous = Track(*([value] for value in state['last_fix']))
+        breaks = segment_breaks(Track.concatenate([previous, track]), max_time_diff, max_lat_lon_diff,
+                                distance_in_meters) - 1
+        continues_segment = state['segment_open'] and (len(breaks) == 0 or breaks[0] != 0)
+        breaks = breaks[breaks > 0]
+    else:
+        breaks = segment_breaks(track, max_time_diff, max_lat_lon_diff, distance_in_meters)
+        continues_segment = False
+
+    for index, segment in enumerate(track.split(breaks)):
+        if index > 0 or not continues_segment:
+            if state['segment_open']:
+                out.write(SEGMENT_END.encode())
+            out.write(SEGMENT_START.encode())
+            state['segment_open'] = True
+        out.write(''.join(format_gpx_point(*point) for point in segment).encode())
+
+    state['last_fix'] = [int(track.times[-1]), *track.point(-1)[1:]]
+
+
+def follow_once(nmea_file_path, output_path, max_time_diff, max_lat_lon_diff, distance_in_meters=None,
+                checkpoint_path=None, block_size=64 * 1024 * 1024, validate_checksums=True):
+    """
+    Convert only the lines appended to the NMEA file since the last call and extend the GPX file with them.
+    A partial last line is left for the next call.
+    :return: Number of points added.
+    """
+    checkpoint_path = checkpoint_path or default_checkpoint_path(output_path)
+    state = load_checkpoint(checkpoint_path)
+
+    input_size = os.path.getsize(nmea_file_path)
+    if input_size < state['input_offset'] or not os.path.exists(output_path):
+        # The log was rotated or truncated, or the output is gone: start over
+        state = initial_state()
+
+    if state['output_offset'] is None:
+        with open(output_path, 'wb') as out:
+            out.write(GPX_HEADER.encode())
+            state['output_offset'] = out.tell()
+            out.write(gpx_closing_tags(state).encode())
+
+    points_added = 0
+    if input_size > state['input_offset']:
+        with open(nmea_file_path, 'rb') as f, open(output_path, 'r+b') as out:
+            out.seek(state['output_offset'])
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start, end in line_block_bounds(mapped, block_size, state['input_offset']):
+                    if mapped[end - 1] != ord('\n'):
+                        # Leave the partial last line for the next call
+                        end = mapped.rfind(b'\n', start, end) + 1
+                        if end <= start:
+                            break
+                    data = memoryview(mapped)[start:end]
+                    try:
+                        decoded = decode_nmea_block(data, validate_checksums=validate_checksums)
+                    finally:
+                        data.release()
+                    fixes, state['last_day'] = resolve_dates(decoded, state['last_day'])
+                    track = Track.from_columns(fixes)
+                    if len(track):
+                        append_track(out, state, track, max_time_diff, max_lat_lon_diff, distance_in_meters)
+                        points_added += len(track)
+                    state['input_offset'] = end
+
+            state['output_offset'] = out.tell()
+            out.write(gpx_closing_tags(state).encode())
+            out.truncate()
+
+    save_checkpoint(checkpoint_path, state)
+    return points_added
+
+
+def follow(nmea_file_path, output_path, max_time_diff, max_lat_lon_diff, distance_in_meters=None,
+           checkpoint_path=None, poll_interval=5.0, validate_checksums=True):
+    # Poll the growing log forever, each tick costs work proportional to the newly appended data only
+    while True:
+        points_added = follow_once(nmea_file_path, output_path, max_time_diff, max_lat_lon_diff,
+                                   distance_in_meters, checkpoint_path, validate_checksums=validate_checksums)
+        if points_added:
+            print(f"Added {points_added} points to '{output_path}'")
+        time.sleep(poll_interval)
@@ -0,0 +1,324 @@
+import mmap
+import os
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import repeat
+from math import ceil
+
+import numpy as np
+
+from checksum import valid_checksums
+
+GPGGA = np.frombuffer(b'$GPGGA', dtype=np.uint8)
+GPRMC = np.frombuffer(b'$GPRMC', dtype=np.uint8)
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+COMMA = ord(',')
+ZERO = ord('0')
+
+MICROSECONDS_PER_SECOND = 1_000_000
+MICROSECONDS_PER_DAY = 86_400 * MICROSECONDS_PER_SECOND
+EPOCH = datetime(1970, 1, 1)
+# decode_nmea_file_parallel does not split files into chunks smaller than this, their overhead would outweigh the gain
+MIN_PARALLEL_BLOCK_SIZE = 1024 * 1024
+# Wider fields are parsed one by one by _floats: its matrix of characters is as wide as the widest field, so a
+# single overlong field of a broken line would make it rows x that many bytes
+MAX_FLOAT_WIDTH = 32
+
+# Columns of one decoded block. GGA fixes that come before the first active RMC of the block have
+# date_index -1, their date has to come from whatever was parsed before the block.
+DecodedBlock = namedtuple('DecodedBlock', [
+    'time_of_day',  # int64 microseconds since midnight, one per GGA
+    'latitudes',  # float64 degrees, one per GGA
+    'longitudes',  # float64 degrees, one per GGA
+    'altitudes',  # float64 metres, one per GGA
+    'date_index',  # int64 index into rmc_days of the last active RMC before each GGA, -1 if none
+    'rmc_days',  # int64 days since 1970-01-01, one per active RMC
+])
+
+# Fixes with resolved dates; times are int64 microseconds since 1970-01-01 (NMEA times are UTC)
+FixColumns = namedtuple('FixColumns', ['times', 'latitudes', 'longitudes', 'altitudes'])
+
+
+def _digits(buf, starts, ends, width):
+    # Integer value of the ASCII digits buf[start:end] (at most `width` of them), -1 if empty or not all digits
+    value = np.zeros(len(starts), dtype=np.int64)
+    valid = ends > starts
+    for offset in range(width):
+        inside = starts + offset < ends
+        digit = buf[np.minimum(starts + offset, len(buf) - 1)].astype(np.int64) - ZERO
+        valid &= ~inside | ((digit >= 0) & (digit <= 9))
+        value = np.where(inside, value * 10 + digit, value)
+    return np.where(valid, value, -1)
+
+
+def _float_or_nan(text):
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def _floats(buf, starts, ends):
+    # Parse buf[start:end] of every row as a float, exactly like float() on the same characters; NaN if it fails
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.float64)
+    lengths = np.maximum(ends - starts, 0)
+    wide = lengths > MAX_FLOAT_WIDTH
+    if wide.any():
+        values = np.empty(len(starts), dtype=np.float64)
+        values[~wide] = _floats(buf, starts[~wide], ends[~wide])
+        values[wide] = [_float_or_nan(buf[start:end].tobytes())
+                        for start, end in zip(starts[wide].tolist(), ends[wide].tolist())]
+        return values
+    width = max(int(lengths.max()), 1)
+    columns = np.arange(width)
+    indices = np.minimum(starts[:, None] + columns, len(buf) - 1)
+    chars = np.where(columns < lengths[:, None], buf[indices], 0).astype(np.uint8)
+    strings = chars.view(f'S{width}').ravel()
+    try:
+        return strings.astype(np.float64)
+    except ValueError:
+        # Some field is broken, parse one by one to find out which
+        return np.array([_float_or_nan(text) for text in strings.tolist()], dtype=np.float64)
+
+
+def _select_lines(buf, line_starts, prefix):
+    candidates = line_starts[line_starts + len(prefix) <= len(buf)]
+    matches = np.all(buf[candidates[:, None] + np.arange(len(prefix))] == prefix, axis=1)
+    return candidates[matches]
+
+
+def _is_char(buf, starts, ends, char):
+    # Whether the field buf[start:end] is exactly the single character `char`
+    return (ends - starts == 1) & (buf[np.minimum(starts, len(buf) - 1)] == ord(char))
+
+
+def decode_nmea_block(data, counters=None, validate_checksums=True):
+    """
+    Decode all $GPGGA and $GPRMC sentences of a block of raw NMEA bytes in one vectorized pass.
+    Sentences with a wrong checksum, GGA sentences without a fix and sentences with missing or broken fields
+    are dropped and counted instead of stopping the conversion.
+    :param data: bytes, bytearray, mmap or memoryview holding whole lines.
+    :param counters: Optional collections.Counter; 'sentences' is increased by the number of lines in the block,
+                     'bad_checksum', 'no_fix' and 'malformed' by the number of dropped GGA/RMC sentences.
+    :param validate_checksums: Check the *hh checksum of every GGA/RMC sentence.
+    :return: DecodedBlock with one entry per valid GGA fix and one per valid active RMC sentence.
+    """
+    counters = Counter() if counters is None else counters
+    buf = np.frombuffer(data, dtype=np.uint8)
+    # Lines end with '\n', '\r\n' or a lone '\r', like the lines of the universal newlines mode app reads files in
+    lone_carriage_returns = buf == CARRIAGE_RETURN
+    lone_carriage_returns[:-1] &= buf[1:] != NEWLINE
+    newlines = np.flatnonzero((buf == NEWLINE) | lone_carriage_returns)
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_starts = line_starts[line_starts < len(buf)]
+    commas = np.flatnonzero(buf == COMMA)
+    counters['sentences'] += len(line_starts)
+    # With the end of the buffer appended, so that lookups past the last comma or newline stay in bounds
+    commas_or_end = np.append(commas, len(buf))
+    newlines_or_end = np.append(newlines, len(buf))
+
+    def has_field(first_comma, line_ends, index):
+        # Whether the line has the given comma separated field, i.e. at least `index` commas
+        last = first_comma + index - 1
+        present = last < len(commas)
+        present[present] = commas[last[present]] < line_ends[present]
+        return present
+
+    def field(first_comma, line_ends, index):
+        # Start (inclusive) and end (exclusive) of the given field of each line, the last field ends with the line
+        following = commas_or_end[np.minimum(first_comma + index, len(commas))]
+        return commas[np.minimum(first_comma + index - 1, len(commas) - 1)] + 1, np.minimum(following, line_ends)
+
+    def usable_lines(prefix, last_field):
+        # Lines starting with the prefix that have a valid checksum and at least fields 0 to last_field
+        starts = _select_lines(buf, line_starts, prefix)
+        ends = newlines_or_end[np.searchsorted(newlines, starts)]
+        ends -= (ends > starts) & (buf[np.maximum(ends - 1, 0)] == CARRIAGE_RETURN)
+        if validate_checksums:
+            valid = valid_checksums(buf, starts, ends)
+            counters['bad_checksum'] += int(np.count_nonzero(~valid))
+            starts, ends = starts[valid], ends[valid]
+        first_comma = np.searchsorted(commas, starts)
+        complete = has_field(first_comma, ends, last_field)
+        counters['malformed'] += int(np.count_nonzero(~complete))
+        return starts[complete], ends[complete], first_comma[complete]
+
+    # GGA: time, latitude, longitude and altitude
+    gga, gga_ends, gga_commas = usable_lines(GPGGA, 6)
+    time_start, time_end = field(gga_commas, gga_ends, 1)
+    lat_start, lat_end = field(gga_commas, gga_ends, 2)
+    lat_dir_start, lat_dir_end = field(gga_commas, gga_ends, 3)
+    lon_start, lon_end = field(gga_commas, gga_ends, 4)
+    lon_dir_start, lon_dir_end = field(gga_commas, gga_ends, 5)
+    quality_start, quality_end = field(gga_commas, gga_ends, 6)
+    alt_start, alt_end = field(gga_commas, gga_ends, 9)
+
+    no_fix = (quality_start == quality_end) | _is_char(buf, quality_start, quality_end, '0')
+    no_fix |= (time_start == time_end) | (lat_start == lat_end) | (lon_start == lon_end)
+
+    hours = _digits(buf, time_start, np.minimum(time_start + 2, time_end), 2)
+    minutes = _digits(buf, time_start + 2, np.minimum(time_start + 4, time_end), 2)
+    seconds = _floats(buf, time_start + 4, time_end)
+    whole_seconds = np.nan_to_num(seconds, nan=-1).astype(np.int64)
+    time_of_day = ((hours * 60 + minutes) * 60 + whole_seconds) * MICROSECONDS_PER_SECOND
+    time_of_day += (np.nan_to_num(np.remainder(seconds, 1.0)) * 1e6).astype(np.int64)
+
+    latitudes = _floats(buf, lat_start, np.minimum(lat_start + 2, lat_end)) + _floats(buf, lat_start + 2, lat_end) / 60.0
+    latitudes[_is_char(buf, lat_dir_start, lat_dir_end, 'S')] *= -1
+
+    longitudes = _floats(buf, lon_start, np.minimum(lon_start + 3, lon_end)) + _floats(buf, lon_start + 3, lon_end) / 60.0
+    longitudes[_is_char(buf, lon_dir_start, lon_dir_end, 'W')] *= -1
+
+    altitudes = _floats(buf, alt_start, alt_end)
+
+    malformed = ~has_field(gga_commas, gga_ends, 9)
+    malformed |= (hours < 0) | (hours > 23) | (minutes < 0) | (minutes > 59) | (whole_seconds < 0) | (whole_seconds > 59)
+    malformed |= np.isnan(latitudes) | np.isnan(longitudes) | np.isnan(altitudes)
+    malformed &= ~no_fix
+    counters['no_fix'] += int(np.count_nonzero(no_fix))
+    counters['malformed'] += int(np.count_nonzero(malformed))
+
+    fix = ~(no_fix | malformed)
+    gga, time_of_day, latitudes, longitudes, altitudes = (
+        gga[fix], time_of_day[fix], latitudes[fix], longitudes[fix], altitudes[fix])
+
+    # RMC: only active sentences carry the date forward
+    rmc, rmc_ends, rmc_commas = usable_lines(GPRMC, 2)
+    status_start, status_end = field(rmc_commas, rmc_ends, 2)
+    active = _is_char(buf, status_start, status_end, 'A')
+    rmc, rmc_ends, rmc_commas = rmc[active], rmc_ends[active], rmc_commas[active]
+    date_start, date_end = field(rmc_commas, rmc_ends, 9)
+
+    days = _digits(buf, date_start, np.minimum(date_start + 2, date_end), 2)
+    months = _digits(buf, date_start + 2, np.minimum(date_start + 4, date_end), 2)
+    years = _digits(buf, date_start + 4, np.minimum(date_start + 6, date_end), 2) + 2000
+    valid_date = has_field(rmc_commas, rmc_ends, 9) & (days >= 1) & (months >= 1) & (months <= 12) & (years >= 2000)
+    months, years = np.where(valid_date, months, 1), np.where(valid_date, years, 2000)
+    first_of_month = (years - 1970).astype('datetime64[Y]') + (months - 1).astype('timedelta64[M]')
+    days_in_month = ((first_of_month + 1).astype('datetime64[D]') - first_of_month.astype('datetime64[D]')).astype(np.int64)
+    valid_date &= days <= days_in_month
+    counters['malformed'] += int(np.count_nonzero(~valid_date))
+
+    rmc = rmc[valid_date]
+    rmc_days = (first_of_month.astype('datetime64[D]').astype(np.int64) + days - 1)[valid_date]
+
+    date_index = np.searchsorted(rmc, gga, side='right') - 1
+
+    return DecodedBlock(time_of_day, latitudes, longitudes, altitudes, date_index, rmc_days)
+
+
+def resolve_dates(block, initial_day=None):
+    """
+    Attach dates to the GGA fixes of a block, dropping fixes that have no active RMC date before them.
+    :param block: DecodedBlock.
+    :param initial_day: Day (days since epoch) of the last active RMC before this block, or None.
+    :return: FixColumns and the day carried into the next block.
+    """
+    day_of_fix = np.append(block.rmc_days, -1 if initial_day is None else initial_day)[block.date_index]
+    dated = day_of_fix >= 0 if initial_day is None else np.ones(len(day_of_fix), dtype=bool)
+    times = day_of_fix[dated] * MICROSECONDS_PER_DAY + block.time_of_day[dated]
+    fixes = FixColumns(times, block.latitudes[dated], block.longitudes[dated], block.altitudes[dated])
+
+    last_day = int(block.rmc_days[-1]) if len(block.rmc_days) else initial_day
+    return fixes, last_day
+
+
+def line_block_bounds(mapped, block_size, start=0):
+    # (start, end) offsets of consecutive blocks of about block_size bytes that always end at a line boundary
+    while start < len(mapped):
+        end = mapped.find(b'\n', min(start + block_size, len(mapped)) - 1) + 1 or len(mapped)
+        yield start, end
+        start = end
+
+
+def iter_file_blocks(nmea_file_path, block_size=64 * 1024 * 1024):
+    # Memory-map the file and yield consecutive blocks that always end at a line boundary
+    with open(nmea_file_path, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start, end in line_block_bounds(mapped, block_size):
+                block = memoryview(mapped)[start:end]
+                try:
+                    yield block
+                finally:
+                    block.release()
+
+
+def empty_fix_columns():
+    return FixColumns(*(np.zeros(0, dtype=dtype) for dtype in (np.int64, np.float64, np.float64, np.float64)))
+
+
+def concatenate_fix_columns(parts):
+    if not parts:
+        return empty_fix_columns()
+    return FixColumns(*(np.concatenate(column) for column in zip(*parts)))
+
+
+def decode_nmea_file(nmea_file_path, block_size=64 * 1024 * 1024, counters=None, validate_checksums=True):
+    # Decode a whole file block by block, carrying the RMC date across block boundaries
+    parts = []
+    current_day = None
+    for block in iter_file_blocks(nmea_file_path, block_size):
+        fixes, current_day = resolve_dates(decode_nmea_block(block, counters, validate_checksums), current_day)
+        parts.append(fixes)
+    return concatenate_fix_columns(parts)
+
+
+def decode_file_range(nmea_file_path, start, end, validate_checksums=True):
+    # Worker side of decode_nmea_file_parallel: map the file and decode the bytes between two line boundaries
+    counters = Counter()
+    with open(nmea_file_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            block = memoryview(mapped)[start:end]
+            try:
+                return decode_nmea_block(block, counters, validate_checksums), counters
+            finally:
+                block.release()
+
+
+def parallel_block_size(size, workers, block_size=64 * 1024 * 1024):
+    # Chunk size that gives every worker a chunk of a file of `size` bytes, at most block_size and at least
+    # MIN_PARALLEL_BLOCK_SIZE
+    return min(block_size, max(ceil(size / workers), MIN_PARALLEL_BLOCK_SIZE))
+
+
+def decode_nmea_file_parallel(nmea_file_path, workers=None, block_size=64 * 1024 * 1024, counters=None,
+                              validate_checksums=True):
+    """
+    Decode one large file on several processes. The file is split at newline boundaries and every worker
+    decodes its chunks independently; GGA fixes at the start of a chunk do not know their date yet, so the
+    dates are resolved here, in file order, carrying the last active RMC date from chunk to chunk.
+    The result is identical to decode_nmea_file.
+    :param block_size: Largest chunk, see parallel_block_size.
+    """
+    workers = workers or os.cpu_count() or 1
+    with open(nmea_file_path, 'rb') as f:
+        size = f.seek(0, 2)
+        if size == 0:
+            return empty_fix_columns()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            bounds = list(line_block_bounds(mapped, parallel_block_size(size, workers, block_size)))
+
+    parts = []
+    current_day = None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        decoded = executor.map(decode_file_range, repeat(nmea_file_path), *zip(*bounds), repeat(validate_checksums))
+        # map() yields in submission order, so the date can be carried as chunks arrive
+        for block, block_counters in decoded:
+            fixes, current_day = resolve_dates(block, current_day)
+            parts.append(fixes)
+            if counters is not None:
+                counters.update(block_counters)
+    return concatenate_fix_columns(parts)
+
+
+def fix_columns_to_gps_data(fixes):
+    # Same list of (datetime, latitude, longitude, altitude) tuples as the scalar nmea_to_gps_data
+    return [
+        (EPOCH + timedelta(microseconds=int(time)), float(latitude), float(longitude), float(altitude))
+        for time, latitude, longitude, altitude in zip(*fixes)
+    ]
@@ -0,0 +1,45 @@
+import numpy as np
+
+# Distances in this module are in metres, matching the --distance_in_meters threshold
+EARTH_RADIUS_M = 6371000.0
+
+
+def haversine_m(lon1, lat1, lon2, lat2):
+    # Vectorized great-circle distance in metres between arrays of points given in degrees
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a)) * EARTH_RADIUS_M
+
+
+def consecutive_distances_m(track):
+    # Distance from every point to the next one, len(track) - 1 values
+    return haversine_m(track.longitudes[:-1], track.latitudes[:-1], track.longitudes[1:], track.latitudes[1:])
+
+
+def segment_breaks(track, max_time_diff, max_lat_lon_diff, distance_in_meters=None):
+    """
+    Find where new segments start, using the same rules as app.should_create_new_path for every consecutive pair.
+    :param track: Track to split.
+    :param max_time_diff: Maximum time difference between points in seconds.
+    :param max_lat_lon_diff: Maximum latitude/longitude difference in degrees, used when distance_in_meters is None.
+    :param distance_in_meters: Maximum great-circle distance between points in metres.
+    :return: Sorted int64 array of indices of the first point of every segment except the first one.
+    """
+    if len(track) < 2:
+        return np.zeros(0, dtype=np.int64)
+
+    new_path = np.diff(track.times) / 1e6 > max_time_diff
+
+    if distance_in_meters is not None:
+        new_path |= consecutive_distances_m(track) > distance_in_meters
+    else:
+        new_path |= np.abs(np.diff(track.latitudes)) > max_lat_lon_diff
+        new_path |= np.abs(np.diff(track.longitudes)) > max_lat_lon_diff
+
+    return np.flatnonzero(new_path) + 1
+
+
+def split_track(track, max_time_diff, max_lat_lon_diff, distance_in_meters=None):
+    return track.split(segment_breaks(track, max_time_diff, max_lat_lon_diff, distance_in_meters))
@@ -0,0 +1,62 @@
+import numpy as np
+
+from segmentation import EARTH_RADIUS_M
+from track import Track
+
+
+def project_to_metres(track):
+    # Local equirectangular projection around the track's mean latitude, good enough within one segment
+    lat0 = np.radians(track.latitudes.mean())
+    x = np.radians(track.longitudes - track.longitudes[0]) * np.cos(lat0) * EARTH_RADIUS_M
+    y = np.radians(track.latitudes - track.latitudes[0]) * EARTH_RADIUS_M
+    return x, y
+
+
+def point_to_segment_distances(x, y, x1, y1, x2, y2):
+    # Distances of the points (x, y) from the line segment (x1, y1)-(x2, y2)
+    dx, dy = x2 - x1, y2 - y1
+    length_squared = dx * dx + dy * dy
+    if length_squared == 0:
+        return np.hypot(x - x1, y - y1)
+    t = np.clip(((x - x1) * dx + (y - y1) * dy) / length_squared, 0.0, 1.0)
+    return np.hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+
+def douglas_peucker_mask(x, y, tolerance):
+    """
+    Douglas-Peucker simplification of a polyline.
+    Iterative, and the distances of every sub-range are computed in one vectorized step.
+    :param tolerance: Maximum allowed distance of a dropped point from the simplified line, in the units of x and y.
+    :return: Boolean mask of the points to keep; the first and last point are always kept.
+    """
+    keep = np.zeros(len(x), dtype=bool)
+    if len(x) == 0:
+        return keep
+    keep[0] = keep[-1] = True
+
+    stack = [(0, len(x) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        distances = point_to_segment_distances(x[start + 1:end], y[start + 1:end], x[start], y[start], x[end], y[end])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return keep
+
+
+def simplify_track(track, tolerance_in_meters):
+    # Simplify one segment; run it per segment so that segment ends are never moved or merged
+    if len(track) < 3:
+        return track
+    x, y = project_to_metres(track)
+    keep = douglas_peucker_mask(x, y, tolerance_in_meters)
+    return Track(track.times[keep], track.latitudes[keep], track.longitudes[keep], track.altitudes[keep])
+
+
+def simplify_segments(segments, tolerance_in_meters):
+    return [simplify_track(segment, tolerance_in_meters) for segment in segments]
@@ -0,0 +1,302 @@
+from collections import namedtuple
+from math import ceil, inf, log, nan, sqrt
+
+import numpy as np
+
+from segmentation import consecutive_distances_m, segment_breaks
+from track import EPOCH, ONE_MICROSECOND, Track, TrackBuilder
+
+# Steps slower than this are GPS jitter while standing still and do not count as moving time
+MOVING_SPEED_MPS = 0.5
+# Climbs and descents smaller than this are altitude noise and do not add to the elevation gain or loss
+ELEVATION_HYSTERESIS_M = 2.0
+# Fixes added one at a time are buffered and folded into the statistics this many at once
+PENDING_FIXES = 65536
+SPEED_PERCENTILES = (50, 90, 95, 99)
+# Suggested thresholds are this many times the usual step, with floors for logs that barely move
+GAP_FACTOR = 5
+MIN_LAT_LON_DIFF = 1e-5
+MIN_DISTANCE_M = 1.0
+
+SegmentSummary = namedtuple('SegmentSummary', [
+    'start',  # datetime of the first point
+    'end',  # datetime of the last point
+    'points',
+    'distance_m',
+    'moving_seconds',
+    'elevation_gain_m',
+    'elevation_loss_m',
+    'max_speed_mps',
+])
+
+
+class RunningStats:
+    """
+    Count, mean, variance, minimum and maximum of a stream of values in constant memory.
+    Whole arrays are folded in at once by merging their own mean and sum of squared deviations into the running ones
+    (Welford's update, generalised to batches as by Chan et al.), so results do not depend on how values are chunked.
+    """
+    __slots__ = ('count', 'mean', 'm2', 'minimum', 'maximum')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = inf
+        self.maximum = -inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        mean = float(values.mean())
+        self._merge(len(values), mean, float(np.square(values - mean).sum()), float(values.min()),
+                    float(values.max()))
+
+    def merge(self, other):
+        if other.count:
+            self._merge(other.count, other.mean, other.m2, other.minimum, other.maximum)
+
+    def _merge(self, count, mean, m2, minimum, maximum):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.minimum = min(self.minimum, minimum)
+        self.maximum = max(self.maximum, maximum)
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else nan
+
+    @property
+    def std(self):
+        return sqrt(self.variance)
+
+
+class QuantileSketch:
+    """
+    Approximate quantiles of a stream of non-negative values in bounded memory.
+    Values are counted in logarithmic buckets (the DDSketch layout): every quantile is within relative_accuracy of
+    the true value, and memory depends on the range of the values, never on how many there are.
+    """
+    __slots__ = ('gamma', 'log_gamma', 'min_value', 'max_buckets', 'buckets', 'zero_count', 'count')
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-9, max_buckets=2048):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = log(self.gamma)
+        self.min_value = min_value  # values up to this one are counted as zero
+        self.max_buckets = max_buckets
+        self.buckets = {}  # bucket index i counts values in (gamma ** (i - 1), gamma ** i]
+        self.zero_count = 0
+        self.count = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        small = values <= self.min_value
+        self.zero_count += int(small.sum())
+        self.count += len(values)
+        indices = np.ceil(np.log(values[~small]) / self.log_gamma).astype(np.int64)
+        for index, count in zip(*(column.tolist() for column in np.unique(indices, return_counts=True))):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Only sketches with the same relative accuracy can be merged")
+        self.zero_count += other.zero_count
+        self.count += other.count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def _collapse(self):
+        # Fold the lowest buckets into one, giving up accuracy only at the low end
+        indices = sorted(self.buckets)
+        excess = indices[:len(indices) - self.max_buckets]
+        self.buckets[indices[len(excess)]] += sum(self.buckets.pop(index) for index in excess)
+
+    def quantile(self, q):
+        if not self.count:
+            return nan
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                break
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+
+class _OpenSegment:
+    # Running totals of the segment the last fix belongs to
+    __slots__ = ('start', 'end', 'points', 'distance_m', 'moving_seconds', 'elevation_gain_m', 'elevation_loss_m',
+                 'max_speed_mps', 'anchor_altitude')
+
+    def __init__(self, start_time):
+        self.start = self.end = start_time
+        self.points = 0
+        self.distance_m = self.moving_seconds = self.elevation_gain_m = self.elevation_loss_m = 0.0
+        self.max_speed_mps = 0.0
+        self.anchor_altitude = None
+
+    def extend(self, times, altitudes, step_seconds, step_distances, moving_speed, elevation_hysteresis):
+        # Fold in the points of one slice and the steps between them, return the speed of every timed step
+        self.end = int(times[-1])
+        self.distance_m += float(step_distances.sum())
+        timed = step_seconds > 0
+        speeds = step_distances[timed] / step_seconds[timed]
+        self.moving_seconds += float(step_seconds[timed][speeds >= moving_speed].sum())
+        self.max_speed_mps = max(self.max_speed_mps, float(speeds.max(initial=0.0)))
+
+        # Altitude only counts once it moved more than the hysteresis away from where the last climb or descent ended
+        anchor = self.anchor_altitude
+        for altitude in altitudes.tolist():
+            if anchor is None:
+                anchor = altitude
+            elif altitude > anchor + elevation_hysteresis:
+                self.elevation_gain_m += altitude - anchor
+                anchor = altitude
+            elif altitude < anchor - elevation_hysteresis:
+                self.elevation_loss_m += anchor - altitude
+                anchor = altitude
+        self.anchor_altitude = anchor
+        return speeds
+
+    def summary(self):
+        return SegmentSummary(EPOCH + self.start * ONE_MICROSECOND, EPOCH + self.end * ONE_MICROSECOND, self.points,
+                              self.distance_m, self.moving_seconds, self.elevation_gain_m, self.elevation_loss_m,
+                              self.max_speed_mps)
+
+
+class TrackStats:
+    """
+    Single pass statistics of a track, fed chunk by chunk with update() or fix by fix with add() and observe()
+    while it is being parsed. Memory stays bounded: running moments, quantile sketches, the last fix and the
+    summaries of the segments.
+    With segmentation thresholds, distance, moving time, speeds and elevation only count within segments, using
+    the same rules as segmentation.segment_breaks. The steps between all consecutive fixes are sketched either way,
+    they are what suggest_thresholds() works from.
+    """
+
+    def __init__(self, max_time_diff=None, max_lat_lon_diff=None, distance_in_meters=None,
+                 moving_speed=MOVING_SPEED_MPS, elevation_hysteresis=ELEVATION_HYSTERESIS_M):
+        self.thresholds = None if max_time_diff is None else (max_time_diff, max_lat_lon_diff, distance_in_meters)
+        self.moving_speed = moving_speed
+        self.elevation_hysteresis = elevation_hysteresis
+        self.fixes = 0
+        self.altitudes = RunningStats()
+        self.speeds = RunningStats()
+        self.speed_sketch = QuantileSketch()
+        self.time_steps = QuantileSketch()  # seconds between consecutive fixes
+        self.lat_lon_steps = QuantileSketch()  # larger of the latitude and longitude change, in degrees
+        self.step_distances = QuantileSketch()  # metres between consecutive fixes
+        self.closed_segments = []
+        self.segment = None
+        self.last = None
+        self.pending = TrackBuilder()
+
+    def add(self, time, latitude, longitude, altitude):
+        self.pending.append(time, latitude, longitude, altitude)
+        if len(self.pending) >= PENDING_FIXES:
+            self.flush()
+
+    def observe(self, gps_data):
+        # Pass fixes through unchanged while adding them, for streaming pipelines
+        for fix in gps_data:
+            self.add(*fix)
+            yield fix
+
+    def flush(self):
+        if len(self.pending):
+            track = self.pending.build()
+            self.pending = TrackBuilder()
+            self.update(track)
+
+    def update(self, track):
+        """
+        Fold the next fixes into the statistics.
+        :param track: Track with the fixes that follow the ones added so far.
+        """
+        if len(track) == 0:
+            return
+        self.fixes += len(track)
+        self.altitudes.update(track.altitudes)
+
+        # Steps start at the last fix of the previous call, which is already counted and only carried over
+        carried = 0 if self.last is None else 1
+        combined = track if self.last is None else Track.concatenate([self.last, track])
+        self.last = Track(*(column[-1:].copy() for column in combined.columns()))
+
+        step_seconds = np.diff(combined.times) / 1e6
+        step_distances = consecutive_distances_m(combined)
+        self.time_steps.update(step_seconds)
+        self.lat_lon_steps.update(np.maximum(np.abs(np.diff(combined.latitudes)),
+                                             np.abs(np.diff(combined.longitudes))))
+        self.step_distances.update(step_distances)
+
+        breaks = [] if self.thresholds is None else segment_breaks(combined, *self.thresholds).tolist()
+        bounds = [0, *breaks, len(combined)]
+        for start, end in zip(bounds, bounds[1:]):
+            if start > 0 or self.segment is None:
+                if self.segment is not None:
+                    self.closed_segments.append(self.segment.summary())
+                self.segment = _OpenSegment(int(combined.times[start]))
+                new_start = start
+            else:
+                new_start = start + carried
+            self.segment.points += end - new_start
+            speeds = self.segment.extend(combined.times[start:end], combined.altitudes[new_start:end],
+                                         step_seconds[start:end - 1], step_distances[start:end - 1],
+                                         self.moving_speed, self.elevation_hysteresis)
+            self.speeds.update(speeds)
+            self.speed_sketch.update(speeds)
+
+    def segments(self):
+        # Summaries of every segment so far, the last one still open
+        self.flush()
+        return self.closed_segments + ([self.segment.summary()] if self.segment is not None else [])
+
+    def summary(self):
+        """
+        :return: dict with totals over all segments, speed and altitude statistics and the per segment summaries.
+        """
+        segments = self.segments()
+        return {
+            'fixes': self.fixes,
+            'segments': segments,
+            'distance_m': sum(segment.distance_m for segment in segments),
+            'moving_seconds': sum(segment.moving_seconds for segment in segments),
+            'elapsed_seconds': sum((segment.end - segment.start).total_seconds() for segment in segments),
+            'elevation_gain_m': sum(segment.elevation_gain_m for segment in segments),
+            'elevation_loss_m': sum(segment.elevation_loss_m for segment in segments),
+            'speed_mean_mps': self.speeds.mean if self.speeds.count else nan,
+            'speed_max_mps': self.speeds.maximum if self.speeds.count else nan,
+            'speed_percentiles_mps': {p: self.speed_sketch.quantile(p / 100) for p in SPEED_PERCENTILES},
+            'altitude_min_m': self.altitudes.minimum if self.altitudes.count else nan,
+            'altitude_max_m': self.altitudes.maximum if self.altitudes.count else nan,
+            'altitude_mean_m': self.altitudes.mean if self.altitudes.count else nan,
+            'time_step_median_s': self.time_steps.quantile(0.5),
+        }
+
+    def suggest_thresholds(self):
+        """
+        Segmentation thresholds that fit this log: a new segment starts where a step is several times longer or
+        wider than the usual one. Works from the steps between all consecutive fixes, so it needs no thresholds.
+        :return: dict with max_time_diff (whole seconds), max_lat_lon_diff (degrees) and distance_in_meters,
+                 None with fewer than two fixes.
+        """
+        self.flush()
+        if not self.time_steps.count:
+            return None
+        return {
+            'max_time_diff': max(1, ceil(GAP_FACTOR * self.time_steps.quantile(0.95))),
+            'max_lat_lon_diff': max(MIN_LAT_LON_DIFF, GAP_FACTOR * self.lat_lon_steps.quantile(0.99)),
+            'distance_in_meters': max(MIN_DISTANCE_M, GAP_FACTOR * self.step_distances.quantile(0.99)),
+        }
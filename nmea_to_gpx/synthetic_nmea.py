@@ -0,0 +1,179 @@
+import argparse
+import random
+from datetime import datetime, timedelta
+from functools import reduce
+from math import cos, degrees, radians, sin
+from operator import xor
+
+from segmentation import EARTH_RADIUS_M
+
+GPS_PRNS = range(1, 33)
+GLONASS_PRNS = range(65, 97)
+# Constellation sentences are only rebuilt this often, real receivers change them just as slowly
+SATELLITE_UPDATE_SECONDS = 10
+
+
+def parse_size(text):
+    # '1MB', '100 MB', '1GB' or a plain number of bytes; decimal units like the sizes in the benchmark names
+    units = {'KB': 10 ** 3, 'MB': 10 ** 6, 'GB': 10 ** 9, 'B': 1}
+    text = text.strip().upper()
+    for unit, factor in units.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def nmea_sentence(body, corrupt=False):
+    # "$<body>*hh", a corrupt sentence gets one flipped body character after the checksum was computed
+    checksum = reduce(xor, body.encode(), 0)
+    if corrupt:
+        position = len(body) // 2
+        body = body[:position] + chr(ord(body[position]) ^ 1) + body[position + 1:]
+    return f'${body}*{checksum:02X}\n'
+
+
+def format_coordinate(value, degree_digits, hemispheres):
+    # ddmm.mmmmmm / dddmm.mmmmmm with exact carries, worked out in whole micro-minutes
+    micro_minutes = round(abs(value) * 60e6)
+    whole_degrees, micro_minutes = divmod(micro_minutes, 60_000_000)
+    minutes, fraction = divmod(micro_minutes, 1_000_000)
+    hemisphere = hemispheres[0] if value >= 0 else hemispheres[1]
+    return f'{whole_degrees:0{degree_digits}d}{minutes:02d}.{fraction:06d},{hemisphere}'
+
+
+def format_time(time):
+    return f'{time:%H%M%S}.{time.microsecond // 1000:03d}'
+
+
+def gsa_sentences(talker, satellites, has_fix):
+    # One GSA per constellation, a fix lists the (at most 12) satellites used
+    if not has_fix:
+        return nmea_sentence(f'{talker}GSA,A,1' + ',' * 12 + ',99.99,99.99,99.99')
+    prns = [f'{prn:02d}' for prn, *_ in satellites[:12]]
+    return nmea_sentence(f'{talker}GSA,A,3,' + ','.join(prns + [''] * (12 - len(prns))) + ',1.4,0.8,1.2')
+
+
+def gsv_sentences(talker, satellites):
+    # Satellites in view, four per sentence
+    messages = max(1, (len(satellites) + 3) // 4)
+    sentences = []
+    for index in range(messages):
+        views = ''.join(f',{prn:02d},{elevation:02d},{azimuth:03d},{snr:02d}'
+                        for prn, elevation, azimuth, snr in satellites[index * 4:index * 4 + 4])
+        sentences.append(nmea_sentence(f'{talker}GSV,{messages},{index + 1},{len(satellites):02d}{views}'))
+    return ''.join(sentences)
+
+
+def random_satellites(rng, prns, count):
+    return [(prn, rng.randint(5, 90), rng.randint(0, 359), rng.randint(20, 48))
+            for prn in sorted(rng.sample(prns, count))]
+
+
+def generate_nmea(f, duration=None, target_bytes=None, rate=1.0, start=datetime(2015, 8, 12, 7, 0, 0),
+                  latitude=49.1655, longitude=20.2779, altitude=877.0, max_speed=5.0, noise=2.0,
+                  outlier_rate=0.0, gap_every=None, gap_length=30.0, corrupt_rate=0.0, seed=0):
+    """
+    Write a synthetic GPS/GLONASS receiver log: GNGSA, GPRMC, GPGGA, GPGSA every epoch and GPGSV/GLGSV every second.
+    The position follows a random walk with a varying speed and heading, across midnight and the days after it.
+    :param f: Text file opened for writing.
+    :param duration: Seconds of log to write; generation stops at whichever of duration and target_bytes comes first.
+    :param target_bytes: Approximate file size to write.
+    :param rate: Fixes per second, 10 gives a 10 Hz log.
+    :param max_speed: Upper bound of the random walk's speed in m/s.
+    :param noise: Standard deviation of the reported position around the true one, in metres.
+    :param outlier_rate: Share of fixes that jump 50 to 500 metres away from the track.
+    :param gap_every: Lose the fix for gap_length seconds every gap_every seconds (void RMC, quality 0 GGA).
+    :param corrupt_rate: Share of sentences with a flipped character, so that their checksum no longer matches.
+    :param seed: Seed of the random generator, the same arguments always produce the same file.
+    :return: Number of bytes written.
+    """
+    if duration is None and target_bytes is None:
+        raise ValueError("Either duration or target_bytes is needed")
+    rng = random.Random(seed)
+    interval_ms = round(1000 / rate)
+    epochs = None if duration is None else int(duration * 1000 // interval_ms)
+
+    speed, heading = max_speed / 2, rng.uniform(0, 360)
+    bytes_written = 0
+    epoch = 0
+    constellation = None
+    while (epochs is None or epoch < epochs) and (target_bytes is None or bytes_written < target_bytes):
+        lines = []
+        for epoch in range(epoch, epoch + 1000 if epochs is None else min(epoch + 1000, epochs)):
+            elapsed_ms = epoch * interval_ms
+            time = start + timedelta(milliseconds=elapsed_ms)
+            dt = interval_ms / 1000
+
+            # Move along the true track
+            speed = min(max(speed + rng.gauss(0, 0.3 * dt), 0.0), max_speed)
+            heading = (heading + rng.gauss(0, 5 * dt)) % 360
+            latitude += degrees(speed * dt * cos(radians(heading)) / EARTH_RADIUS_M)
+            longitude += degrees(speed * dt * sin(radians(heading)) / (EARTH_RADIUS_M * cos(radians(latitude))))
+            altitude += rng.gauss(0, 0.2 * dt)
+
+            has_fix = not (gap_every and elapsed_ms / 1000 % gap_every >= gap_every - gap_length)
+            if constellation is None or elapsed_ms % (SATELLITE_UPDATE_SECONDS * 1000) < interval_ms:
+                gps = random_satellites(rng, GPS_PRNS, rng.randint(6, 12))
+                glonass = random_satellites(rng, GLONASS_PRNS, rng.randint(3, 8))
+                constellation = {
+                    fix: (gsa_sentences('GN', gps, fix) + gsa_sentences('GN', glonass, fix),
+                          gsa_sentences('GP', gps, fix))
+                    for fix in (True, False)
+                }
+                views = gsv_sentences('GP', gps) + gsv_sentences('GL', glonass)
+            gn_gsa, gp_gsa = constellation[has_fix]
+
+            # Report the position with noise and the occasional outlier
+            error = rng.gauss(0, noise)
+            if outlier_rate and rng.random() < outlier_rate:
+                error += rng.uniform(50, 500)
+            direction = radians(rng.uniform(0, 360))
+            reported_latitude = latitude + degrees(error * cos(direction) / EARTH_RADIUS_M)
+            reported_longitude = longitude + degrees(error * sin(direction) /
+                                                     (EARTH_RADIUS_M * cos(radians(latitude))))
+            clock, date = format_time(time), f'{time:%d%m%y}'
+            position = (format_coordinate(reported_latitude, 2, 'NS') + ','
+                        + format_coordinate(reported_longitude, 3, 'EW'))
+            if has_fix:
+                rmc = f'GPRMC,{clock},A,{position},{speed * 1.943844:.1f},{heading:.1f},{date},,,A'
+                gga = (f'GPGGA,{clock},{position},1,{min(len(gps), 12):02d},0.8,'
+                       f'{altitude + rng.gauss(0, noise * 1.5):.1f},M,41.8,M,,')
+            else:
+                rmc = f'GPRMC,{clock},V,,,,,,,{date},,,N'
+                gga = f'GPGGA,{clock},,,,,0,00,99.99,,,,,,'
+
+            lines.append(gn_gsa)
+            lines.append(nmea_sentence(rmc, corrupt_rate and rng.random() < corrupt_rate))
+            lines.append(nmea_sentence(gga, corrupt_rate and rng.random() < corrupt_rate))
+            lines.append(gp_gsa)
+            if elapsed_ms % 1000 < interval_ms:
+                lines.append(views)
+        epoch += 1
+
+        chunk = ''.join(lines)
+        f.write(chunk)
+        bytes_written += len(chunk)
+    return bytes_written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic NMEA log for testing and benchmarks')
+    parser.add_argument('output', help='NMEA file to write')
+    parser.add_argument('--size', type=parse_size, default=None, help='Approximate file size, e.g. 100MB')
+    parser.add_argument('--duration', type=float, default=None, help='Seconds of log to write')
+    parser.add_argument('--rate', type=float, default=1.0, help='Fixes per second')
+    parser.add_argument('--noise', type=float, default=2.0, help='Position noise in metres (standard deviation)')
+    parser.add_argument('--outlier_rate', type=float, default=0.0, help='Share of fixes that jump off the track')
+    parser.add_argument('--gap_every', type=float, default=None, help='Lose the fix every this many seconds')
+    parser.add_argument('--gap_length', type=float, default=30.0, help='Seconds without a fix in every gap')
+    parser.add_argument('--corrupt_rate', type=float, default=0.0, help='Share of sentences with a bad checksum')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+    if args.size is None and args.duration is None:
+        parser.error('--size or --duration is needed')
+
+    with open(args.output, 'w') as f:
+        written = generate_nmea(f, args.duration, args.size, args.rate, noise=args.noise,
+                                outlier_rate=args.outlier_rate, gap_every=args.gap_every,
+                                gap_length=args.gap_length, corrupt_rate=args.corrupt_rate, seed=args.seed)
+    print(f"Wrote {written:,} bytes to '{args.output}'")
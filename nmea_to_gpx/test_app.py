@@ -0,0 +1,33 @@
+from collections import Counter
+
+import pytest
+
+from app import iter_gps_data, iter_nmea_sentences, load_nmea_sentences
+
+RMC = b'$GPRMC,071219.000,A,4909.933210,N,02016.678859,E,1.9,188.6,120815,,,A*64\n'
+GGA = b'$GPGGA,071219.000,4909.933210,N,02016.678859,E,1,09,0.8,877.3,M,41.8,M,,*51\n'
+# The GGA sentence with a byte that is not ASCII in its latitude, as a noisy serial line leaves them
+GARBLED_GGA = GGA.replace(b'4909.93', b'4909.9\xff3')
+
+
+@pytest.fixture
+def garbled_log(tmp_path):
+    path = tmp_path / 'garbled.nmea'
+    path.write_bytes(RMC + GGA + GARBLED_GGA + GGA)
+    return str(path)
+
+
+@pytest.mark.parametrize('read_sentences', [load_nmea_sentences, iter_nmea_sentences])
+def test_garbage_byte_fails_the_checksum(garbled_log, read_sentences):
+    counters = Counter()
+    fixes = list(iter_gps_data(read_sentences(garbled_log), counters))
+    assert len(fixes) == 2
+    assert counters['bad_checksum'] == 1
+
+
+@pytest.mark.parametrize('read_sentences', [load_nmea_sentences, iter_nmea_sentences])
+def test_garbage_byte_is_malformed_without_checksums(garbled_log, read_sentences):
+    counters = Counter()
+    fixes = list(iter_gps_data(read_sentences(garbled_log), counters, validate_checksums=False))
+    assert len(fixes) == 2
+    assert counters['malformed'] == 1
@@ -0,0 +1,99 @@
+import os
+import random
+import tracemalloc
+from collections import Counter
+from math import ceil
+
+import pytest
+
+from app import iter_gps_data, iter_nmea_sentences
+import nmea_numpy
+from nmea_numpy import (MAX_FLOAT_WIDTH, decode_nmea_block, decode_nmea_file, decode_nmea_file_parallel,
+                        parallel_block_size)
+from synthetic_nmea import nmea_sentence
+from track import Track
+
+SAMPLE = os.path.join(os.path.dirname(__file__), '2015-08-12.nmea')
+
+RMC = nmea_sentence('GPRMC,071219.000,A,4909.933210,N,02016.678859,E,1.9,188.6,120815,,,A')
+
+
+def gga(altitude):
+    return nmea_sentence(f'GPGGA,071219.000,4909.933210,N,02016.678859,E,1,09,0.8,{altitude},M,41.8,M,,')
+
+
+def decode_like_app(data):
+    # The block decoded by nmea_numpy and by the scalar parser of app, with their counters
+    numpy_counters, app_counters = Counter(), Counter()
+    block = decode_nmea_block(data.encode(), numpy_counters)
+    fixes = list(iter_gps_data(data.splitlines(), app_counters))
+    return block, numpy_counters, fixes, app_counters
+
+
+def test_overlong_field_is_malformed_without_a_huge_matrix():
+    data = RMC + gga('877.3') * 1000 + gga('9' * 100000 + 'x') + gga('877.3')
+    tracemalloc.start()
+    try:
+        block, numpy_counters, fixes, app_counters = decode_like_app(data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # The character matrix of 1002 altitudes 100 KB wide alone would be 100 MB
+    assert peak < 10 * 2 ** 20
+    assert len(block.altitudes) == len(fixes) == 1001
+    assert numpy_counters['malformed'] == app_counters['malformed'] == 1
+
+
+def test_wide_fields_parse_like_float():
+    altitudes = ['0' * MAX_FLOAT_WIDTH + '877.3', '877.' + '3' * MAX_FLOAT_WIDTH, ' 12.5 ', '1e3', '877.3']
+    block, numpy_counters, fixes, app_counters = decode_like_app(RMC + ''.join(gga(altitude) for altitude in altitudes))
+    assert block.altitudes.tolist() == [fix[3] for fix in fixes] == [float(altitude) for altitude in altitudes]
+    assert numpy_counters['malformed'] == app_counters['malformed'] == 0
+
+
+def with_carriage_returns(data, seed):
+    # The log with line breaks turned into lone '\r' or '\r\n', and '\r' put into or between some sentences
+    rng = random.Random(seed)
+    out = bytearray()
+    for byte in data:
+        choice = rng.random()
+        if byte == ord('\n') and choice < 0.1:
+            out += b'\r'
+        elif byte == ord('\n') and choice < 0.2:
+            out += b'\r\n'
+        else:
+            if choice > 0.998:
+                out += b'\r'
+            out.append(byte)
+    return bytes(out)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('validate_checksums', [True, False])
+def test_decoders_agree_on_carriage_returns(tmp_path, seed, validate_checksums):
+    with open(SAMPLE, 'rb') as f:
+        data = with_carriage_returns(f.read(), seed)
+    path = tmp_path / 'carriage_returns.nmea'
+    path.write_bytes(data)
+    numpy_counters, app_counters = Counter(), Counter()
+    decoded = Track.from_columns(decode_nmea_file(str(path), counters=numpy_counters,
+                                                  validate_checksums=validate_checksums))
+    parsed = Track.from_fixes(iter_gps_data(iter_nmea_sentences(str(path)), app_counters, validate_checksums))
+    assert decoded == parsed
+    assert numpy_counters == app_counters
+
+
+@pytest.mark.parametrize('size, workers, chunks', [
+    (100 * 2 ** 20, 8, 8), (100 * 2 ** 20, 1, 2), (10 * 2 ** 30, 8, 160), (3 * 2 ** 20, 8, 3), (1000, 8, 1)])
+def test_parallel_chunks_keep_workers_busy(size, workers, chunks):
+    assert ceil(size / parallel_block_size(size, workers)) == chunks
+
+
+def test_parallel_decode_matches_sequential(monkeypatch):
+    # With small chunks the sample log is split between the workers
+    monkeypatch.setattr(nmea_numpy, 'MIN_PARALLEL_BLOCK_SIZE', 4096)
+    sequential_counters, parallel_counters = Counter(), Counter()
+    sequential = Track.from_columns(decode_nmea_file(SAMPLE, counters=sequential_counters))
+    parallel = Track.from_columns(decode_nmea_file_parallel(SAMPLE, 4, counters=parallel_counters))
+    assert parallel == sequential
+    assert parallel_counters == sequential_counters
@@ -0,0 +1,100 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from app import haversine, should_create_new_path
+from segmentation import haversine_m, segment_breaks
+from track import Track
+
+START = datetime(2015, 8, 12, 7, 0, 0)
+
+
+def random_fixes(seed, count=500):
+    # A walk with occasional time gaps, jumps, repeated points and crossings of the antimeridian
+    rng = random.Random(seed)
+    time, latitude, longitude = START, rng.uniform(-60, 60), rng.uniform(179, 180)
+    fixes = []
+    for _ in range(count):
+        fixes.append((time, latitude, longitude, rng.uniform(0, 1000)))
+        time += timedelta(seconds=rng.choice([1, 1, 1, 5, 30, 600]))
+        step = rng.choice([0.0, 0.0001, 0.001, 0.01, 0.5])
+        latitude = min(89.0, max(-89.0, latitude + rng.uniform(-step, step)))
+        longitude += rng.uniform(-step, step)
+        # Wrap into [-180, 180), so that the walk keeps crossing the antimeridian
+        longitude = (longitude + 180) % 360 - 180
+    return fixes
+
+
+def reference_breaks(fixes, max_time_diff, max_lat_lon_diff, distance_in_meters=None):
+    return [index for index in range(1, len(fixes))
+            if should_create_new_path(fixes[index - 1], fixes[index], max_time_diff, max_lat_lon_diff,
+                                      distance_in_meters)]
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('max_time_diff', [1, 10, 300, 3600])
+@pytest.mark.parametrize('max_lat_lon_diff', [0.0001, 0.005, 0.1, 1.0])
+def test_degree_thresholds_match_should_create_new_path(seed, max_time_diff, max_lat_lon_diff):
+    fixes = random_fixes(seed)
+    breaks = segment_breaks(Track.from_fixes(fixes), max_time_diff, max_lat_lon_diff)
+    assert breaks.tolist() == reference_breaks(fixes, max_time_diff, max_lat_lon_diff)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('max_time_diff', [1, 10, 3600])
+@pytest.mark.parametrize('distance_in_meters', [1.0, 50.0, 1000.0, 100000.0])
+def test_metre_thresholds_match_should_create_new_path(seed, max_time_diff, distance_in_meters):
+    fixes = random_fixes(seed)
+    breaks = segment_breaks(Track.from_fixes(fixes), max_time_diff, 0.0001, distance_in_meters)
+    assert breaks.tolist() == reference_breaks(fixes, max_time_diff, 0.0001, distance_in_meters)
+
+
+def test_threshold_is_in_metres_not_kilometres():
+    # 0.0045 degrees of latitude is about 500 m: a break at 400 m, none at 600 m, and none at 0.4 (km) would be wrong
+    fixes = [(START, 49.0, 20.0, 0.0), (START + timedelta(seconds=1), 49.0045, 20.0, 0.0)]
+    track = Track.from_fixes(fixes)
+    for distance_in_meters, expected in [(400.0, [1]), (600.0, []), (0.4, [1])]:
+        assert segment_breaks(track, 10, 1.0, distance_in_meters).tolist() == expected
+        assert reference_breaks(fixes, 10, 1.0, distance_in_meters) == expected
+
+
+def test_antimeridian_crossing():
+    # Two points 0.02 degrees of longitude apart across the antimeridian, about 2 km at the equator
+    fixes = [(START, 0.0, 179.99, 0.0), (START + timedelta(seconds=1), 0.0, -179.99, 0.0)]
+    track = Track.from_fixes(fixes)
+    assert segment_breaks(track, 10, 1.0, 3000.0).tolist() == reference_breaks(fixes, 10, 1.0, 3000.0) == []
+    assert segment_breaks(track, 10, 1.0, 1000.0).tolist() == reference_breaks(fixes, 10, 1.0, 1000.0) == [1]
+    # In degrees the longitudes are 359.98 apart
+    assert segment_breaks(track, 10, 1.0).tolist() == reference_breaks(fixes, 10, 1.0) == [1]
+
+
+def test_same_point():
+    fixes = [(START + timedelta(seconds=second), 49.1, 20.2, 800.0) for second in range(4)]
+    track = Track.from_fixes(fixes)
+    assert segment_breaks(track, 1, 0.0, 0.0).tolist() == reference_breaks(fixes, 1, 0.0, 0.0) == []
+    assert segment_breaks(track, 1, 0.0).tolist() == reference_breaks(fixes, 1, 0.0) == []
+
+
+def test_time_threshold_is_exclusive():
+    fixes = [(START, 49.1, 20.2, 0.0), (START + timedelta(seconds=10), 49.1, 20.2, 0.0),
+             (START + timedelta(seconds=21), 49.1, 20.2, 0.0)]
+    track = Track.from_fixes(fixes)
+    assert segment_breaks(track, 10, 1.0).tolist() == reference_breaks(fixes, 10, 1.0) == [2]
+
+
+def test_short_tracks_have_no_breaks():
+    assert segment_breaks(Track.empty(), 10, 1.0).tolist() == []
+    assert segment_breaks(Track.from_fixes([(START, 49.1, 20.2, 0.0)]), 10, 1.0, 5.0).tolist() == []
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_haversine_m_is_haversine_in_metres(seed):
+    rng = random.Random(seed)
+    points = [(rng.uniform(-180, 180), rng.uniform(-90, 90), rng.uniform(-180, 180), rng.uniform(-90, 90))
+              for _ in range(200)]
+    points += [(179.99, 0.0, -179.99, 0.0), (20.2, 49.1, 20.2, 49.1), (0.0, 90.0, 180.0, -90.0)]
+    lon1, lat1, lon2, lat2 = map(np.array, zip(*points))
+    expected = [haversine(*point) * 1000 for point in points]
+    np.testing.assert_allclose(haversine_m(lon1, lat1, lon2, lat2), expected, rtol=1e-9, atol=1e-6)
@@ -0,0 +1,47 @@
+import io
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from track import Track
+from writers import CHUNK_POINTS, write_geojson
+
+START = datetime(2015, 8, 12, 7, 0, 0)
+
+
+def line_track(count):
+    # count points one second and 0.0001 degrees apart
+    return Track.from_fixes((START + timedelta(seconds=index), 49.0 + index * 1e-4, 20.0, 800.0)
+                            for index in range(count))
+
+
+def geojson_features(segments):
+    f = io.StringIO()
+    points = write_geojson(segments, f)
+    return points, json.loads(f.getvalue())["features"]
+
+
+def test_single_point_segments_are_points():
+    single = (START, 49.1, 20.2, 877.3)
+    points, features = geojson_features([line_track(3), iter([single]), line_track(1)[:1]])
+    assert points == 5
+    assert [feature["geometry"]["type"] for feature in features] == ["LineString", "Point", "Point"]
+    assert features[1]["geometry"]["coordinates"] == [20.2, 49.1, 877.3]
+    assert features[1]["properties"] == {"segment": 1, "coordTimes": ["2015-08-12T07:00:00Z"]}
+
+
+def test_long_segment_features_join_up():
+    track = line_track(2 * CHUNK_POINTS + 1)
+    for segment in (track, iter(list(track))):
+        points, features = geojson_features([segment])
+        assert points == len(track)
+        assert [feature["geometry"]["type"] for feature in features] == ["LineString"] * 3
+        # Every feature starts where the one before ended, so dropping those repeats gives the whole track
+        for previous, feature in zip(features, features[1:]):
+            assert feature["geometry"]["coordinates"][0] == previous["geometry"]["coordinates"][-1]
+            assert feature["properties"]["coordTimes"][0] == previous["properties"]["coordTimes"][-1]
+        coordinates = features[0]["geometry"]["coordinates"] + [
+            position for feature in features[1:] for position in feature["geometry"]["coordinates"][1:]]
+        np.testing.assert_array_equal(np.array(coordinates)[:, 1], track.latitudes)
+        assert {feature["properties"]["segment"] for feature in features} == {0}
@@ -0,0 +1,125 @@
+from array import array
+from datetime import datetime, timedelta
+
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# Points are converted to Python objects in chunks of this size while iterating
+ITERATION_CHUNK = 4096
+
+
+def datetime_to_epoch_us(time):
+    return (time - EPOCH) // ONE_MICROSECOND
+
+
+class Track:
+    """
+    Columnar store of GPS fixes: int64 epoch microseconds, float64 latitude/longitude and float32 altitude.
+    That is 28 bytes per fix instead of a tuple holding a datetime and three floats.
+    Slicing returns a Track viewing the same memory, iterating yields (datetime, latitude, longitude, altitude).
+    """
+    __slots__ = ('times', 'latitudes', 'longitudes', 'altitudes')
+
+    def __init__(self, times, latitudes, longitudes, altitudes):
+        self.times = np.asarray(times, dtype=np.int64)
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.altitudes = np.asarray(altitudes, dtype=np.float32)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0))
+
+    @classmethod
+    def from_columns(cls, fixes):
+        # fixes: FixColumns from nmea_numpy, or any (times, latitudes, longitudes, altitudes) sequence of columns
+        return cls(*fixes)
+
+    @classmethod
+    def from_fixes(cls, gps_data):
+        builder = TrackBuilder()
+        for time, latitude, longitude, altitude in gps_data:
+            builder.append(time, latitude, longitude, altitude)
+        return builder.build()
+
+    @classmethod
+    def concatenate(cls, tracks):
+        tracks = list(tracks)
+        if not tracks:
+            return cls.empty()
+        return cls(
+            np.concatenate([track.times for track in tracks]),
+            np.concatenate([track.latitudes for track in tracks]),
+            np.concatenate([track.longitudes for track in tracks]),
+            np.concatenate([track.altitudes for track in tracks]),
+        )
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Track(self.times[index], self.latitudes[index], self.longitudes[index], self.altitudes[index])
+        return self.point(index)
+
+    def __iter__(self):
+        for start in range(0, len(self), ITERATION_CHUNK):
+            chunk = self[start:start + ITERATION_CHUNK]
+            yield from zip(chunk.datetimes(), chunk.latitudes.tolist(), chunk.longitudes.tolist(),
+                           chunk.altitudes_as_float())
+
+    def __eq__(self, other):
+        if not isinstance(other, Track):
+            return NotImplemented
+        return all(np.array_equal(a, b) for a, b in zip(self.columns(), other.columns()))
+
+    def columns(self):
+        return self.times, self.latitudes, self.longitudes, self.altitudes
+
+    def point(self, index):
+        time = EPOCH + timedelta(microseconds=int(self.times[index]))
+        return time, float(self.latitudes[index]), float(self.longitudes[index]), float(str(self.altitudes[index]))
+
+    def datetimes(self):
+        return self.times.astype('datetime64[us]').tolist()
+
+    def altitudes_as_float(self):
+        # Shortest float32 representation, so 877.3 stays 877.3 instead of 877.2999877929688
+        return self.altitudes.astype(str).astype(np.float64).tolist()
+
+    def split(self, break_indices):
+        # Slices of the track starting at 0 and at every break index
+        bounds = [0, *break_indices, len(self)]
+        return [self[start:end] for start, end in zip(bounds, bounds[1:]) if end > start]
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns())
+
+
+class TrackBuilder:
+    # Append-only builder backed by the array module; build() hands the buffers to NumPy without copying
+    def __init__(self):
+        self.times = array('q')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.altitudes = array('f')
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, time, latitude, longitude, altitude):
+        self.times.append(datetime_to_epoch_us(time))
+        self.latitudes.append(latitude)
+        self.longitudes.append(longitude)
+        self.altitudes.append(altitude)
+
+    def build(self):
+        return Track(
+            np.frombuffer(self.times, dtype=np.int64),
+            np.frombuffer(self.latitudes, dtype=np.float64),
+            np.frombuffer(self.longitudes, dtype=np.float64),
+            np.frombuffer(self.altitudes, dtype=np.float32),
+        )
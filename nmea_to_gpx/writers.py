@@ -0,0 +1,221 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from track import Track, TrackBuilder
+
+GPX_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<gpx xmlns="http://www.topografix.com/GPX/1/1" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" '
+    'version="1.1" creator="nmea_to_gpx">\n'
+    '  <trk>\n'
+)
+GPX_FOOTER = '  </trk>\n</gpx>'
+SEGMENT_START = '    <trkseg>\n'
+SEGMENT_END = '    </trkseg>\n'
+
+TRKPT_TEMPLATE = (
+    '      <trkpt lat="{!r}" lon="{!r}">\n'
+    '        <ele>{!r}</ele>\n'
+    '        <time>{}</time>\n'
+    '      </trkpt>\n'
+)
+
+
+def format_gpx_point(time, latitude, longitude, altitude):
+    # Same layout and number formatting as gpxpy's to_xml(), so both paths produce identical points
+    return TRKPT_TEMPLATE.format(latitude, longitude, altitude, time.isoformat())
+
+
+def write_gpx(segments, f):
+    """
+    Write segments to an open text file as GPX, one <trkseg> at a time.
+    Nothing but the point being written is kept in memory, so segments may be lazy iterators.
+    :param segments: Iterable of segments, each an iterable of (time, latitude, longitude, altitude).
+    :param f: File opened for writing.
+    :return: Number of points written.
+    """
+    points_written = 0
+    f.write(GPX_HEADER)
+    for segment in segments:
+        f.write(SEGMENT_START)
+        for time, latitude, longitude, altitude in segment:
+            f.write(format_gpx_point(time, latitude, longitude, altitude))
+            points_written += 1
+        f.write(SEGMENT_END)
+    f.write(GPX_FOOTER)
+    return points_written
+
+
+# Streamed formats other than GPX work on columnar chunks of at most this many points
+CHUNK_POINTS = 65536
+
+
+def iter_track_chunks(segment, chunk_size=CHUNK_POINTS):
+    # Columnar chunks of one segment: slices of a Track, or Tracks built from an iterator of fixes
+    if isinstance(segment, Track):
+        for start in range(0, len(segment), chunk_size):
+            yield segment[start:start + chunk_size]
+        return
+    builder = TrackBuilder()
+    for time, latitude, longitude, altitude in segment:
+        builder.append(time, latitude, longitude, altitude)
+        if len(builder) == chunk_size:
+            yield builder.build()
+            builder = TrackBuilder()
+    if len(builder):
+        yield builder.build()
+
+
+def write_geojson(segments, f):
+    """
+    Write segments to an open text file as a GeoJSON FeatureCollection of LineStrings, or of a Point for a segment
+    of a single point, as a LineString needs two.
+    Coordinates are [longitude, latitude, altitude] and the point times are in the coordTimes property.
+    Long segments are written as several consecutive features with the same "segment" property,
+    so that only one chunk is ever held in memory. Every such feature starts with the last point of the one before,
+    so that the line has no gaps.
+    :return: Number of points written, the repeated ones counted once.
+    """
+    points_written = 0
+    features = 0
+    f.write('{"type": "FeatureCollection", "features": [')
+    for segment_index, segment in enumerate(segments):
+        last_point = None  # (coordinates, time) of the previous chunk of the segment
+        for chunk in iter_track_chunks(segment):
+            coordinates = [f'[{longitude!r}, {latitude!r}, {altitude!r}]'
+                           for longitude, latitude, altitude in zip(chunk.longitudes.tolist(), chunk.latitudes.tolist(),
+                                                                    chunk.altitudes_as_float())]
+            times = [time.isoformat() + 'Z' for time in chunk.datetimes()]
+            if last_point is not None:
+                coordinates.insert(0, last_point[0])
+                times.insert(0, last_point[1])
+            last_point = coordinates[-1], times[-1]
+            if len(coordinates) == 1:
+                geometry = f'{{"type": "Point", "coordinates": {coordinates[0]}}}'
+            else:
+                geometry = f'{{"type": "LineString", "coordinates": [{", ".join(coordinates)}]}}'
+            f.write(',\n' if features else '\n')
+            f.write(f'{{"type": "Feature", "geometry": {geometry}, '
+                    f'"properties": {{"segment": {segment_index}, "coordTimes": {json.dumps(times)}}}}}')
+            features += 1
+            points_written += len(chunk)
+    f.write('\n]}\n')
+    return points_written
+
+
+# Binary track: BINARY_MAGIC, then one record per chunk of a segment:
+#   flags (uint8, 1 = first chunk of a new segment), point count (uint32), compressed size (uint32),
+#   zlib compressed payload: first time in epoch milliseconds (int64), then four int32 columns of `count` values,
+#   time in milliseconds, latitude and longitude in micro-degrees and altitude in decimetres,
+#   each stored as the difference to the previous point (the first one relative to zero, times to the first time).
+BINARY_MAGIC = b'NTRK\x01'
+BINARY_RECORD = struct.Struct('<BII')
+BINARY_NEW_SEGMENT = 1
+
+
+def encode_binary_chunk(chunk):
+    times_ms = np.round(chunk.times / 1000).astype(np.int64)
+    columns = (
+        times_ms - times_ms[0],
+        np.round(chunk.latitudes * 1e6).astype(np.int64),
+        np.round(chunk.longitudes * 1e6).astype(np.int64),
+        np.round(chunk.altitudes.astype(np.float64) * 10).astype(np.int64),
+    )
+    deltas = [np.diff(column, prepend=0).astype('<i4') for column in columns]
+    return zlib.compress(struct.pack('<q', times_ms[0]) + b''.join(delta.tobytes() for delta in deltas), 1)
+
+
+def decode_binary_chunk(payload, count):
+    data = zlib.decompress(payload)
+    first_time_ms, = struct.unpack_from('<q', data)
+    columns = np.frombuffer(data, dtype='<i4', offset=8).reshape(4, count).astype(np.int64).cumsum(axis=1)
+    return Track((columns[0] + first_time_ms) * 1000, columns[1] / 1e6, columns[2] / 1e6, columns[3] / 10)
+
+
+def write_binary_track(segments, f):
+    """
+    Write segments to a file opened in binary mode in the compact delta encoded format described above.
+    Precision is 1 ms, 1 micro-degree (about 0.1 m) and 0.1 m of altitude.
+    :return: Number of points written.
+    """
+    points_written = 0
+    f.write(BINARY_MAGIC)
+    for segment in segments:
+        flags = BINARY_NEW_SEGMENT
+        for chunk in iter_track_chunks(segment):
+            payload = encode_binary_chunk(chunk)
+            f.write(BINARY_RECORD.pack(flags, len(chunk), len(payload)))
+            f.write(payload)
+            flags = 0
+            points_written += len(chunk)
+    return points_written
+
+
+def read_binary_track(f):
+    # Read a file written by write_binary_track back into a list of segments (Tracks)
+    if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError("Not a binary track file")
+    segments = []
+    while header := f.read(BINARY_RECORD.size):
+        flags, count, size = BINARY_RECORD.unpack(header)
+        chunk = decode_binary_chunk(f.read(size), count)
+        if flags & BINARY_NEW_SEGMENT or not segments:
+            segments.append([chunk])
+        else:
+            segments[-1].append(chunk)
+    return [Track.concatenate(chunks) for chunks in segments]
+
+
+def write_parquet(segments, f):
+    """
+    Write segments to a file opened in binary mode as Parquet, one row group per chunk.
+    Columns: time (timestamp[us], UTC), latitude, longitude (float64), altitude (float32) and segment (int32).
+    Needs the optional pyarrow package.
+    :return: Number of points written.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet output needs pyarrow, install it with 'pip install pyarrow'")
+
+    schema = pa.schema([
+        ('time', pa.timestamp('us', tz='UTC')),
+        ('latitude', pa.float64()),
+        ('longitude', pa.float64()),
+        ('altitude', pa.float32()),
+        ('segment', pa.int32()),
+    ])
+    points_written = 0
+    with pq.ParquetWriter(f, schema) as writer:
+        for segment_index, segment in enumerate(segments):
+            for chunk in iter_track_chunks(segment):
+                writer.write_table(pa.Table.from_arrays([
+                    pa.array(chunk.times, type=pa.timestamp('us', tz='UTC')),
+                    pa.array(chunk.latitudes),
+                    pa.array(chunk.longitudes),
+                    pa.array(chunk.altitudes),
+                    pa.array(np.full(len(chunk), segment_index, dtype=np.int32)),
+                ], schema=schema))
+                points_written += len(chunk)
+    return points_written
+
+
+# Writer, file mode and extension of every output format
+OUTPUT_FORMATS = {
+    'gpx': (write_gpx, 'w', '.gpx'),
+    'geojson': (write_geojson, 'w', '.geojson'),
+    'bin': (write_binary_track, 'wb', '.trk'),
+    'parquet': (write_parquet, 'wb', '.parquet'),
+}
+
+
+def write_segments(segments, output_path, output_format='gpx'):
+    writer, file_mode, _ = OUTPUT_FORMATS[output_format]
+    with open(output_path, file_mode) as f:
+        return writer(segments, f)